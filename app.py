@@ -1,13 +1,20 @@
-try:
-    from gevent import monkey
-    monkey.patch_all()
-except ImportError:
-    pass
-
 """勤怠管理 Flask アプリケーションのメインモジュール"""
+import time
+IMPORT_STARTED = time.perf_counter()
+
+if __name__ == '__main__':
+    # 開発サーバーとして直接起動したときだけここでパッチする。
+    # gunicorn -k gevent はワーカー起動時に、テストは conftest.py でパッチ済み
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        pass
 
 from flask import (
     Flask,
+    abort,
+    current_app,
     g,
     render_template,
     request,
@@ -18,34 +25,69 @@ from flask import (
     flash,
     Response,
     stream_with_context,
+    has_app_context,
+    before_render_template,
+    template_rendered,
+    stream_template,
+    get_flashed_messages,
+    send_from_directory,
 )
 from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import send_file as werkzeug_send_file
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import escape
 import sqlite3
+import re
 from datetime import datetime, timedelta
 import os
 import csv
 from io import TextIOWrapper
+from pathlib import Path
 from werkzeug.security import generate_password_hash, check_password_hash
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, defaultdict
 from weakref import WeakSet
 import tempfile
+import stat
 import zipfile
 import secrets
+import hashlib
+import hmac
+from urllib.parse import quote
+import queue
+import gzip
+import zlib
 from functools import wraps
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import smtplib
 from email.message import EmailMessage
 import subprocess
 import json
-import time
+import threading
 from utils import (
     is_valid_email, is_valid_time, get_client_info,
-    safe_fromisoformat, normalize_time_str, calculate_overtime,
-    sanitize_filename,
+    normalize_time_str, calculate_overtime,
+    sanitize_filename, normalize_sql,
+    split_timestamp, date_to_day, format_day, format_minute, weekday_of_day,
 )
 try:
-    from gevent.queue import Queue, Empty
+    import fcntl
+except ImportError:  # Windows ではロックファイルによるプロセス間の直列化を行わない
+    fcntl = None
+try:
+    import brotli
+except ImportError:  # brotli 未導入時は gzip のみ
+    brotli = None
+try:
+    from gevent import monkey as gevent_monkey
+    from gevent.threadpool import ThreadPool as GeventThreadPool
+    from gevent import get_hub
 except ImportError:  # gevent未使用環境向け
+    gevent_monkey = None
+if gevent_monkey is not None and gevent_monkey.is_module_patched('threading'):
+    from gevent.queue import Queue, Empty
+else:  # スレッドで動かす場合は標準のキューを使う
     from queue import Queue, Empty
 
 import logging
@@ -53,79 +95,375 @@ from logging.handlers import RotatingFileHandler
 
 load_dotenv()
 
-app = Flask(__name__)
 
-# ロギング設定
-log_dir = os.path.join(os.path.dirname(__file__), 'logs')
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, 'app.log')
+class RouteRegistry:
+    """モジュール内のルートやフックを記録し、create_app() で Flask アプリに登録する
 
-# ログフォーマット
-formatter = logging.Formatter(
-    '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
-)
+    Blueprint と違いエンドポイント名に接頭辞が付かないため、url_for('index') などはそのまま使える。
+    """
 
-# ハンドラ設定 (5MBでローテーション、バックアップ3世代)
-handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3, encoding='utf-8')
-handler.setFormatter(formatter)
+    def __init__(self):
+        self._deferred = []
 
-# ロガー設定
+    def _defer(self, method, *args, **kwargs):
+        def decorator(f):
+            self._deferred.append((method, args, kwargs, f))
+            return f
+        return decorator
+
+    def route(self, rule, **options):
+        return self._defer('route', rule, **options)
+
+    def errorhandler(self, code_or_exception):
+        return self._defer('errorhandler', code_or_exception)
+
+    def before_request(self, f):
+        return self._defer('before_request')(f)
+
+    def after_request(self, f):
+        return self._defer('after_request')(f)
+
+    def teardown_appcontext(self, f):
+        return self._defer('teardown_appcontext')(f)
+
+    def context_processor(self, f):
+        return self._defer('context_processor')(f)
+
+    def register(self, app):
+        # 登録順を保つ (after_request は登録と逆順に実行される)
+        for method, args, kwargs, f in self._deferred:
+            if method == 'route':
+                app.add_url_rule(args[0], view_func=f, **kwargs)
+            elif args:
+                getattr(app, method)(*args)(f)
+            else:
+                getattr(app, method)(f)
+
+
+routes = RouteRegistry()
+
+# ロギング設定 (ファイルハンドラは create_app() で初めて作る)
+LOG_DIR = os.path.join(os.path.dirname(__file__), 'logs')
+LOG_FORMATTER = logging.Formatter(
+    '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
+)
 logger = logging.getLogger(__name__)
-logger.addHandler(handler)
 logger.setLevel(logging.INFO)
+_log_handlers = {}
+
 
-@app.before_request
+def configure_logging(log_dir=None):
+    """app.log と slow_query.log のハンドラを一度だけ設定する (5MBでローテーション、バックアップ3世代)"""
+    log_dir = log_dir or LOG_DIR
+    if log_dir in _log_handlers:
+        return
+    os.makedirs(log_dir, exist_ok=True)
+    handlers = []
+    for target, filename in ((logger, 'app.log'), (slow_query_logger, 'slow_query.log')):
+        handler = RotatingFileHandler(
+            os.path.join(log_dir, filename), maxBytes=5*1024*1024, backupCount=3, encoding='utf-8'
+        )
+        handler.setFormatter(LOG_FORMATTER)
+        target.addHandler(handler)
+        handlers.append(handler)
+    _log_handlers[log_dir] = handlers
+
+# Server-Timing ヘッダ出力 (SERVER_TIMING=1 で有効)
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0').lower() in ('1', 'true', 'yes')
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+@routes.before_request
 def log_request_start():
-    g.start_time = time.time()
-    logger.info(f"Request start: {request.method} {request.path} from {request.remote_addr}")
+    g.start_time = time.perf_counter()
+    incoming_id = request.headers.get('X-Request-ID', '')
+    g.request_id = incoming_id if REQUEST_ID_PATTERN.match(incoming_id) else secrets.token_hex(8)
+    g.timings = defaultdict(float)
+    logger.info(f"Request start: {request.method} {request.path} from {request.remote_addr} [{g.request_id}]")
 
-@app.after_request
+@routes.after_request
 def log_request_end(response):
+    streamed = g.get('_streamed_page', False)
+    if hasattr(g, 'start_time'):
+        duration = time.perf_counter() - g.start_time
+        if not streamed:
+            logger.info(
+                f"Request end: {request.method} {request.path} - Status: {response.status_code} - Duration: {duration:.4f}s [{g.request_id}]"
+            )
+        if SERVER_TIMING:
+            # 逐次送信のページではヘッダ送信までの分だけ。描画と行の読み出しは送信完了時にログへ出す
+            response.headers['Server-Timing'] = build_server_timing(duration)
+            response.headers['X-Request-ID'] = g.request_id
+    if SQL_PROFILE and not streamed:
+        report_sql_profile(g.get('_sql_queries'))
+    return response
+
+
+def log_streamed_request_end():
+    """逐次送信のページを送り終えた (または切断された) ときに全体の所要時間を記録する"""
     if hasattr(g, 'start_time'):
-        duration = time.time() - g.start_time
+        duration = time.perf_counter() - g.start_time
+        timing = f" - Server-Timing: {build_server_timing(duration)}" if SERVER_TIMING else ''
         logger.info(
-            f"Request end: {request.method} {request.path} - Status: {response.status_code} - Duration: {duration:.4f}s"
+            f"Request end: {request.method} {request.path} - Status: 200 (streamed) - Duration: {duration:.4f}s{timing} [{g.request_id}]"
         )
-    return response
+    if SQL_PROFILE:
+        report_sql_profile(g.get('_sql_queries'))
+
+
+def db_time():
+    """現在のリクエストでSQLiteに費やした秒数"""
+    return sum(q['duration'] for q in g.get('_sql_queries', ()))
+
+
+@contextmanager
+def timed(name):
+    """ブロックの所要時間を g.timings[name] に加算する (SQLite の時間は除く)"""
+    start, db_start = time.perf_counter(), db_time()
+    try:
+        yield
+    finally:
+        if 'timings' in g:
+            g.timings[name] += (time.perf_counter() - start) - (db_time() - db_start)
+
+
+def _template_render_started(sender, template, context, **extra):
+    g._template_start = (time.perf_counter(), db_time())
+
+
+def _template_render_finished(sender, template, context, **extra):
+    started = g.pop('_template_start', None)
+    if started and 'timings' in g:
+        g.timings['tpl'] += (time.perf_counter() - started[0]) - (db_time() - started[1])
 
-app.secret_key = os.environ.get('SECRET_KEY', 'your_secret_key_here')  # 本番は環境変数
-app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 10 * 1024 * 1024))
-app.permanent_session_lifetime = timedelta(
-    days=int(os.environ.get('SESSION_LIFETIME_DAYS', 7))
-)
 
-if not app.secret_key or app.secret_key == 'your_secret_key_here':
-    raise RuntimeError("SECRET_KEYを環境変数で必ず設定してください")
+
+
+def build_server_timing(total):
+    """Server-Timing ヘッダ値を組み立てる"""
+    db = db_time()
+    tpl = g.timings.get('tpl', 0.0)
+    ctx = g.timings.get('ctx', 0.0)
+    handler = max(total - db - tpl - ctx, 0.0)
+    parts = [
+        ('db', db, 'SQLite'),
+        ('tpl', tpl, 'Template'),
+        ('ctx', ctx, 'Context processors'),
+        ('app', handler, 'Handler'),
+        ('total', total, 'Total'),
+    ]
+    header = ', '.join(f'{name};dur={value * 1000:.2f};desc="{desc}"' for name, value, desc in parts)
+    return f'{header}, reqid;desc="{g.request_id}"'
 
 DB_PATH = os.path.join(os.path.dirname(__file__), 'database', 'kintai.db')
 EXPORT_DIR = os.path.join(os.path.dirname(__file__), 'exports')
-os.makedirs(EXPORT_DIR, exist_ok=True)
+# コンパイル済みテンプレートの保存先。同じマシンのワーカー間で共有される (空で無効)
+# 共有の一時ディレクトリは他のユーザーに先回りで作られうるので、既定はアプリ配下に置く
+JINJA_CACHE_DIR = os.environ.get(
+    'JINJA_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'cache', 'jinja')
+)
 
 # 監査ログ設定
 AUDIT_LOG_PATH = os.environ.get(
     'AUDIT_LOG_PATH',
     os.path.join(os.path.dirname(__file__), 'logs', 'audit.log')
 )
-os.makedirs(os.path.dirname(AUDIT_LOG_PATH), exist_ok=True)
 
 def clear_audit_log():
     """監査ログを空にするユーティリティ"""
+    os.makedirs(os.path.dirname(AUDIT_LOG_PATH), exist_ok=True)
     with open(AUDIT_LOG_PATH, 'w', encoding='utf-8'):
         pass
 
 # サービス起動時の自動クリアは廃止
 
+# SQL プロファイラ設定 (SQL_PROFILE=1 で有効)
+SQL_PROFILE = os.environ.get('SQL_PROFILE', '0').lower() in ('1', 'true', 'yes')
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+
+slow_query_logger = logging.getLogger(__name__ + '.slow_query')
+slow_query_logger.setLevel(logging.INFO)
+slow_query_logger.propagate = False
+
+# record_queries() で登録された記録先と、正規化済みSQLごとの実行計画キャッシュ
+# (動的に組み立てる SQL で増え続けないよう、最近使った QUERY_PLAN_CACHE_SIZE 件だけ保持する)
+QUERY_PLAN_CACHE_SIZE = 256
+_query_recorders = []
+_query_plans = OrderedDict()
+
+
+def explain_query(conn, sql, parameters=()):
+    """EXPLAIN QUERY PLAN の結果とフルスキャン有無を返す (正規化SQL単位でキャッシュ)"""
+    key = normalize_sql(sql)
+    if key in _query_plans:
+        _query_plans.move_to_end(key)
+        return _query_plans[key]
+    try:
+        # ProfilingCursor を経由すると再帰するため素のカーソルを使う
+        cur = sqlite3.Cursor(conn)
+        plan = [row[3] for row in cur.execute('EXPLAIN QUERY PLAN ' + sql, parameters)]
+    except sqlite3.Error:
+        plan = []
+    result = _query_plans[key] = (plan, any(d.startswith('SCAN ') for d in plan))
+    if len(_query_plans) > QUERY_PLAN_CACHE_SIZE:
+        _query_plans.popitem(last=False)
+    return result
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """実行時間と行数を記録するカーソル"""
+
+    _entry = None
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._entry = _record_query(self, sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._entry = _record_query(self, sql, (), time.perf_counter() - start)
+
+    def _track_fetch(self, start, rows):
+        if self._entry is not None:
+            self._entry['duration'] += time.perf_counter() - start
+            self._entry['rows'] += rows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._track_fetch(start, 1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._track_fetch(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._track_fetch(start, len(rows))
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        row = super().__next__()
+        self._track_fetch(start, 1)
+        return row
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """ProfilingCursor を返すコネクション (conn.execute も対象になる)"""
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _record_query(cursor, sql, parameters, duration):
+    entry = {
+        'sql': normalize_sql(sql),
+        'duration': duration,
+        'rows': max(cursor.rowcount, 0),
+        'plan': [],
+        'full_scan': False,
+    }
+    # 実行計画は SQL プロファイル (またはテストの記録) のときだけ調べ、Server-Timing だけなら時間のみ測る
+    if (SQL_PROFILE or _query_recorders) and entry['sql'].upper().startswith(('SELECT', 'WITH')):
+        entry['plan'], entry['full_scan'] = explain_query(cursor.connection, sql, parameters)
+    if has_app_context():
+        g.setdefault('_sql_queries', []).append(entry)
+    for recorder in _query_recorders:
+        recorder.append(entry)
+    return entry
+
+
+@contextmanager
+def record_queries():
+    """ブロック内で実行されたSQLを記録するリストを返す (テスト用)"""
+    queries = []
+    _query_recorders.append(queries)
+    try:
+        yield queries
+    finally:
+        _query_recorders.remove(queries)
+
+
+def report_sql_profile(queries):
+    """リクエスト内のSQL集計をログに出し、閾値超えをスロークエリログに書く"""
+    if not queries:
+        return
+    total = sum(q['duration'] for q in queries)
+    logger.info(f"SQL profile: {request.method} {request.path} - {len(queries)} queries - {total * 1000:.1f}ms")
+    for q in queries:
+        duration_ms = q['duration'] * 1000
+        if duration_ms >= SLOW_QUERY_MS or q['full_scan']:
+            slow_query_logger.warning(
+                f"{request.method} {request.path}\t{duration_ms:.1f}ms\trows={q['rows']}\t"
+                f"{'FULL SCAN' if q['full_scan'] else '-'}\t{q['sql']}\tplan={' | '.join(q['plan'])}"
+            )
+
+
 # データベース接続ユーティリティ
 def get_db():
     """リクエスト内で単一のDBコネクションを管理・提供する"""
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DB_PATH, timeout=10)  # 10秒でタイムアウト
+        ensure_database()
+        profiling = SQL_PROFILE or SERVER_TIMING or _query_recorders
+        factory = ProfilingConnection if profiling else sqlite3.Connection
+        db = g._database = sqlite3.connect(DB_PATH, timeout=10, factory=factory)  # 10秒でタイムアウト
         db.row_factory = sqlite3.Row
     return db
 
 
-@app.teardown_appcontext
+@contextmanager
+def read_snapshot(attendance_years=()):
+    """1つの読み取りトランザクションに固定した読み取り専用コネクションを返す
+
+    WAL モードでは開始時点のスナップショットを読み続けるため、長いエクスポート中も
+    打刻の書き込みを待たせず、出力内容は開始時点で一貫する。
+    トランザクション中は ATTACH できないため、attendance_years のうちアーカイブ済みの年は
+    開始前に ATTACH しておく。
+    """
+    ensure_database()
+    # パスに ? や # や % が含まれても壊れないよう、URI はエスケープして組み立てる
+    conn = sqlite3.connect(Path(DB_PATH).resolve().as_uri() + '?mode=ro', uri=True, timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        while True:
+            for year in attendance_years:
+                if is_archived(conn, 'attendance', year):
+                    attach_archive(conn, year)
+            conn.execute("BEGIN")
+            # 最初の読み取りでスナップショットが確定する
+            conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            attached = {row[1] for row in conn.execute("PRAGMA database_list").fetchall()}
+            if all(f'arc_{year}' in attached or not is_archived(conn, 'attendance', year)
+                   for year in attendance_years):
+                break
+            # ATTACH の確認後にアーカイブされた。スナップショットを取り直す
+            conn.execute("COMMIT")
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.execute("COMMIT")
+        conn.close()
+
+
+@routes.teardown_appcontext
 def close_connection(exception):
     """リクエスト終了時にDBコネクションを閉じる"""
     db = getattr(g, '_database', None)
@@ -143,6 +481,7 @@ def log_audit_event(action, user_id=None, user_name=None):
         f"{ts}\t{action}\t{user_id if user_id else '-'}\t"
         f"{user_name if user_name else '-'}\t{ip}\t{device}\t{os_name}\n"
     )
+    os.makedirs(os.path.dirname(AUDIT_LOG_PATH), exist_ok=True)
     with open(AUDIT_LOG_PATH, 'a', encoding='utf-8') as f:
         f.write(line)
 
@@ -151,11 +490,11 @@ def generate_csrf_token():
     if '_csrf_token' not in session:
         session['_csrf_token'] = secrets.token_hex(16)
     return session['_csrf_token']
-app.jinja_env.globals['csrf_token'] = generate_csrf_token
 
 def check_csrf():
     if request.method == 'POST':
-        token = request.form.get('_csrf_token')
+        # fetch/Service Worker からの JSON リクエストはヘッダでトークンを送る
+        token = request.form.get('_csrf_token') or request.headers.get('X-CSRF-Token')
         session_token = session.get('_csrf_token')
         if not token or not session_token or not secrets.compare_digest(session_token, token):
             flash("セッションエラーが発生しました。やり直してください。", "danger")
@@ -163,31 +502,29 @@ def check_csrf():
     return True
 
 
-@app.context_processor
+@routes.context_processor
 def inject_unread_count():
     if 'user_id' not in session:
         return {'unread_count': 0}
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT COUNT(*) FROM messages WHERE recipient_id = ? AND is_read = 0",
-        (session['user_id'],),
-    )
-    count = c.fetchone()[0]
+    with timed('ctx'):
+        count = fetch_user_versions(session['user_id'])['unread']
     return {'unread_count': count}
 
 # SSE 管理
 user_streams = defaultdict(WeakSet)
 
+def fetch_unread_total(conn, user_id):
+    """ユーザー宛ての未読件数の合計 (会話ごとの要約 conversations から足し合わせる)"""
+    return conn.execute("""
+        SELECT coalesce(sum(CASE WHEN user_low = ? THEN unread_low ELSE unread_high END), 0)
+        FROM conversations WHERE user_low = ? OR user_high = ?
+        """,
+        (user_id, user_id, user_id),
+    ).fetchone()[0]
+
+
 def get_unread_count(user_id):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT COUNT(*) FROM messages WHERE recipient_id = ? AND is_read = 0",
-        (user_id,),
-    )
-    count = c.fetchone()[0]
-    return count
+    return fetch_unread_total(get_db(), user_id)
 
 def push_event(user_id, data):
     for q in list(user_streams[user_id]):
@@ -221,6 +558,16 @@ def superadmin_required(f):
         return f(*args, **kwargs)
     return decorated
 
+# 共用端末 (キオスク) は X-Kiosk-Key ヘッダの API キーで認証する
+def kiosk_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        key = request.headers.get('X-Kiosk-Key', '')
+        if not KIOSK_API_KEY or not secrets.compare_digest(key, KIOSK_API_KEY):
+            return {'error': 'unauthorized'}, 401
+        return f(*args, **kwargs)
+    return decorated
+
 # embedded=1 を維持したままリダイレクトするユーティリティ
 def redirect_embedded(endpoint, **values):
     embedded = request.args.get('embedded') or request.form.get('embedded')
@@ -228,41 +575,645 @@ def redirect_embedded(endpoint, **values):
         values['embedded'] = embedded
     return redirect(url_for(endpoint, **values))
 
+# 条件付きレスポンス (ETag)
+def not_modified_response(*parts):
+    """データバージョンから弱い ETag を作り、If-None-Match と一致すれば 304 を返す
+
+    一致しない場合は None を返し、ETag は after_request でレスポンスに付与される。
+    """
+    etag = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:20]
+    g._etag = etag
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304)
+    return None
+
+
+@routes.after_request
+def apply_etag(response):
+    etag = g.pop('_etag', None)
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+def fetch_user_versions(user_id):
+    """勤怠・受信箱のバージョンと未読件数を1回のクエリで読む
+
+    ETag の計算とナビの未読数で同じ値を使うので、リクエスト内では最後に読んだ
+    ユーザーの分を g に保持して使い回す。
+    """
+    cached = g.get('_user_versions')
+    if cached and cached[0] == user_id:
+        return cached[1]
+    row = get_db().execute("""
+        SELECT (SELECT version FROM attendance_versions WHERE user_id = ?),
+               (SELECT version FROM inbox_versions WHERE user_id = ?),
+               (SELECT coalesce(sum(CASE WHEN user_low = ? THEN unread_low ELSE unread_high END), 0)
+                FROM conversations WHERE user_low = ? OR user_high = ?)
+        """,
+        (user_id, user_id, user_id, user_id, user_id),
+    ).fetchone()
+    versions = {'attendance': row[0] or 0, 'inbox': row[1] or 0, 'unread': row[2]}
+    g._user_versions = (user_id, versions)
+    return versions
+
+
+def fetch_attendance_version(user_id):
+    return fetch_user_versions(user_id)['attendance']
+
+
+def fetch_inbox_version(user_id):
+    return fetch_user_versions(user_id)['inbox']
+
+
+def fetch_conversation_version(user_a, user_b):
+    """会話の最終メッセージIDと既読更新回数を返す"""
+    c = get_db().cursor()
+    c.execute(
+        "SELECT last_message_id, read_version FROM conversations WHERE user_low = ? AND user_high = ?",
+        (min(user_a, user_b), max(user_a, user_b)),
+    )
+    row = c.fetchone()
+    return tuple(row) if row else (0, 0)
+
+
+def page_etag_parts():
+    """HTMLページ共通の可変要素 (ナビの未読数・ログイン名・CSRFトークン)"""
+    return (session.get('user_name'), generate_csrf_token(), fetch_inbox_version(session['user_id']))
+
+
+# レスポンス圧縮
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+# send_file のレスポンスは静的ファイルだけを、この大きさまで読み込んで圧縮する
+# (エクスポートの CSV/ZIP はリクエスト内で読み込まず、そのまま送る)
+COMPRESS_MAX_FILE_SIZE = 256 * 1024
+COMPRESS_FILE_ENDPOINTS = {'static', 'service_worker'}
+# 動的なレスポンスは毎回圧縮するので、イベントループを長く止めない品質にする。
+# ハッシュ付きの静的ファイルは最高品質で一度だけ圧縮してワーカー内に保持する
+BROTLI_DYNAMIC_QUALITY = 5
+COMPRESS_STREAM_FLUSH_SIZE = 8 * 1024
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+    'application/javascript', 'application/json', 'application/manifest+json',
+}
+
+
+def negotiate_encoding(accept):
+    """Accept-Encoding から使う符号化 ('br'/'gzip') を選ぶ。どちらも不可なら None"""
+    if brotli is not None and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_bytes(data, encoding, brotli_quality):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, 6 if brotli_quality < 11 else 9)
+
+
+def _gzip_stream(chunks):
+    """逐次送信のレスポンスを gzip 圧縮する。一定量ごとに flush して描画を遅らせない"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    pending = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= COMPRESS_STREAM_FLUSH_SIZE:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@routes.after_request
+def compress_response(response):
+    if (
+        response.status_code != 200
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+        or 'Content-Encoding' in response.headers
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    accept = request.accept_encodings
+    if response.direct_passthrough:
+        # send_file のファイルは小さな静的ファイルのときだけ読み込んで圧縮する
+        if (
+            request.endpoint not in COMPRESS_FILE_ENDPOINTS
+            or not response.content_length
+            or response.content_length > COMPRESS_MAX_FILE_SIZE
+        ):
+            return response
+        response.direct_passthrough = False
+    if response.is_streamed:
+        if not accept['gzip']:
+            return response
+        response.response = _gzip_stream(response.response)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers.pop('Content-Length', None)
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = negotiate_encoding(accept)
+    if encoding is None:
+        return response
+    data = compress_bytes(data, encoding, BROTLI_DYNAMIC_QUALITY)
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # 強い ETag は符号化ごとに別の値にする
+        response.set_etag(f'{etag}-{encoding}')
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# 静的ファイルのハッシュ付きURL
+# 内容のハッシュを URL に含めることで、長期・不変キャッシュを安全に使えるようにする
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+UNCACHED_ASSETS = {'sw.js'}
+_asset_manifest = None
+
+
+def get_asset_manifest():
+    """static 配下のファイル名と内容ハッシュの対応表 (プロセス内で1度だけ計算)"""
+    global _asset_manifest
+    if _asset_manifest is None:
+        manifest = {}
+        for root, dirs, files in os.walk(STATIC_DIR):
+            for file in files:
+                path = os.path.join(root, file)
+                rel = os.path.relpath(path, STATIC_DIR).replace(os.sep, '/')
+                if rel in UNCACHED_ASSETS:
+                    continue
+                with open(path, 'rb') as f:
+                    manifest[rel] = hashlib.sha256(f.read()).hexdigest()[:12]
+        _asset_manifest = manifest
+    return _asset_manifest
+
+
+def asset_url(filename):
+    digest = get_asset_manifest().get(filename)
+    if digest is None:
+        return url_for('static', filename=filename)
+    return url_for('hashed_asset', digest=digest, filename=filename)
+
+
+_compressed_assets = {}
+
+
+def compressed_asset(filename, digest, encoding):
+    """ハッシュ付き静的ファイルの圧縮済みバイト列 (ダイジェストごとに一度だけ最高品質で圧縮する)"""
+    key = (filename, digest, encoding)
+    data = _compressed_assets.get(key)
+    if data is None:
+        with open(os.path.join(STATIC_DIR, filename), 'rb') as f:
+            data = compress_bytes(f.read(), encoding, 11)
+        _compressed_assets[key] = data
+    return data
+
+
+@routes.route('/assets/<digest>/<path:filename>')
+def hashed_asset(digest, filename):
+    if get_asset_manifest().get(filename) != digest:
+        return 'ファイルが存在しません', 404
+    response = send_from_directory(STATIC_DIR, filename, max_age=ASSET_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    encoding = negotiate_encoding(request.accept_encodings)
+    if (
+        encoding is None
+        or response.status_code != 200
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+        or (response.content_length or 0) < COMPRESS_MIN_SIZE
+    ):
+        return response
+    response.close()
+    response.direct_passthrough = False
+    response.set_data(compressed_asset(filename, digest, encoding))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}')
+    return response.make_conditional(request)
+
+
+@routes.route('/asset-manifest.json')
+def asset_manifest():
+    manifest = get_asset_manifest()
+    version = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    response = current_app.response_class(
+        json.dumps({'version': version, 'assets': [asset_url(name) for name in sorted(manifest)]}),
+        mimetype='application/json',
+    )
+    response.cache_control.no_cache = True
+    return response
+
+
+@routes.route('/sw.js')
+def service_worker():
+    # ルートスコープで登録し、更新を即座に反映させるため毎回検証させる
+    response = send_from_directory(STATIC_DIR, 'sw.js', mimetype='application/javascript', max_age=0)
+    response.cache_control.no_cache = True
+    return response
+
+
 # ファイル検証
 ALLOWED_EXTENSIONS = {'csv'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 # エラーハンドリング
-@app.errorhandler(RequestEntityTooLarge)
+@routes.errorhandler(RequestEntityTooLarge)
 def handle_file_too_large(e):
     flash("アップロードできるファイルサイズを超えています。", "danger")
     return redirect(url_for('view_my_logs')), 413
 
 # データベース初期化
+# スキーマのマイグレーション
+# PRAGMA user_version に適用済みの番号を保存する。1 は database/schema.sql (初期スキーマ)、
+# 以降は database/migrations/NNNN_*.sql と @python_migration(N) で登録した関数を番号順に適用する。
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), 'database', 'schema.sql')
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'database', 'migrations')
+MIGRATION_FILE_PATTERN = re.compile(r'^(\d{4})_[\w-]+\.sql$')
+MIGRATION_CHUNK_SIZE = 1000
+python_migrations = {}
+
+
+def python_migration(version):
+    """SQLでは書けない移行処理 (データの埋め戻しなど) を番号付きで登録する"""
+    def register(func):
+        python_migrations[version] = func
+        return func
+    return register
+
+
+def load_migrations():
+    """(番号, 名前, SQL文字列または関数) を番号順に返す"""
+    steps = {1: ('schema.sql', SCHEMA_PATH)}
+    if os.path.isdir(MIGRATIONS_DIR):
+        for filename in os.listdir(MIGRATIONS_DIR):
+            match = MIGRATION_FILE_PATTERN.match(filename)
+            if match:
+                version = int(match.group(1))
+                if version in steps:
+                    raise RuntimeError(f"マイグレーション番号 {version:04d} が重複しています")
+                steps[version] = (filename, os.path.join(MIGRATIONS_DIR, filename))
+    for version, func in python_migrations.items():
+        if version in steps:
+            raise RuntimeError(f"マイグレーション番号 {version:04d} が重複しています")
+        steps[version] = (func.__name__, func)
+    return [(version, *steps[version]) for version in sorted(steps)]
+
+
+def backfill_in_chunks(conn, select_sql, apply, chunk_size=None, keyset=False):
+    """未処理の行を chunk_size 件ずつ apply(conn, rows) で処理し、チャンクごとにコミットする
+
+    select_sql は LIMIT ? を持ち、処理済みの行を返さないこと。途中で止まっても
+    次回の起動で残りの行から再開できる。処理した行数を返す。
+    処理しても条件から外れない行がある場合は keyset=True とし、select_sql を
+    「id > ? ORDER BY id LIMIT ?」の形 (先頭列が id) にする。
+    """
+    chunk_size = chunk_size or MIGRATION_CHUNK_SIZE
+    total = 0
+    last_id = 0
+    while True:
+        params = (last_id, chunk_size) if keyset else (chunk_size,)
+        rows = conn.execute(select_sql, params).fetchall()
+        if not rows:
+            return total
+        apply(conn, rows)
+        conn.commit()
+        total += len(rows)
+        last_id = rows[-1][0]
+
+
+@contextmanager
+def migration_lock():
+    """複数ワーカーが同時に起動してもマイグレーションが1つずつ実行されるようにする"""
+    if fcntl is None:
+        yield
+        return
+    with open(DB_PATH + '.migrate.lock', 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def apply_migration(conn, version, target):
+    if callable(target):
+        target(conn)
+        conn.commit()
+        conn.execute(f"PRAGMA user_version = {version}")
+        return
+    with open(target, encoding='utf-8') as f:
+        script = f.read()
+    # 番号の更新まで1トランザクションで行い、途中で失敗しても中途半端に残さない
+    conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {version};\nCOMMIT;")
+
+
 def initialize_database():
-    """テーブルとインデックスを確実に作成する"""
+    """未適用のマイグレーションを適用し、適用した番号の一覧を返す
+
+    適用済みのDBでは PRAGMA user_version を1回読むだけで終わる。
+    """
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    with open(os.path.join(os.path.dirname(__file__), 'database', 'schema.sql'), encoding='utf-8') as f:
-        conn.executescript(f.read())
-    conn.commit()
-    conn.close()
-initialize_database()
+    migrations = load_migrations()
+    latest = migrations[-1][0]
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= latest:
+            return []
+        applied = []
+        with migration_lock():
+            # ロック待ちの間に他のワーカーが適用済みかもしれないので読み直す
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            if current < latest:
+                # WAL モードでは読み取り中も書き込みが待たされない (設定はDBファイルに保存される)
+                conn.execute("PRAGMA journal_mode=WAL")
+            for version, name, target in migrations:
+                if version <= current:
+                    continue
+                started = time.perf_counter()
+                try:
+                    apply_migration(conn, version, target)
+                except Exception:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    logger.error(f"マイグレーション {version:04d} ({name}) に失敗しました")
+                    raise
+                logger.info(f"マイグレーション {version:04d} ({name}) を適用しました: {time.perf_counter() - started:.2f}s")
+                applied.append(version)
+        return applied
+    finally:
+        conn.close()
+
+
+@python_migration(3)
+def backfill_attendance_day_minute(conn):
+    """0002 で追加した day/minute を既存の勤怠行に埋める"""
+    def fill(conn, rows):
+        values = []
+        for row_id, ts in rows:
+            try:
+                day, minute = split_timestamp(ts)
+            except ValueError:
+                continue  # 解釈できない行は NULL のまま残す (一覧では記録された文字列で表示する)
+            values.append((day, minute, row_id))
+        conn.executemany("UPDATE attendance SET day = ?, minute = ? WHERE id = ?", values)
+
+    backfill_in_chunks(
+        conn, "SELECT id, timestamp FROM attendance WHERE day IS NULL AND id > ? ORDER BY id LIMIT ?", fill,
+        keyset=True,
+    )
+
+
+# チャット本文の全文検索索引 (trigram なので日本語も分かち書きなしで 3 文字以上の部分一致ができる)
+# 本文は messages に持ち、索引だけを外部コンテンツ表として保持する
+MESSAGES_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    message, content='messages', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert AFTER INSERT ON messages
+BEGIN
+    INSERT INTO messages_fts (rowid, message) VALUES (NEW.id, NEW.message);
+END;
+
+-- アーカイブへ移したメッセージも索引から外れる
+CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete AFTER DELETE ON messages
+BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update AFTER UPDATE OF message ON messages
+BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+    INSERT INTO messages_fts (rowid, message) VALUES (NEW.id, NEW.message);
+END;
+"""
+# trigram トークナイザは SQLite 3.34 以降
+FTS_TRIGRAM_MIN_SQLITE = (3, 34, 0)
+
+
+@python_migration(6)
+def create_messages_fts(conn):
+    """メッセージの全文検索索引を作り、既存の行を取り込む
+
+    trigram を使えない SQLite では索引を作らず、チャット検索は LIKE で会話内を探す。
+    当初は 0006_messages_fts.sql として出荷したもので、作るオブジェクトは同じ (migrations/README.md 参照)。
+    """
+    if sqlite3.sqlite_version_info < FTS_TRIGRAM_MIN_SQLITE:
+        logger.warning(f"SQLite {sqlite3.sqlite_version} は FTS5 trigram に未対応のため、チャット検索は索引なしで動きます")
+        return
+    try:
+        conn.executescript(
+            f"BEGIN;\n{MESSAGES_FTS_SCHEMA}\nINSERT INTO messages_fts (messages_fts) VALUES ('rebuild');\nCOMMIT;"
+        )
+    except sqlite3.OperationalError as e:
+        if conn.in_transaction:
+            conn.rollback()
+        logger.warning(f"全文検索索引を作れないため、チャット検索は索引なしで動きます: {e}")
+
+
+_migrated_paths = set()
+
+
+def ensure_database():
+    """DB_PATH のマイグレーションをワーカー内で一度だけ確認する"""
+    if DB_PATH not in _migrated_paths:
+        initialize_database()
+        _migrated_paths.add(DB_PATH)
 
 # ユーティリティ
 
-def fetch_overtime_threshold(user_id, default='18:00'):
+# パスワードハッシュ処理
+# PBKDF2/scrypt はCPUを占有するため、OSスレッドのプールで実行してイベントループを止めない
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', '')
+PASSWORD_HASH_SLOW_QUEUE_SEC = 0.5
+password_hash_stats = {
+    'calls': 0, 'queued': 0, 'max_queued': 0,
+    'queue_time': 0.0, 'max_queue_time': 0.0, 'run_time': 0.0,
+}
+_password_hash_pool = None
+_password_hash_prefix = None
+
+
+def _get_password_hash_pool():
+    global _password_hash_pool
+    if _password_hash_pool is None:
+        if gevent_monkey is not None and gevent_monkey.is_module_patched('threading'):
+            _password_hash_pool = GeventThreadPool(PASSWORD_HASH_WORKERS)
+        else:
+            _password_hash_pool = ThreadPoolExecutor(
+                max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash'
+            )
+    return _password_hash_pool
+
+
+def submit_password_job(func, *args):
+    """ハッシュ処理をプールに投入し、結果を待つ関数を返す (待ち時間と処理時間を記録)"""
+    enqueued = time.perf_counter()
+    timing = {}
+
+    def job():
+        timing['start'] = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            timing['end'] = time.perf_counter()
+
+    stats = password_hash_stats
+    stats['queued'] += 1
+    stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+    pool = _get_password_hash_pool()
+    if isinstance(pool, ThreadPoolExecutor):
+        wait = pool.submit(job).result
+    else:
+        wait = pool.spawn(job).get
+
+    def result():
+        try:
+            return wait()
+        finally:
+            stats['queued'] -= 1
+            queue_time = timing['start'] - enqueued
+            stats['calls'] += 1
+            stats['queue_time'] += queue_time
+            stats['max_queue_time'] = max(stats['max_queue_time'], queue_time)
+            stats['run_time'] += timing['end'] - timing['start']
+            if queue_time > PASSWORD_HASH_SLOW_QUEUE_SEC:
+                logger.warning(f"Password hash queue wait {queue_time:.3f}s (queued={stats['queued']})")
+
+    return result
+
+
+def run_password_job(func, *args):
+    return submit_password_job(func, *args)()
+
+
+def _generate_password_hash(password):
+    if PASSWORD_HASH_METHOD:
+        return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+    return generate_password_hash(password)
+
+
+def hash_password(password):
+    return run_password_job(_generate_password_hash, password)
+
+
+def hash_passwords(passwords):
+    """複数のパスワードをプールで並行してハッシュ化する"""
+    waits = [submit_password_job(_generate_password_hash, p) for p in passwords]
+    return [wait() for wait in waits]
+
+
+def verify_password(password_hash, password):
+    return run_password_job(check_password_hash, password_hash, password)
+
+
+def update_password_hash(conn, user_id, password_hash):
+    conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+
+
+def password_needs_rehash(password_hash):
+    """設定されたハッシュ方式・コストと保存済みハッシュが異なるか"""
+    global _password_hash_prefix
+    if not PASSWORD_HASH_METHOD:
+        return False
+    if _password_hash_prefix is None:
+        # 'scrypt' などの省略形を既定パラメータ込みの表記にそろえる
+        _password_hash_prefix = hash_password('').split('$', 1)[0]
+    return password_hash.split('$', 1)[0] != _password_hash_prefix
+
+
+# ユーザー情報・管理関係のキャッシュ
+# 無効化はDBと同じ場所のスタンプファイルの更新時刻で他ワーカーへ伝播させる
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+_user_cache_state = {'db': None, 'stamp': None, 'profiles': {}, 'managed': {}}
+
+
+def _user_cache_stamp_path():
+    return DB_PATH + '.cache-version'
+
+
+def _user_cache_stamp():
+    try:
+        return os.stat(_user_cache_stamp_path()).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _user_cache():
+    """有効なキャッシュを返す。DB切替や他ワーカーでの無効化を検知したら空にする"""
+    if has_app_context() and g.get('_user_cache_checked'):
+        return _user_cache_state
+    stamp = _user_cache_stamp()
+    if _user_cache_state['db'] != DB_PATH or _user_cache_state['stamp'] != stamp:
+        _user_cache_state.update(db=DB_PATH, stamp=stamp, profiles={}, managed={})
+    if has_app_context():
+        g._user_cache_checked = True
+    return _user_cache_state
+
+
+def invalidate_user_cache():
+    """ユーザー・管理関係の変更後に呼び、全ワーカーのキャッシュを無効化する"""
+    path = _user_cache_stamp_path()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(secrets.token_hex(8))
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+    _user_cache_state.update(db=DB_PATH, stamp=_user_cache_stamp(), profiles={}, managed={})
+
+
+def get_user_profile(user_id):
+    """氏名と残業開始時刻を返す (存在しなければ None)"""
+    profiles = _user_cache()['profiles']
+    cached = profiles.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
     conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT overtime_threshold FROM users WHERE id = ?", (user_id,))
+    c.execute("SELECT name, overtime_threshold FROM users WHERE id = ?", (user_id,))
     row = c.fetchone()
-    return row['overtime_threshold'] if row and row['overtime_threshold'] else default
+    profile = dict(row) if row else None
+    profiles[user_id] = (time.monotonic() + USER_CACHE_TTL, profile)
+    return profile
 
-# メール設定管理
-def get_mail_settings():
+
+def get_managed_user_ids(admin_id):
+    """管理者が管理対象としているユーザーIDの集合を返す"""
+    managed = _user_cache()['managed']
+    cached = managed.get(admin_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
     conn = get_db()
     c = conn.cursor()
+    c.execute("SELECT user_id FROM admin_managed_users WHERE admin_id = ?", (admin_id,))
+    ids = frozenset(row['user_id'] for row in c.fetchall())
+    managed[admin_id] = (time.monotonic() + USER_CACHE_TTL, ids)
+    return ids
+
+
+def fetch_overtime_threshold(user_id, default='18:00'):
+    profile = get_user_profile(user_id)
+    return profile['overtime_threshold'] if profile and profile['overtime_threshold'] else default
+
+# メール設定管理
+def get_mail_settings(conn=None):
+    conn = conn or get_db()
+    c = conn.cursor()
     c.execute(
         "SELECT server, port, username, password, use_tls, subject_template, body_template FROM mail_settings WHERE id = 1"
     )
@@ -271,9 +1222,7 @@ def get_mail_settings():
 
 
 def save_mail_settings(server, port, username, password, use_tls, subject_tmpl, body_tmpl):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
+    run_write(lambda conn: conn.execute(
         """
         INSERT INTO mail_settings (id, server, port, username, password, use_tls, subject_template, body_template)
         VALUES (1, ?, ?, ?, ?, ?, ?, ?)
@@ -287,59 +1236,888 @@ def save_mail_settings(server, port, username, password, use_tls, subject_tmpl,
             body_template=excluded.body_template
         """,
         (server, port, username, password, use_tls, subject_tmpl, body_tmpl),
-    )
-    conn.commit()
+    ))
+
 
+# メール送信キュー
+MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS', 5))
+MAIL_RETRY_BASE_SEC = int(os.environ.get('MAIL_RETRY_BASE_SEC', 60))
+MAIL_POLL_SEC = int(os.environ.get('MAIL_POLL_SEC', 30))
+MAIL_SMTP_TIMEOUT = 30
+MAIL_BATCH_SIZE = 100
+_mail_wakeup = threading.Event()
+_mail_worker = None
 
-def send_registration_email(to_email, name):
-    settings = get_mail_settings()
+
+def send_registration_email(to_email, name, conn=None):
+    """登録通知メールを送信キューに積む (コミットは呼び出し側で行う)"""
+    conn = conn or get_db()
+    settings = get_mail_settings(conn)
     if not settings:
-        return
+        return False
     subject = (settings.get("subject_template") or "").format(name=name, email=to_email)
     body = (settings.get("body_template") or "").format(name=name, email=to_email)
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = settings.get("username") or settings.get("server")
-    msg["To"] = to_email
-    msg.set_content(body)
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn.execute(
+        "INSERT INTO mail_outbox (to_email, subject, body, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+        (to_email, subject, body, now, now),
+    )
+    return True
+
+
+def notify_mail_worker():
+    """送信キューの処理を促す (ワーカーが未起動なら起動する)"""
+    ensure_mail_worker()
+    _mail_wakeup.set()
+
+
+def ensure_mail_worker():
+    global _mail_worker
+    if current_app.config.get('TESTING'):
+        return
+    if _mail_worker is None or not _mail_worker.is_alive():
+        _mail_worker = threading.Thread(target=_mail_worker_loop, name='mail-outbox', daemon=True)
+        _mail_worker.start()
+
+
+@routes.before_request
+def start_mail_worker():
+    # 再起動前に積まれた未送信メールも処理されるよう、最初のリクエストで起動する
+    ensure_mail_worker()
+
+
+def _mail_worker_loop():
+    while True:
+        try:
+            process_mail_outbox()
+        except Exception as e:
+            logger.error(f"メール送信キューの処理に失敗しました: {e}")
+        _mail_wakeup.wait(MAIL_POLL_SEC)
+        _mail_wakeup.clear()
+
+
+def _open_smtp(settings):
+    smtp = smtplib.SMTP(settings["server"], int(settings["port"]), timeout=MAIL_SMTP_TIMEOUT)
     try:
-        with smtplib.SMTP(settings["server"], int(settings["port"])) as smtp:
-            if settings.get("use_tls"):
-                smtp.starttls()
-            if settings.get("username"):
-                smtp.login(settings["username"], settings.get("password", ""))
-            smtp.send_message(msg)
-    except Exception as e:
-        app.logger.error(f"メール送信に失敗しました: {e}")
+        if settings.get("use_tls"):
+            smtp.starttls()
+        if settings.get("username"):
+            smtp.login(settings["username"], settings.get("password", ""))
+    except Exception:
+        smtp.close()
+        raise
+    return smtp
 
 
-# アップデート管理
+def _close_smtp(smtp):
+    try:
+        smtp.quit()
+    except Exception:
+        smtp.close()
 
-def get_git_commits():
-    """ローカルとリモートの最新コミットを取得する"""
+
+def process_mail_outbox(db_path=None):
+    """期限の来たメールを1つのSMTPセッションでまとめて送信し、送信件数を返す"""
+    if db_path is None:
+        ensure_database()
+    conn = sqlite3.connect(db_path or DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    smtp = None
+    sent = 0
     try:
-        local = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        settings = get_mail_settings(conn)
+        if not settings:
+            return 0
+        now = datetime.now()
+        now_str = now.strftime('%Y-%m-%d %H:%M:%S')
+        rows = conn.execute(
+            """
+            SELECT id, to_email, subject, body, status, attempts, next_attempt_at FROM mail_outbox
+            WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+            ORDER BY id LIMIT ?
+            """,
+            (now_str, MAIL_BATCH_SIZE),
+        ).fetchall()
+        for row in rows:
+            # 他ワーカーと重複送信しないよう、送信中として確保できた行だけを扱う
+            lease = (now + timedelta(seconds=MAIL_SMTP_TIMEOUT * 2)).strftime('%Y-%m-%d %H:%M:%S')
+            claimed = conn.execute(
+                "UPDATE mail_outbox SET status = 'sending', next_attempt_at = ?"
+                " WHERE id = ? AND status = ? AND next_attempt_at = ?",
+                (lease, row['id'], row['status'], row['next_attempt_at']),
+            ).rowcount
+            conn.commit()
+            if not claimed:
+                continue
+            msg = EmailMessage()
+            msg["Subject"] = row['subject'] or ''
+            msg["From"] = settings.get("username") or settings.get("server")
+            msg["To"] = row['to_email']
+            msg.set_content(row['body'] or '')
+            attempts = row['attempts'] + 1
+            try:
+                if smtp is None:
+                    smtp = _open_smtp(settings)
+                smtp.send_message(msg)
+            except (smtplib.SMTPException, OSError) as e:
+                if smtp is not None:
+                    _close_smtp(smtp)
+                    smtp = None
+                if attempts >= MAIL_MAX_ATTEMPTS:
+                    status, next_at = 'failed', now_str
+                else:
+                    delay = min(MAIL_RETRY_BASE_SEC * 2 ** (attempts - 1), 3600)
+                    status = 'pending'
+                    next_at = (datetime.now() + timedelta(seconds=delay)).strftime('%Y-%m-%d %H:%M:%S')
+                conn.execute(
+                    "UPDATE mail_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                    (status, attempts, next_at, str(e), row['id']),
+                )
+                conn.commit()
+                logger.error(f"メール送信に失敗しました: {e}")
+                continue
+            conn.execute(
+                "UPDATE mail_outbox SET status = 'sent', attempts = ?, sent_at = ?, last_error = NULL WHERE id = ?",
+                (attempts, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), row['id']),
+            )
+            conn.commit()
+            sent += 1
+    finally:
+        if smtp is not None:
+            _close_smtp(smtp)
+        conn.close()
+    return sent
+
+
+# 書き込みキュー / 打刻のグループコミット
+DB_WRITE_QUEUE = os.environ.get('DB_WRITE_QUEUE', '0').lower() in ('1', 'true', 'yes')
+DB_WRITE_WINDOW_MS = float(os.environ.get('DB_WRITE_WINDOW_MS', 0))
+DB_WRITE_BATCH_MAX = 100
+DB_WRITE_LOCK_POLL_SEC = 0.001
+KIOSK_API_KEY = os.environ.get('KIOSK_API_KEY', '')
+KIOSK_COMMIT_WINDOW_MS = float(os.environ.get('KIOSK_COMMIT_WINDOW_MS', 5))
+KIOSK_BATCH_MAX = 200
+
+
+class GroupCommitWriter:
+    """書き込みジョブを短い時間窓で集め、1トランザクションでまとめてコミットする
+
+    ジョブは func(conn, *args) の形で専用接続のセーブポイント内で実行される。
+    submit() はコミット完了まで待ってジョブの戻り値を返し、例外はそのまま送出する。
+    ワーカープロセス間ではロックファイル (DB_PATH + '.write.lock') で書き込みを直列化する。
+    """
+
+    def __init__(self, name, window_ms, max_batch):
+        self.name = name
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._conn = None
+        self._conn_path = None
+        self._lock_file = None
+        self._lock_path = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            'jobs': 0, 'batches': 0, 'max_batch': 0, 'errors': 0,
+            'commit_time': 0.0, 'latency': 0.0, 'max_latency': 0.0,
+            'lock_wait': 0.0, 'max_lock_wait': 0.0, 'max_queue_depth': 0,
+            'started_at': time.time(),
+        }
+
+    def submit(self, func, *args):
+        self._ensure_thread()
+        job = {'func': func, 'args': args, 'done': threading.Event(), 'queued_at': time.perf_counter()}
+        self._queue.put(job)
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self._queue.qsize())
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['result']
+
+    def snapshot(self):
+        """スループットの集計値を返す"""
+        stats = self.stats
+        jobs, batches = stats['jobs'], stats['batches']
+        return {
+            'jobs': jobs,
+            'batches': batches,
+            'errors': stats['errors'],
+            'max_batch': stats['max_batch'],
+            'avg_batch': round(jobs / batches, 2) if batches else 0,
+            'avg_commit_ms': round(stats['commit_time'] * 1000 / batches, 3) if batches else 0,
+            'avg_latency_ms': round(stats['latency'] * 1000 / jobs, 3) if jobs else 0,
+            'max_latency_ms': round(stats['max_latency'] * 1000, 3),
+            'avg_lock_wait_ms': round(stats['lock_wait'] * 1000 / batches, 3) if batches else 0,
+            'max_lock_wait_ms': round(stats['max_lock_wait'] * 1000, 3),
+            # 書き込みに費やした時間あたりの処理件数 (捌ける上限の目安)
+            'capacity_per_sec': round(jobs / stats['commit_time'], 1) if stats['commit_time'] else 0,
+            'rate_per_sec': round(jobs / max(time.time() - stats['started_at'], 1e-9), 3),
+            'queue_depth': self._queue.qsize(),
+            'max_queue_depth': stats['max_queue_depth'],
+        }
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                logger.error(f"{self.name}: 書き込みに失敗しました: {e}")
+                for job in batch:
+                    job.setdefault('error', e)
+            for job in batch:
+                job['done'].set()
+
+    def _connection(self):
+        if self._conn is None or self._conn_path != DB_PATH:
+            if self._conn is not None:
+                self._conn.close()
+            ensure_database()
+            self._conn = sqlite3.connect(DB_PATH, timeout=10, isolation_level=None, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn_path = DB_PATH
+        return self._conn
+
+    def _acquire_file_lock(self):
+        """ロックファイルを取得し、待った秒数を返す
+
+        gevent 環境でハブを止めないよう、ブロックせずに取得を繰り返す。
+        """
+        if fcntl is None:
+            return 0.0
+        path = DB_PATH + '.write.lock'
+        if self._lock_path != path:
+            if self._lock_file is not None:
+                self._lock_file.close()
+            self._lock_file = open(path, 'a')
+            self._lock_path = path
+        started = time.perf_counter()
+        delay = DB_WRITE_LOCK_POLL_SEC
+        while True:
+            try:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return time.perf_counter() - started
+            except BlockingIOError:
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+
+    def _release_file_lock(self):
+        if fcntl is not None and self._lock_file is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _run_batch(self, batch):
+        lock_wait = self._acquire_file_lock()
+        try:
+            self._run_locked_batch(batch, lock_wait)
+        finally:
+            self._release_file_lock()
+
+    def _run_locked_batch(self, batch, lock_wait):
+        started = time.perf_counter()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for job in batch:
+                # 1件の失敗でまとめた他のジョブを巻き込まないようセーブポイントで区切る
+                conn.execute('SAVEPOINT job')
+                try:
+                    job['result'] = job['func'](conn, *job['args'])
+                except Exception as e:
+                    conn.execute('ROLLBACK TO job')
+                    job['error'] = e
+                    self.stats['errors'] += 1
+                conn.execute('RELEASE job')
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for job in batch:
+                job.pop('result', None)
+            raise
+        finished = time.perf_counter()
+        stats = self.stats
+        stats['jobs'] += len(batch)
+        stats['batches'] += 1
+        stats['max_batch'] = max(stats['max_batch'], len(batch))
+        stats['commit_time'] += finished - started
+        stats['lock_wait'] += lock_wait
+        stats['max_lock_wait'] = max(stats['max_lock_wait'], lock_wait)
+        for job in batch:
+            latency = finished - job['queued_at']
+            stats['latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+
+
+db_writer = GroupCommitWriter('db-writer', DB_WRITE_WINDOW_MS, DB_WRITE_BATCH_MAX)
+# 書き込みキュー有効時はキオスクも同じ書き込みスレッドを使い、ワーカー内の書き手を1つにする
+kiosk_writer = db_writer if DB_WRITE_QUEUE else GroupCommitWriter(
+    'kiosk-writer', KIOSK_COMMIT_WINDOW_MS, KIOSK_BATCH_MAX
+)
+
+
+def run_write(func, *args):
+    """書き込み処理 func(conn, *args) を実行してコミットし、戻り値を返す
+
+    DB_WRITE_QUEUE 有効時はワーカー内の書き込みスレッドに渡して直列化し、
+    無効時はリクエストのコネクションでそのまま実行する。func 内でコミットしないこと。
+    """
+    if DB_WRITE_QUEUE:
+        return db_writer.submit(func, *args)
+    conn = get_db()
+    try:
+        result = func(conn, *args)
+        conn.commit()
     except Exception:
-        return None, None
+        conn.rollback()
+        raise
+    return result
+
+
+def insert_attendance(conn, user_id, timestamp, punch_type, description):
+    """打刻を1件追加する。日付・時刻の整数列は timestamp から求める (不正な値は ValueError)"""
+    day, minute = split_timestamp(timestamp)
+    conn.execute(
+        "INSERT INTO attendance (user_id, timestamp, type, description, day, minute) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, timestamp, punch_type, description, day, minute),
+    )
+
+
+def delete_attendance_day(conn, user_id, date, punch_type):
+    """指定日 (YYYY-MM-DD) の指定区分の打刻を削除する"""
+    conn.execute("DELETE FROM attendance WHERE user_id = ? AND day = ? AND type = ?",
+                 (user_id, date_to_day(date), punch_type))
+
+
+def replace_attendance(conn, user_id, entries):
+    """(日付, 区分, 時刻, 業務内容) ごとに同じ日・区分の打刻を置き換える"""
+    for day, typ, ts, desc in entries:
+        delete_attendance_day(conn, user_id, day, typ)
+        insert_attendance(conn, user_id, ts, typ, desc)
+
+
+def hash_badge(token):
+    """バッジ/PIN を照合用のハッシュにする (平文は保存しない)"""
+    secret_key = (current_app if has_app_context() else get_default_app()).secret_key
+    return hmac.new(secret_key.encode(), token.encode(), hashlib.sha256).hexdigest()
+
+
+# アーカイブ
+# 締めた年の勤怠と古い既読メッセージを年別のアーカイブ DB (archive/kintai_<年>.db) へ移し、
+# ホット DB を小さく保つ。読み出しは必要な年だけ ATTACH DATABASE で参照する
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', '')
+ARCHIVE_KEEP_YEARS = int(os.environ.get('ARCHIVE_KEEP_YEARS', 1))
+ARCHIVE_MESSAGE_DAYS = int(os.environ.get('ARCHIVE_MESSAGE_DAYS', 365))
+# 締めた年は読み取り専用になるので、定期実行は ARCHIVE_INTERVAL を設定したときだけ (既定は無効)
+ARCHIVE_INTERVAL = int(os.environ.get('ARCHIVE_INTERVAL', 0))
+ARCHIVE_COPY_ATTEMPTS = 3
+ARCHIVE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS {alias}.attendance (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        timestamp TEXT NOT NULL,
+        type TEXT NOT NULL,
+        description TEXT,
+        day INTEGER,
+        minute INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS {alias}.idx_attendance_user_day ON attendance(user_id, day, type)",
+    """CREATE TABLE IF NOT EXISTS {alias}.messages (
+        id INTEGER PRIMARY KEY,
+        sender_id INTEGER NOT NULL,
+        recipient_id INTEGER NOT NULL,
+        message TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        is_read INTEGER DEFAULT 0,
+        read_timestamp TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS {alias}.idx_messages_pair_id ON messages(sender_id, recipient_id, id)",
+)
+ATTENDANCE_COLUMNS = 'id, user_id, timestamp, type, description, day, minute'
+MESSAGE_COLUMNS = 'id, sender_id, recipient_id, message, timestamp, is_read, read_timestamp'
+_archiver = None
+# archive_years の内容はワーカー内にキャッシュし、アーカイブ処理がスタンプファイルを更新したら読み直す
+_archive_cache_state = {'db': None, 'stamp': None, 'years': None}
+
+
+def archive_dir():
+    return ARCHIVE_DIR or os.path.join(os.path.dirname(DB_PATH), 'archive')
+
+
+def archive_path(year):
+    return os.path.join(archive_dir(), f'kintai_{int(year)}.db')
+
+
+def attach_archive(conn, year, create=False):
+    """年別アーカイブ DB を arc_<年> として ATTACH し、スキーマ名を返す (ATTACH 済みならそのまま)
+
+    ATTACH はトランザクション中には行えないため、read_snapshot では開始前に済ませておく。
+    """
+    alias = f'arc_{int(year)}'
+    if any(row[1] == alias for row in conn.execute("PRAGMA database_list").fetchall()):
+        return alias
+    path = archive_path(year)
+    if create:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+    if create:
+        for statement in ARCHIVE_SCHEMA:
+            conn.execute(statement.format(alias=alias))
+    return alias
+
+
+def _archive_stamp_path():
+    return DB_PATH + '.archive-version'
+
+
+def _archive_stamp():
     try:
-        subprocess.run(['git', 'fetch'], capture_output=True, text=True, check=True)
-        remote = subprocess.run(['git', 'rev-parse', 'origin/main'], capture_output=True, text=True, check=True).stdout.strip()
+        return os.stat(_archive_stamp_path()).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def touch_archive_stamp():
+    path = _archive_stamp_path()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(secrets.token_hex(8))
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+def archive_index():
+    """アーカイブ済みの (種類, 年, 最小ID, 最大ID) の一覧を返す (年の昇順)"""
+    state = _archive_cache_state
+    if has_app_context() and g.get('_archive_cache_checked'):
+        return state['years']
+    stamp = _archive_stamp()
+    if not os.path.isdir(archive_dir()):
+        # アーカイブ DB が1つもなければ問い合わせるまでもない
+        state.update(db=DB_PATH, stamp=stamp, years=[])
+    elif state['db'] != DB_PATH or state['stamp'] != stamp or state['years'] is None:
+        conn = get_db() if has_app_context() else None
+        own = conn is None
+        if own:
+            ensure_database()
+            conn = sqlite3.connect(DB_PATH, timeout=10)
+        try:
+            years = [tuple(row) for row in conn.execute(
+                "SELECT kind, year, min_id, max_id FROM archive_years ORDER BY year"
+            ).fetchall()]
+        finally:
+            if own:
+                conn.close()
+        state.update(db=DB_PATH, stamp=stamp, years=years)
+    if has_app_context():
+        g._archive_cache_checked = True
+    return state['years']
+
+
+def archived_years(kind):
+    return [year for k, year, _, _ in archive_index() if k == kind]
+
+
+def is_archived(conn, kind, year):
+    """conn から見て year がアーカイブ済みか (書き込みやスナップショットはキャッシュでなくこちらで判定する)"""
+    return conn.execute(
+        "SELECT 1 FROM archive_years WHERE kind = ? AND year = ?", (kind, year)
+    ).fetchone() is not None
+
+
+def attendance_table(conn, year):
+    """year の勤怠を読むテーブル名を返す (アーカイブ済みの年はアーカイブ DB を ATTACH する)"""
+    if is_archived(conn, 'attendance', year):
+        return attach_archive(conn, year) + '.attendance'
+    return 'attendance'
+
+
+def fetch_conversation_page(conn, user_a, user_b, before_id=0, limit=20):
+    """2人の会話から before_id より前のメッセージを新しい順に limit 件集め、古い順のリストで返す
+
+    ホット DB で足りない分は、ID の範囲が重なるアーカイブ年だけを新しい順に ATTACH して補う。
+    移動中の行が両方に見えることがあるため ID で重複を除く。
+    """
+    def query(table):
+        sql = f"""
+            SELECT {MESSAGE_COLUMNS} FROM {table}
+            WHERE ((sender_id = ? AND recipient_id = ?) OR (sender_id = ? AND recipient_id = ?))
+        """
+        params = [user_a, user_b, user_b, user_a]
+        if before_id:
+            sql += " AND id < ?"
+            params.append(before_id)
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        return [dict(row) for row in conn.execute(sql, params).fetchall()]
+
+    rows = {row['id']: row for row in query('messages')}
+    archives = sorted(
+        ((year, min_id, max_id) for kind, year, min_id, max_id in archive_index() if kind == 'messages'),
+        key=lambda archive: archive[2], reverse=True,
+    )
+    for year, min_id, max_id in archives:
+        if before_id and min_id >= before_id:
+            continue
+        if len(rows) >= limit and sorted(rows, reverse=True)[limit - 1] > max_id:
+            break
+        for row in query(attach_archive(conn, year) + '.messages'):
+            rows.setdefault(row['id'], row)
+    ids = sorted(rows, reverse=True)[:limit]
+    return [rows[i] for i in reversed(ids)]
+
+
+@contextmanager
+def try_file_lock(path):
+    """ロックファイルをブロックせずに取得し、取得できたかを返す (定期処理を全ワーカーで1つだけ実行する)"""
+    if fcntl is None:
+        yield True
+        return
+    with open(path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _record_archive_year(conn, kind, year, alias):
+    count, min_id, max_id = conn.execute(f"SELECT COUNT(*), MIN(id), MAX(id) FROM {alias}.{kind}").fetchone()
+    conn.execute(
+        """
+        INSERT INTO archive_years (kind, year, rows, min_id, max_id, archived_at) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(kind, year) DO UPDATE SET
+            rows = excluded.rows, min_id = excluded.min_id, max_id = excluded.max_id,
+            archived_at = excluded.archived_at
+        """,
+        (kind, year, count, min_id, max_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+    )
+
+
+def archive_attendance_year(conn, year):
+    """1年分の勤怠をアーカイブ DB へ移し、移した件数を返す
+
+    アーカイブ側へのコピーとホット DB からの削除は別々のトランザクションで行い、
+    コピーが確定してから削除する (WAL では複数ファイルにまたがるコミットが原子的でないため)。
+    削除時に書き込みロックを持った状態で内容が一致しなければ、コピーからやり直す。
+    """
+    alias = attach_archive(conn, year, create=True)
+    try:
+        return _move_attendance_year(conn, year, alias)
+    finally:
+        # ATTACH できる数には上限があるため1年ごとに外す
+        conn.execute(f"DETACH DATABASE {alias}")
+
+
+def _move_attendance_year(conn, year, alias):
+    start, end = year * 10000, (year + 1) * 10000
+    for _ in range(ARCHIVE_COPY_ATTEMPTS):
+        conn.execute("BEGIN")
+        conn.execute(f"""
+            DELETE FROM {alias}.attendance
+            WHERE id NOT IN (SELECT id FROM main.attendance WHERE day >= ? AND day < ?)
+        """, (start, end))
+        conn.execute(f"""
+            INSERT OR REPLACE INTO {alias}.attendance ({ATTENDANCE_COLUMNS})
+            SELECT {ATTENDANCE_COLUMNS} FROM main.attendance WHERE day >= ? AND day < ?
+        """, (start, end))
+        conn.execute("COMMIT")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            hot = conn.execute(
+                "SELECT COUNT(*) FROM main.attendance WHERE day >= ? AND day < ?", (start, end)
+            ).fetchone()[0]
+            matched = conn.execute(f"""
+                SELECT COUNT(*) FROM main.attendance m JOIN {alias}.attendance a ON a.id = m.id
+                WHERE m.day >= ? AND m.day < ? AND a.timestamp = m.timestamp AND a.type = m.type
+                  AND a.description IS m.description
+            """, (start, end)).fetchone()[0]
+            archived = conn.execute(f"SELECT COUNT(*) FROM {alias}.attendance").fetchone()[0]
+            if hot != matched or hot != archived:
+                conn.execute("ROLLBACK")
+                continue  # コピー後に書き換えられた
+            # 記録と同時に、この年への新しい打刻はトリガーで拒否されるようになる
+            _record_archive_year(conn, 'attendance', year, alias)
+            conn.execute("DELETE FROM main.attendance WHERE day >= ? AND day < ?", (start, end))
+            conn.execute("COMMIT")
+            touch_archive_stamp()
+            return hot
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    logger.warning(f"{year} 年の勤怠のアーカイブを見送りました: 移動中に更新が続きました")
+    return 0
+
+
+def archive_messages_year(conn, year, cutoff):
+    """year のうち cutoff より前の既読メッセージをアーカイブ DB へ移し、移した件数を返す
+
+    既読メッセージは変更されないため、コピー済みの行だけを削除すればよい。
+    会話の最新メッセージを移しても、チャット一覧の要約 (プレビューと並び順) は移す前のまま残す。
+    """
+    alias = attach_archive(conn, year, create=True)
+    try:
+        return _move_messages_year(conn, year, alias, cutoff)
+    finally:
+        conn.execute(f"DETACH DATABASE {alias}")
+
+
+def _move_messages_year(conn, year, alias, cutoff):
+    params = (f'{year:04d}-01-01', f'{year + 1:04d}-01-01', cutoff)
+    condition = "is_read = 1 AND timestamp >= ? AND timestamp < ? AND timestamp < ?"
+    conn.execute("BEGIN")
+    try:
+        conn.execute(f"""
+            INSERT OR IGNORE INTO {alias}.messages ({MESSAGE_COLUMNS})
+            SELECT {MESSAGE_COLUMNS} FROM main.messages WHERE {condition}
+        """, params)
+        conn.execute("COMMIT")
+        conn.execute("BEGIN IMMEDIATE")
+        _record_archive_year(conn, 'messages', year, alias)
+        # 削除トリガーは残っている中で最新のメッセージへ要約を指し直すので、移す行が最新の会話は書き戻す
+        summaries = conn.execute(f"""
+            SELECT last_message_id, last_sender_id, preview, last_timestamp, user_low, user_high
+            FROM conversations
+            WHERE last_message_id IN (
+                SELECT id FROM main.messages WHERE {condition} AND id IN (SELECT id FROM {alias}.messages)
+            )
+        """, params).fetchall()
+        moved = conn.execute(
+            f"DELETE FROM main.messages WHERE {condition} AND id IN (SELECT id FROM {alias}.messages)", params
+        ).rowcount
+        conn.executemany("""
+            UPDATE conversations SET last_message_id = ?, last_sender_id = ?, preview = ?, last_timestamp = ?
+            WHERE user_low = ? AND user_high = ?
+        """, summaries)
+        conn.execute("COMMIT")
+        touch_archive_stamp()
+        return moved
     except Exception:
-        remote = None
-    return local, remote
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def archive_old_data(now=None):
+    """締めた年の勤怠と古い既読メッセージをアーカイブし、{'attendance': {年: 件数}, 'messages': {...}} を返す
+
+    ARCHIVE_KEEP_YEARS 年前より前の勤怠と、ARCHIVE_MESSAGE_DAYS 日より前の既読メッセージが対象。
+    他のワーカーが実行中なら何もしない。
+    """
+    ensure_database()
+    now = now or datetime.now()
+    moved = {'attendance': {}, 'messages': {}}
+    with try_file_lock(DB_PATH + '.archive.lock') as locked:
+        if not locked:
+            return moved
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+        try:
+            last_closed = now.year - ARCHIVE_KEEP_YEARS - 1
+            years = [row[0] for row in conn.execute(
+                "SELECT DISTINCT day / 10000 FROM attendance WHERE day > 0 AND day < ?", ((last_closed + 1) * 10000,)
+            ).fetchall()]
+            for year in sorted(years):
+                count = archive_attendance_year(conn, year)
+                if count:
+                    moved['attendance'][year] = count
+            if ARCHIVE_MESSAGE_DAYS > 0:
+                cutoff = (now - timedelta(days=ARCHIVE_MESSAGE_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+                years = [int(row[0]) for row in conn.execute(
+                    "SELECT DISTINCT substr(timestamp, 1, 4) FROM messages WHERE is_read = 1 AND timestamp < ?",
+                    (cutoff,),
+                ).fetchall()]
+                for year in sorted(years):
+                    count = archive_messages_year(conn, year, cutoff)
+                    if count:
+                        moved['messages'][year] = count
+        finally:
+            conn.close()
+    if moved['attendance'] or moved['messages']:
+        logger.info(f"アーカイブしました: {moved}")
+    return moved
+
 
-def get_changed_files():
-    """リモートとの差分ファイル一覧を取得する"""
+def purge_user_archives(user_id):
+    """アーカイブ DB に残っているユーザーのメッセージを削除する"""
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
     try:
-        subprocess.run(['git', 'fetch'], capture_output=True, text=True, check=True)
-        result = subprocess.run(
-            ['git', 'diff', '--name-only', 'HEAD', 'origin/main'],
-            capture_output=True, text=True, check=True
-        )
-        files = [f.strip() for f in result.stdout.splitlines() if f.strip()]
-        return files
+        years = [row[0] for row in conn.execute("SELECT year FROM archive_years WHERE kind = 'messages'")]
+        for year in years:
+            alias = attach_archive(conn, year)
+            conn.execute(
+                f"DELETE FROM {alias}.messages WHERE sender_id = ? OR recipient_id = ?", (user_id, user_id)
+            )
+            conn.execute(f"DETACH DATABASE {alias}")
+    finally:
+        conn.close()
+
+
+def ensure_archiver():
+    """定期アーカイブのスレッドを起動する (ARCHIVE_INTERVAL=0 で無効)"""
+    global _archiver
+    if ARCHIVE_INTERVAL <= 0 or current_app.config.get('TESTING'):
+        return
+    if _archiver is None or not _archiver.is_alive():
+        _archiver = threading.Thread(target=_archiver_loop, name='archiver', daemon=True)
+        _archiver.start()
+
+
+@routes.before_request
+def start_archiver():
+    ensure_archiver()
+
+
+def _archiver_loop():
+    while True:
+        try:
+            archive_old_data()
+        except Exception as e:
+            logger.error(f"アーカイブに失敗しました: {e}")
+        time.sleep(ARCHIVE_INTERVAL)
+
+
+# アップデート管理
+# git fetch は時間がかかるため、バックグラウンドで定期確認した結果をキャッシュして表示する
+UPDATE_CHECK_INTERVAL = int(os.environ.get('UPDATE_CHECK_INTERVAL', 3600))
+_update_status = {
+    'local': None, 'remote': None, 'changed_files': [], 'critical_changes': False,
+    'error': None, 'checked_at': None, 'checking': False,
+}
+_update_lock = threading.Lock()
+_update_refresher = None
+
+
+def _git(*args):
+    return subprocess.run(['git', *args], capture_output=True, text=True, check=True).stdout.strip()
+
+
+def fetch_remote(force=False):
+    """git fetch を全ワーカーで1つだけ実行し、実行したかを返す
+
+    ロックを取れないときは他のワーカーが取得中なので、取得済みの origin/main を使う。
+    直近 UPDATE_CHECK_INTERVAL の半分以内に取得済みなら、force でない限り取得しない。
+    """
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    stamp = DB_PATH + '.update-fetched'
+    with try_file_lock(DB_PATH + '.update.lock') as locked:
+        if not locked:
+            return False
+        try:
+            fetched_at = os.path.getmtime(stamp)
+        except OSError:
+            fetched_at = 0
+        if not force and time.time() - fetched_at < UPDATE_CHECK_INTERVAL / 2:
+            return False
+        _git('fetch')
+        with open(stamp, 'a'):
+            pass
+        os.utime(stamp)
+        return True
+
+
+def check_for_updates(force=False):
+    """リモートとの差分を調べ、キャッシュを更新して返す
+
+    git fetch は fetch_remote() でワーカー間に1つだけ実行し、他のワーカーは
+    取得済みの origin/main と比べるだけにする。force で取得を必ず試みる。
+    """
+    status = {'local': None, 'remote': None, 'changed_files': [], 'critical_changes': False, 'error': None}
+    try:
+        status['local'] = _git('rev-parse', 'HEAD')
     except Exception:
-        return None
+        status['error'] = 'Gitリポジリではありません。'
+    if status['local']:
+        try:
+            fetch_remote(force)
+            status['remote'] = _git('rev-parse', 'origin/main')
+        except Exception:
+            status['error'] = 'リモートリポジリが設定されていません。'
+    if status['remote'] and status['local'] != status['remote']:
+        try:
+            files = [f.strip() for f in _git('diff', '--name-only', 'HEAD', 'origin/main').splitlines() if f.strip()]
+        except Exception:
+            files = []
+        status['changed_files'] = files
+        status['critical_changes'] = any(f.startswith('database/') or f == '.env.example' for f in files)
+    with _update_lock:
+        _update_status.update(status, checked_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        return dict(_update_status)
+
+
+def get_update_status():
+    with _update_lock:
+        return dict(_update_status)
+
+
+def refresh_update_status_async(notify_user_id=None, force=False):
+    """更新確認を非同期で開始する。完了したら notify_user_id に SSE で結果を送る"""
+    with _update_lock:
+        if _update_status['checking']:
+            return False
+        _update_status['checking'] = True
+
+    def run():
+        try:
+            status = check_for_updates(force)
+        finally:
+            with _update_lock:
+                _update_status['checking'] = False
+        if notify_user_id:
+            push_event(notify_user_id, {
+                'type': 'update_status',
+                'update_available': bool(status['remote'] and status['local'] != status['remote']),
+                'checked_at': status['checked_at'],
+                'error': status['error'],
+            })
+
+    threading.Thread(target=run, name='update-check', daemon=True).start()
+    return True
+
+
+def ensure_update_refresher():
+    """定期確認スレッドを起動する (UPDATE_CHECK_INTERVAL=0 で無効)"""
+    global _update_refresher
+    if UPDATE_CHECK_INTERVAL <= 0 or current_app.config.get('TESTING'):
+        return
+    if _update_refresher is None or not _update_refresher.is_alive():
+        _update_refresher = threading.Thread(target=_update_refresher_loop, name='update-refresher', daemon=True)
+        _update_refresher.start()
+
+
+@routes.before_request
+def start_update_refresher():
+    ensure_update_refresher()
+
+
+def _update_refresher_loop():
+    while True:
+        try:
+            check_for_updates()
+        except Exception as e:
+            logger.error(f"アップデート確認に失敗しました: {e}")
+        time.sleep(UPDATE_CHECK_INTERVAL)
 
 def perform_git_pull():
     try:
@@ -349,25 +2127,22 @@ def perform_git_pull():
         return str(e)
 
 # CSV 出力ヘルパ
-def generate_csv(user_id, name, year, month, target_dir, overtime_threshold='18:00'):
-    conn = get_db()
+def generate_csv(user_id, name, year, month, target_dir, overtime_threshold='18:00', conn=None):
+    conn = conn or get_db()
     c = conn.cursor()
-    start = datetime(year, month, 1)
-    end = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
-    c.execute("""
-        SELECT timestamp, type, description FROM attendance
-        WHERE user_id = ? AND timestamp >= ? AND timestamp < ?
-        ORDER BY timestamp ASC
-    """, (user_id, start.isoformat(), end.isoformat()))
+    start = year * 10000 + month * 100 + 1
+    end = (year + 1) * 10000 + 101 if month == 12 else year * 10000 + (month + 1) * 100 + 1
+    c.execute(f"""
+        SELECT day, minute, type, description FROM {attendance_table(conn, year)}
+        WHERE user_id = ? AND day >= ? AND day < ?
+        ORDER BY day, minute
+    """, (user_id, start, end))
     rows = c.fetchall()
     if not rows:
         return None
     daily_data = defaultdict(lambda: {'in': '', 'out': '', 'description': ''})
-    for row in rows:
-        ts, typ, desc = row
-        dt = safe_fromisoformat(ts)
-        day = dt.strftime('%Y/%m/%d')
-        time = dt.strftime('%H:%M')
+    for day, minute, typ, desc in rows:
+        time = format_minute(minute)
         if typ == 'in':
             daily_data[day]['in'] = time
         elif typ == 'out':
@@ -381,46 +2156,287 @@ def generate_csv(user_id, name, year, month, target_dir, overtime_threshold='18:
         writer.writerow(['日付', '曜日', '出勤時刻', '退勤時刻', '業務内容', '残業時間'])
         for day in sorted(daily_data):
             data = daily_data[day]
-            dt = datetime.strptime(day, '%Y/%m/%d')
-            weekday = '月火水木金土日'[dt.weekday()]
+            weekday = '月火水木金土日'[weekday_of_day(day)]
             overtime = (
                 calculate_overtime(data['out'], overtime_threshold, data['in'])
                 if data['out']
                 else ''
             )
-            writer.writerow([day, weekday, data['in'], data['out'], data['description'], overtime])
+            writer.writerow([format_day(day, '/'), weekday, data['in'], data['out'], data['description'], overtime])
     return filepath
 
-def delete_old_exports(base_dir='exports', days=30):
-    threshold = datetime.now() - timedelta(days=days)
-    for root, dirs, files in os.walk(base_dir):
-        for file in files:
-            path = os.path.join(root, file)
-            if os.path.isfile(path) and os.path.getmtime(path) < threshold.timestamp():
-                os.remove(path)
+# エクスポートファイルの掃除
+# 出力・ダウンロードのたびに export_files へサイズと最終アクセス時刻を記録し、
+# 掃除スレッドが索引だけを見て期限切れ・容量超過分を古い順に削除する
+EXPORT_MAX_AGE_DAYS = int(os.environ.get('EXPORT_MAX_AGE_DAYS', 30))
+EXPORT_MAX_BYTES = int(os.environ.get('EXPORT_MAX_BYTES', 1024 * 1024 * 1024))
+EXPORT_JANITOR_INTERVAL = int(os.environ.get('EXPORT_JANITOR_INTERVAL', 3600))
+# 作成・アクセスからこの分数以内のファイルは容量超過でも削除しない (ダウンロード中のものを守る)
+EXPORT_EVICT_MIN_AGE_MINUTES = int(os.environ.get('EXPORT_EVICT_MIN_AGE_MINUTES', 10))
+# エクスポートの送信をフロントのプロキシに任せる ('nginx': X-Accel-Redirect / 'sendfile': X-Sendfile)
+EXPORT_OFFLOAD = os.environ.get('EXPORT_OFFLOAD', '').lower()
+EXPORT_ACCEL_PREFIX = os.environ.get('EXPORT_ACCEL_PREFIX', '/protected-exports/')
+_export_janitor = None
+_export_janitor_state = {'db': None, 'scanned': False}
+export_janitor_stats = {
+    'runs': 0, 'files_removed': 0, 'bytes_reclaimed': 0,
+    'last_run_at': None, 'last_files_removed': 0, 'last_bytes_reclaimed': 0,
+}
+
+
+def export_relpath(path):
+    return os.path.relpath(path, EXPORT_DIR).replace(os.sep, '/')
+
+
+def record_export_file(conn, path):
+    """エクスポートファイルを索引に登録し、最終アクセス時刻を更新する"""
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn.execute(
+        """
+        INSERT INTO export_files (path, size, created_at, last_access) VALUES (?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET size = excluded.size, last_access = excluded.last_access
+        """,
+        (export_relpath(path), os.path.getsize(path), now, now),
+    )
+
+
+def send_export(path, mimetype, download_name=None):
+    """EXPORT_DIR 内のファイルを添付として返す (パスの検証は呼び出し側で済ませておく)
+
+    EXPORT_OFFLOAD 指定時はヘッダだけを返してファイルの送信・Range・条件付きリクエストを
+    プロキシに任せ、ワーカーを占有しない。直接送信では send_file が ETag / Last-Modified を付け、
+    304 や Range にも応答する。
+    """
+    download_name = download_name or os.path.basename(path)
+    if EXPORT_OFFLOAD in ('nginx', 'sendfile'):
+        response = werkzeug_send_file(
+            os.path.realpath(path), request.environ, mimetype=mimetype, as_attachment=True,
+            download_name=download_name, conditional=False, use_x_sendfile=True,
+            response_class=current_app.response_class,
+        )
+        # 本文はプロキシが付けるので、空の本文に合わない長さは返さない
+        response.headers.pop('Content-Length', None)
+        if EXPORT_OFFLOAD == 'nginx':
+            del response.headers['X-Sendfile']
+            response.headers['X-Accel-Redirect'] = (
+                EXPORT_ACCEL_PREFIX.rstrip('/') + '/' + quote(export_relpath(path))
+            )
+    else:
+        response = send_file(path, mimetype=mimetype, as_attachment=True, download_name=download_name,
+                             conditional=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _remove_export(relpath):
+    """ファイルを削除して空になったディレクトリを片付け、削除したバイト数を返す"""
+    path = os.path.join(EXPORT_DIR, *relpath.split('/'))
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    parent = os.path.dirname(path)
+    root = os.path.realpath(EXPORT_DIR)
+    while os.path.realpath(parent) != root:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+    return size
+
+
+def run_in_os_thread(func, *args):
+    """ディスクの走査などブロックする処理を OS スレッドで実行し、結果を返す
+
+    gevent のワーカーでは掃除用のスレッドもイベントループ上のグリーンレットなので、
+    ハブのスレッドプールに渡してリクエストの処理を止めないようにする。
+    """
+    if gevent_monkey is not None and gevent_monkey.is_module_patched('threading'):
+        return get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+
+def _scan_export_dir():
+    """EXPORT_DIR 内のファイルを {相対パス: (サイズ, 更新時刻)} で返す"""
+    found = {}
+    for root, dirs, files in os.walk(EXPORT_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.startswith('.') or os.path.islink(path):
+                continue
+            st = os.stat(path)
+            found[export_relpath(path)] = (st.st_size, st.st_mtime)
+    return found
+
+
+def _remove_exports(relpaths):
+    return sum(_remove_export(relpath) for relpath in relpaths)
+
+
+def _reconcile_export_index(conn):
+    """索引とディスクを突き合わせる
+
+    索引にないファイル (索引導入前の出力など) は更新時刻を最終アクセスとして登録し、
+    手作業で消されたファイルの行は削除する。走査はワーカー起動後の初回の掃除でだけ行う。
+    """
+    known = {row[0] for row in conn.execute("SELECT path FROM export_files")}
+    found = run_in_os_thread(_scan_export_dir)
+    rows = []
+    for relpath, (size, mtime) in found.items():
+        if relpath in known:
+            continue
+        stamp = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+        rows.append((relpath, size, stamp, stamp))
+    conn.executemany(
+        "INSERT OR IGNORE INTO export_files (path, size, created_at, last_access) VALUES (?, ?, ?, ?)", rows
+    )
+    conn.executemany("DELETE FROM export_files WHERE path = ?", [(path,) for path in known - found.keys()])
+    conn.commit()
+
+
+def clean_exports(now=None):
+    """期限切れと容量超過のエクスポートを削除し、{'files': 件数, 'bytes': 削除バイト数} を返す
+
+    EXPORT_MAX_AGE_DAYS 日アクセスのないファイルを削除したうえで、合計が EXPORT_MAX_BYTES を
+    超えていれば最終アクセスの古い順に削除する (どちらも 0 で無効)。容量超過による削除は
+    EXPORT_EVICT_MIN_AGE_MINUTES 分以内に作成・アクセスされたファイルには行わない。
+    ディスクの走査と削除は OS スレッドで行う。
+    """
+    ensure_database()
+    now = now or datetime.now()
+    removed = {'files': 0, 'bytes': 0}
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    with try_file_lock(os.path.join(EXPORT_DIR, '.janitor.lock')) as locked:
+        if not locked:
+            return removed
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        try:
+            if _export_janitor_state['db'] != (DB_PATH, EXPORT_DIR) or not _export_janitor_state['scanned']:
+                _reconcile_export_index(conn)
+                _export_janitor_state.update(db=(DB_PATH, EXPORT_DIR), scanned=True)
+            victims = []
+            if EXPORT_MAX_AGE_DAYS > 0:
+                threshold = (now - timedelta(days=EXPORT_MAX_AGE_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+                victims = [row[0] for row in conn.execute(
+                    "SELECT path FROM export_files WHERE last_access < ?", (threshold,)
+                )]
+            if EXPORT_MAX_BYTES > 0:
+                expired = set(victims)
+                protected_since = (now - timedelta(minutes=EXPORT_EVICT_MIN_AGE_MINUTES)).strftime('%Y-%m-%d %H:%M:%S')
+                total = 0
+                # 新しい順に数えて、容量に収まらなくなった以降を削除する
+                for path, size, last_access in conn.execute(
+                    "SELECT path, size, last_access FROM export_files ORDER BY last_access DESC"
+                ):
+                    if path in expired:
+                        continue
+                    total += size
+                    if total > EXPORT_MAX_BYTES and last_access < protected_since:
+                        victims.append(path)
+            if victims:
+                removed['bytes'] = run_in_os_thread(_remove_exports, victims)
+                removed['files'] = len(victims)
+                conn.executemany("DELETE FROM export_files WHERE path = ?", [(path,) for path in victims])
+            conn.commit()
+        finally:
+            conn.close()
+    stats = export_janitor_stats
+    stats['runs'] += 1
+    stats['files_removed'] += removed['files']
+    stats['bytes_reclaimed'] += removed['bytes']
+    stats.update(
+        last_run_at=now.strftime('%Y-%m-%d %H:%M:%S'),
+        last_files_removed=removed['files'], last_bytes_reclaimed=removed['bytes'],
+    )
+    if removed['files']:
+        logger.info(f"エクスポートを {removed['files']} 件削除しました: {removed['bytes']} バイト解放")
+    return removed
+
+
+def ensure_export_janitor():
+    """エクスポート掃除のスレッドを起動する (EXPORT_JANITOR_INTERVAL=0 で無効)"""
+    global _export_janitor
+    if EXPORT_JANITOR_INTERVAL <= 0 or current_app.config.get('TESTING'):
+        return
+    if _export_janitor is None or not _export_janitor.is_alive():
+        _export_janitor = threading.Thread(target=_export_janitor_loop, name='export-janitor', daemon=True)
+        _export_janitor.start()
+
+
+@routes.before_request
+def start_export_janitor():
+    ensure_export_janitor()
+
+
+def _export_janitor_loop():
+    while True:
+        try:
+            clean_exports()
+        except Exception as e:
+            logger.error(f"エクスポートの掃除に失敗しました: {e}")
+        time.sleep(EXPORT_JANITOR_INTERVAL)
+
+# 初回セットアップ完了フラグ (DBパスごとにワーカー内でキャッシュ)
+_setup_completed = set()
+
+def is_setup_completed():
+    """セットアップ済みかを返す。一度完了を確認した後はクエリを発行しない"""
+    if DB_PATH in _setup_completed:
+        return True
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT value FROM app_settings WHERE key = 'setup_completed'")
+    if c.fetchone() is None:
+        # フラグ導入前のDBはユーザーの有無で判定し、結果を永続化する
+        c.execute("SELECT 1 FROM users LIMIT 1")
+        if c.fetchone() is None:
+            return False
+        run_write(mark_setup_completed)
+    _setup_completed.add(DB_PATH)
+    return True
+
+def mark_setup_completed(conn):
+    """セットアップ完了フラグをDBに記録する (コミットは呼び出し側で行う)"""
+    conn.execute(
+        "INSERT OR REPLACE INTO app_settings (key, value) VALUES ('setup_completed', ?)",
+        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),),
+    )
 
 # 初回起動時のセットアップリダイレクト
-@app.before_request
+@routes.before_request
 def redirect_to_setup_if_first_run():
-    if app.config.get('TESTING'):
+    if current_app.config.get('TESTING'):
         return
-    if request.endpoint in ('static', 'setup'):
+    if request.endpoint in ('static', 'setup', 'hashed_asset', 'asset_manifest', 'service_worker'):
         return
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM users")
-    count = c.fetchone()[0]
-    if count == 0:
+    if not is_setup_completed():
         return redirect(url_for('setup'))
 
 # ルーティング
 
-@app.route('/')
+@routes.route('/')
 @login_required
 def index():
     return render_template('index.html', user_name=session['user_name'])
 
-@app.route('/login', methods=['GET', 'POST'])
+
+@routes.route('/offline')
+@login_required
+def offline_shell():
+    """Service Worker が保存しておき、通信できないときに表示する打刻画面
+
+    フラッシュメッセージを消費せず、未読数などその時点の値も埋め込まない。
+    """
+    response = current_app.make_response(
+        render_template('index.html', user_name=session['user_name'], offline_shell=True, unread_count=0)
+    )
+    response.cache_control.no_store = True
+    return response
+
+@routes.route('/login', methods=['GET', 'POST'])
 def login():
     errors = {}
     if request.method == 'POST':
@@ -440,12 +2456,15 @@ def login():
             c = conn.cursor()
             c.execute("SELECT id, name, password_hash, is_admin, is_superadmin FROM users WHERE email = ?", (email,))
             user = c.fetchone()
-            if not user or not check_password_hash(user['password_hash'], password):
+            if not user or not verify_password(user['password_hash'], password):
                 errors['password'] = "メールアドレスまたはパスワードが正しくありません。"
 
         if errors:
             return render_template('login.html', errors=errors)
-        
+
+        if password_needs_rehash(user['password_hash']):
+            run_write(update_password_hash, user['id'], hash_password(password))
+
         session['user_id'] = user['id']
         session['user_name'] = user['name']
         session['is_admin'] = bool(user['is_admin'])
@@ -456,7 +2475,7 @@ def login():
 
     return render_template('login.html', errors=errors)
 
-@app.route('/logout')
+@routes.route('/logout')
 def logout():
     user_id = session.get('user_id')
     user_name = session.get('user_name')
@@ -465,7 +2484,7 @@ def logout():
         log_audit_event('logout', user_id, user_name)
     return redirect(url_for('login'))
 
-@app.route('/punch', methods=['POST'])
+@routes.route('/punch', methods=['POST'])
 @login_required
 def punch():
     if not check_csrf():
@@ -474,31 +2493,28 @@ def punch():
     timestamp = request.form['timestamp']
     punch_type = request.form['type']
     description = request.form.get('description', '')
+    try:
+        split_timestamp(timestamp)
+    except ValueError:
+        flash("打刻時刻の形式が正しくありません。", "danger")
+        return redirect(request.form.get('referer', url_for('index')))
     day = timestamp[:10]
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT timestamp, description FROM attendance 
-        WHERE user_id = ? AND type = ? AND substr(timestamp, 1, 10) = ?
-    """, (user_id, punch_type, day))
-    existing = c.fetchone()
+    status, existing = run_write(
+        lambda conn: apply_punch(conn.cursor(), user_id, timestamp, punch_type, description)
+    )
+    if status == 'archived':
+        flash("アーカイブ済みの年には打刻できません。", "danger")
+        return redirect(request.form.get('referer', url_for('index')))
     if existing:
-        return render_template('confirm_punch.html', existing={
-            'timestamp': existing['timestamp'], 'description': existing['description']
-        }, incoming={
+        return render_template('confirm_punch.html', existing=existing, incoming={
             'timestamp': timestamp, 'description': description
         }, punch_type=punch_type, day=day, referer=request.referrer or url_for('index'))
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("INSERT INTO attendance (user_id, timestamp, type, description) VALUES (?, ?, ?, ?)",
-              (user_id, timestamp, punch_type, description))
-    conn.commit()
     log_audit_event(f'punch:{punch_type}', user_id, session.get('user_name'))
     flash("打刻しました。", "success")
     referer = request.form.get('referer', url_for('index'))
     return redirect(referer)
 
-@app.route('/punch/resolve', methods=['POST'])
+@routes.route('/punch/resolve', methods=['POST'])
 @login_required
 def resolve_punch():
     if not check_csrf():
@@ -509,22 +2525,169 @@ def resolve_punch():
     punch_type = request.form['type']
     timestamp = request.form['timestamp']
     description = request.form.get('description', '')
-    conn = get_db()
-    c = conn.cursor()
+    referer = request.form.get('referer', url_for('index'))
     if action == 'overwrite':
-        c.execute("DELETE FROM attendance WHERE user_id = ? AND type = ? AND substr(timestamp, 1, 10) = ?",
-                  (user_id, punch_type, day))
-        c.execute("INSERT INTO attendance (user_id, timestamp, type, description) VALUES (?, ?, ?, ?)",
-                  (user_id, timestamp, punch_type, description))
-        conn.commit()
+        try:
+            split_timestamp(timestamp)
+            date_to_day(day)
+        except ValueError:
+            flash("打刻時刻の形式が正しくありません。", "danger")
+            return redirect(referer)
+        conn = get_db()
+        if any(is_archived(conn, 'attendance', int(d[:4])) for d in (day, timestamp)):
+            flash("アーカイブ済みの年には打刻できません。", "danger")
+            return redirect(referer)
+        run_write(replace_attendance, user_id, [(day, punch_type, timestamp, description)])
     log_audit_event(
         f'resolve:{action}:{punch_type}', user_id, session.get('user_name')
     )
     flash("打刻しました。", "success")
-    referer = request.form.get('referer', url_for('index'))
     return redirect(referer)
 
-@app.route('/exports/<path:filename>')
+PUNCH_BATCH_MAX = 500
+
+def apply_punch(c, user_id, timestamp, punch_type, description, on_conflict='skip'):
+    """1件の打刻を適用し、結果の状態と既存の打刻を返す (コミットは呼び出し側で行う)
+
+    同じ日・同じ区分の打刻がある場合は punch と同じく conflict とし、
+    on_conflict='overwrite' なら resolve_punch と同じく置き換える。
+    """
+    day, _ = split_timestamp(timestamp)
+    if is_archived(c, 'attendance', day // 10000):
+        return 'archived', None
+    c.execute("""
+        SELECT timestamp, description FROM attendance
+        WHERE user_id = ? AND day = ? AND type = ?
+    """, (user_id, day, punch_type))
+    existing = c.fetchone()
+    if existing:
+        existing = {'timestamp': existing['timestamp'], 'description': existing['description']}
+        if existing['timestamp'] == timestamp and (existing['description'] or '') == description:
+            # 同じ打刻の再送は成功扱いにする
+            return 'duplicate', existing
+        if on_conflict != 'overwrite':
+            return 'conflict', existing
+        c.execute("DELETE FROM attendance WHERE user_id = ? AND day = ? AND type = ?",
+                  (user_id, day, punch_type))
+    insert_attendance(c, user_id, timestamp, punch_type, description)
+    return ('overwritten' if existing else 'created'), existing
+
+
+@routes.route('/punch/batch', methods=['POST'])
+@login_required
+def punch_batch():
+    """オフライン中に端末へ溜めた打刻をまとめて1トランザクションで適用する"""
+    if not check_csrf():
+        return {'error': 'csrf'}, 400
+    payload = request.get_json(silent=True) or {}
+    punches = payload.get('punches')
+    if not isinstance(punches, list) or len(punches) > PUNCH_BATCH_MAX:
+        return {'error': 'invalid'}, 400
+    user_id = session['user_id']
+    results, applied = run_write(apply_punch_batch, user_id, punches)
+    for status, punch_type in applied:
+        action = f'punch:{punch_type}' if status == 'created' else f'resolve:overwrite:{punch_type}'
+        log_audit_event(f'{action}:offline', user_id, session.get('user_name'))
+    return {'results': results}
+
+
+def apply_punch_batch(conn, user_id, punches):
+    """打刻の一覧を適用し、項目ごとの結果と適用した (状態, 区分) の一覧を返す"""
+    c = conn.cursor()
+    results = []
+    applied = []
+    for item in punches:
+        if not isinstance(item, dict):
+            results.append({'id': None, 'status': 'invalid'})
+            continue
+        result = {'id': item.get('id')}
+        timestamp = str(item.get('timestamp') or '')
+        punch_type = item.get('type')
+        description = str(item.get('description') or '')
+        try:
+            split_timestamp(timestamp)
+        except ValueError:
+            timestamp = ''
+        if not timestamp or punch_type not in ('in', 'out'):
+            result['status'] = 'invalid'
+        else:
+            result['status'], existing = apply_punch(
+                c, user_id, timestamp, punch_type, description, item.get('on_conflict', 'skip')
+            )
+            if existing:
+                result['existing'] = existing
+            if result['status'] in ('created', 'overwritten'):
+                applied.append((result['status'], punch_type))
+        results.append(result)
+    return results, applied
+
+
+def _kiosk_punch_job(conn, token_hash, timestamp, punch_type, description):
+    c = conn.cursor()
+    c.execute("""
+        SELECT u.id, u.name FROM kiosk_badges k JOIN users u ON u.id = k.user_id
+        WHERE k.token_hash = ?
+    """, (token_hash,))
+    user = c.fetchone()
+    if not user:
+        return None, None, None
+    status, existing = apply_punch(c, user['id'], timestamp, punch_type, description)
+    return status, {'id': user['id'], 'name': user['name']}, existing
+
+
+@routes.route('/kiosk/punch', methods=['POST'])
+@kiosk_required
+def kiosk_punch():
+    """共用端末からバッジ/PIN で打刻する (書き込みはグループコミット)"""
+    payload = request.get_json(silent=True) or {}
+    badge = str(payload.get('badge') or '').strip()
+    punch_type = payload.get('type')
+    timestamp = str(payload.get('timestamp') or datetime.now().strftime('%Y-%m-%dT%H:%M'))
+    description = str(payload.get('description') or '')
+    try:
+        split_timestamp(timestamp)
+    except ValueError:
+        timestamp = ''
+    if not badge or not timestamp or punch_type not in ('in', 'out'):
+        return {'error': 'invalid'}, 400
+    status, user, existing = kiosk_writer.submit(
+        _kiosk_punch_job, hash_badge(badge), timestamp, punch_type, description
+    )
+    if user is None:
+        return {'error': 'unknown_badge'}, 404
+    if status == 'created':
+        log_audit_event(f'punch:{punch_type}:kiosk', user['id'], user['name'])
+    result = {'status': status, 'name': user['name'], 'type': punch_type, 'timestamp': timestamp}
+    if existing:
+        result['existing'] = existing
+    return result, 409 if status in ('conflict', 'archived') else 200
+
+
+@routes.route('/admin/kiosk/stats')
+@admin_required
+def kiosk_stats():
+    return kiosk_writer.snapshot()
+
+
+@routes.route('/admin/exports/janitor')
+@admin_required
+def export_janitor_status():
+    """エクスポート掃除の実行結果と現在の使用量"""
+    total_bytes, total_files = get_db().execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM export_files").fetchone()
+    return dict(
+        export_janitor_stats, total_bytes=total_bytes, total_files=total_files,
+        max_bytes=EXPORT_MAX_BYTES, max_age_days=EXPORT_MAX_AGE_DAYS,
+    )
+
+
+@routes.route('/admin/db/write_stats')
+@admin_required
+def db_write_stats():
+    """書き込みキューの待ち行列長とロック待ち時間"""
+    return dict(db_writer.snapshot(), enabled=DB_WRITE_QUEUE)
+
+
+@routes.route('/exports/<path:filename>')
 @admin_required
 def download_export_file(filename):
     export_root = os.path.realpath(EXPORT_DIR)
@@ -535,26 +2698,29 @@ def download_export_file(filename):
         return '不正なファイルパスです', 400
     if not os.path.isfile(filepath):
         return 'ファイルが存在しません', 404
-    return send_file(filepath, as_attachment=True, mimetype='text/csv')
+    path = os.path.join(EXPORT_DIR, filename)
+    run_write(record_export_file, path)
+    mimetype = 'application/zip' if filename.endswith('.zip') else 'text/csv'
+    return send_export(path, mimetype)
 
-@app.route('/my')
+@routes.route('/my')
 @login_required
 def my_page():
     return render_template('my_dashboard.html')
 
 
-@app.route('/my/profile')
+@routes.route('/my/profile')
 @login_required
 def my_profile():
     return render_template('my_profile.html')
 
 
-@app.route('/admin')
+@routes.route('/admin')
 @admin_required
 def admin_dashboard():
     return render_template('admin_dashboard.html')
 
-@app.route('/my/password', methods=['GET', 'POST'])
+@routes.route('/my/password', methods=['GET', 'POST'])
 @login_required
 def my_password():
     user_id = session['user_id']
@@ -582,12 +2748,10 @@ def my_password():
             c = conn.cursor()
             c.execute("SELECT password_hash FROM users WHERE id = ?", (user_id,))
             row = c.fetchone()
-            if not row or not check_password_hash(row['password_hash'], current):
+            if not row or not verify_password(row['password_hash'], current):
                 errors['current_password'] = "現在のパスワードが正しくありません。"
             else:
-                new_hash = generate_password_hash(new)
-                c.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, user_id))
-                conn.commit()
+                run_write(update_password_hash, user_id, hash_password(new))
                 flash("パスワードを更新しました。", "success")
                 return redirect_embedded('my_password')
 
@@ -595,7 +2759,7 @@ def my_password():
 
     return render_template('my_password.html', errors=errors)
 
-@app.route('/my/import', methods=['POST'])
+@routes.route('/my/import', methods=['POST'])
 @login_required
 def import_csv():
     if not check_csrf():
@@ -613,13 +2777,12 @@ def import_csv():
         return redirect(url_for('view_my_logs'))
     conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT timestamp, type, description FROM attendance WHERE user_id = ?", (user_id,))
+    c.execute("SELECT day, timestamp, type, description FROM attendance WHERE user_id = ?", (user_id,))
     existing = defaultdict(dict)
-    for row in c.fetchall():
-        ts, typ, desc = row
-        dt = safe_fromisoformat(ts)
-        day = dt.strftime('%Y-%m-%d')
-        existing[day][typ] = (ts, desc)
+    for day, ts, typ, desc in c.fetchall():
+        if day is None:
+            continue  # 時刻を解釈できない行は CSV のどの日付とも突き合わせない
+        existing[format_day(day)][typ] = (ts, desc)
     incoming = defaultdict(dict)
     try:
         for row in reader:
@@ -634,6 +2797,10 @@ def import_csv():
     except Exception:
         flash("CSVデータの形式が正しくありません。日付・時刻形式を確認してください。", "danger")
         return redirect(url_for('view_my_logs'))
+    closed = sorted({day[:4] for day in incoming if is_archived(conn, 'attendance', int(day[:4]))})
+    if closed:
+        flash(f"アーカイブ済みの年 ({', '.join(closed)}) の勤怠は取り込めません。", "danger")
+        return redirect(url_for('view_my_logs'))
     conflicts = []
     for day in incoming:
         for typ in incoming[day]:
@@ -645,30 +2812,23 @@ def import_csv():
                     'incoming': incoming[day][typ]
                 })
     if not conflicts:
-        for day in incoming:
-            for typ in ['in', 'out']:
-                if typ in incoming[day]:
-                    ts, desc = incoming[day][typ]
-                    c.execute("DELETE FROM attendance WHERE user_id = ? AND type = ? AND substr(timestamp, 1, 10) = ?",
-                              (user_id, typ, day))
-                    c.execute("INSERT INTO attendance (user_id, timestamp, type, description) VALUES (?, ?, ?, ?)",
-                              (user_id, ts, typ, desc))
-        conn.commit()
+        run_write(replace_attendance, user_id, [
+            (day, typ, *incoming[day][typ])
+            for day in incoming for typ in ['in', 'out'] if typ in incoming[day]
+        ])
         flash("CSVインポートが完了しました。", "success")
         return redirect(url_for('view_my_logs'))
     return render_template('resolve_conflicts.html', conflicts=conflicts, incoming=incoming, user_id=user_id, referer=request.referrer or url_for('view_my_logs'))
 
-@app.route('/my/import/resolve', methods=['POST'])
+@routes.route('/my/import/resolve', methods=['POST'])
 @login_required
 def resolve_conflicts():
     if not check_csrf():
         return redirect(url_for('view_my_logs'))
     user_id = session['user_id']
     referer = request.form.get('referer', url_for('view_my_logs'))
-    conn = get_db()
-    c = conn.cursor()
     errors = []
-    updated_count = 0
+    entries = []
     for key, value in request.form.items():
         if key.startswith("choice_"):
             try:
@@ -682,14 +2842,24 @@ def resolve_conflicts():
                         continue
                     ts = request.form[ts_key]
                     desc = request.form.get(desc_key, '')
-                    c.execute("DELETE FROM attendance WHERE user_id = ? AND type = ? AND substr(timestamp, 1, 10) = ?",
-                              (user_id, typ, day))
-                    c.execute("INSERT INTO attendance (user_id, timestamp, type, description) VALUES (?, ?, ?, ?)",
-                              (user_id, ts, typ, desc))
-                    updated_count += 1
+                    try:
+                        split_timestamp(ts)
+                        date_to_day(day)
+                    except ValueError:
+                        errors.append(f"{day} の {typ}：時刻の形式が正しくありません。")
+                        continue
+                    entries.append((day, typ, ts, desc))
             except Exception:
                 errors.append(f"{key} の処理中に予期しないエラーが発生しました。")
-    conn.commit()
+    conn = get_db()
+    closed = sorted({
+        d[:4] for day, _, ts, _ in entries for d in (day, ts) if is_archived(conn, 'attendance', int(d[:4]))
+    })
+    if closed:
+        flash(f"アーカイブ済みの年 ({', '.join(closed)}) の勤怠は取り込めません。", "danger")
+        return redirect(referer)
+    run_write(replace_attendance, user_id, entries)
+    updated_count = len(entries)
     if errors:
         for msg in errors:
             flash(msg, "danger")
@@ -697,112 +2867,187 @@ def resolve_conflicts():
     flash(f"{updated_count} 件の勤怠データを更新しました。", "success")
     return redirect(referer)
 
-@app.route('/my/logs')
+def stream_page(template_name, **context):
+    """テンプレートを逐次送信するレスポンスを返す
+
+    送信開始後のセッション変更は保存されないため、フラッシュメッセージと
+    CSRFトークンは描画前に確定させておく。行を読み出すカーソルが使えるよう、
+    DBコネクションは teardown から切り離して送信完了時に閉じる。
+    リクエストの所要時間 (Server-Timing の内訳を含む) も送信完了時にログへ出す。
+    """
+    get_flashed_messages(with_categories=True)
+    generate_csrf_token()
+    chunks = stream_template(template_name, **context)
+    conn = g.pop('_database', None)
+    g._streamed_page = True
+
+    def generate():
+        try:
+            yield from chunks
+        finally:
+            if conn is not None:
+                conn.close()
+            log_streamed_request_end()
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+
+def iter_attendance_days(rows, overtime_threshold):
+    """日時順の勤怠行を読みながら1日分ずつ (日付, 表示用データ) を返す
+
+    day が NULL の行 (timestamp を解釈できなかった行) は記録された文字列を日付欄に出し、1行ずつ返す。
+    """
+    current = label = data = None
+    for day, minute, typ, desc, ts in rows:
+        key = day if day is not None else ('raw', ts)
+        if data is None or key != current:
+            if data is not None:
+                yield label, _finish_attendance_day(data, overtime_threshold)
+            current = key
+            if day is None:
+                label = ts
+                data = {'weekday': '', 'in': None, 'out': None, 'overtime': '', 'editable': False}
+            else:
+                label = format_day(day)
+                data = {'weekday': '月火水木金土日'[weekday_of_day(day)], 'in': None, 'out': None, 'overtime': '',
+                        'editable': True}
+        data[typ] = {'time': format_minute(minute) if minute is not None else '', 'description': desc}
+    if data is not None:
+        yield label, _finish_attendance_day(data, overtime_threshold)
+
+
+def _finish_attendance_day(data, overtime_threshold):
+    if data['out'] and data['out']['time']:
+        in_time = data['in']['time'] if data['in'] else None
+        data['overtime'] = calculate_overtime(data['out']['time'], overtime_threshold, in_time)
+    return data
+
+
+@routes.route('/my/logs')
 @login_required
 def view_my_logs():
     user_id = session['user_id']
     conn = get_db()
     c = conn.cursor()
     overtime_threshold = fetch_overtime_threshold(user_id)
-    c.execute("SELECT timestamp, type, description FROM attendance WHERE user_id = ? ORDER BY timestamp", (user_id,))
-    records = c.fetchall()
-    attendance_by_day = {}
-    for row in records:
-        ts, typ, desc = row
-        dt = safe_fromisoformat(ts)
-        date = dt.strftime('%Y-%m-%d')
-        weekday = '月火水木金土日'[dt.weekday()]
-        time = dt.strftime('%H:%M')
-        if date not in attendance_by_day:
-            attendance_by_day[date] = {'weekday': weekday, 'in': None, 'out': None, 'overtime': ''}
-        attendance_by_day[date][typ] = {'time': time, 'description': desc}
-    for date, data in attendance_by_day.items():
-        if data['out']:
-            in_time = data['in']['time'] if data['in'] else None
-            data['overtime'] = calculate_overtime(
-                data['out']['time'], overtime_threshold, in_time
-            )
-        else:
-            data['overtime'] = ''
-    return render_template('my_logs.html', logs=attendance_by_day)
+    year = request.args.get('year', type=int)
+    archived = archived_years('attendance')
+    if year and year not in archived:
+        return redirect(url_for('view_my_logs'))
+    if '_flashes' not in session:
+        # 年の選択肢はアーカイブ済みの年の一覧から作る。その年に自分の打刻がなくても一覧は変わるので、
+        # 勤怠のバージョンとは別に ETag に含める (一覧はキャッシュ済みで問い合わせは増えない)
+        not_modified = not_modified_response(
+            'my_logs', fetch_attendance_version(user_id), overtime_threshold, year, tuple(archived),
+            *page_etag_parts()
+        )
+        if not_modified:
+            return not_modified
+    # アーカイブ済みの年は指定されたときだけアーカイブ DB を ATTACH して読む
+    table = attach_archive(conn, year) + '.attendance' if year else 'attendance'
+    c.execute(
+        f"SELECT day, minute, type, description, timestamp FROM {table} WHERE user_id = ? ORDER BY day, minute",
+        (user_id,),
+    )
+    return stream_page(
+        'my_logs.html', logs=iter_attendance_days(c, overtime_threshold), year=year, archived_years=archived,
+    )
+
+def edit_attendance_day(conn, user_id, date, in_time, out_time, description):
+    """1日分の出勤・退勤を入力値で置き換える (空欄の区分は削除する)"""
+    delete_attendance_day(conn, user_id, date, 'in')
+    if in_time:
+        insert_attendance(conn, user_id, f"{date}T{in_time}:00", 'in', '')
+    delete_attendance_day(conn, user_id, date, 'out')
+    if out_time:
+        insert_attendance(conn, user_id, f"{date}T{out_time}:00", 'out', description or '')
 
-@app.route('/my/logs/edit/<date>', methods=['GET', 'POST'])
+@routes.route('/my/logs/edit/<date>', methods=['GET', 'POST'])
 @login_required
 def edit_log(date):
     user_id = session['user_id']
+    try:
+        day = date_to_day(date)
+    except ValueError:
+        abort(404)
     conn = get_db()
     c = conn.cursor()
+    if is_archived(conn, 'attendance', day // 10000):
+        flash("アーカイブ済みの年の勤怠は編集できません。", "danger")
+        return redirect(url_for('view_my_logs', year=day // 10000))
     if request.method == 'POST':
         if not check_csrf():
             return redirect(url_for('edit_log', date=date))
         in_time = request.form.get('in_time')
         out_time = request.form.get('out_time')
         description = request.form.get('description')
-        c.execute("DELETE FROM attendance WHERE user_id = ? AND type = 'in' AND substr(timestamp, 1, 10) = ?", (user_id, date))
-        if in_time:
-            c.execute("INSERT INTO attendance (user_id, timestamp, type, description) VALUES (?, ?, 'in', '')",
-                      (user_id, f"{date}T{in_time}:00"))
-        c.execute("DELETE FROM attendance WHERE user_id = ? AND type = 'out' AND substr(timestamp, 1, 10) = ?", (user_id, date))
-        if out_time:
-            c.execute("INSERT INTO attendance (user_id, timestamp, type, description) VALUES (?, ?, 'out', ?)",
-                      (user_id, f"{date}T{out_time}:00", description or ''))
-        conn.commit()
+        try:
+            run_write(edit_attendance_day, user_id, date, in_time, out_time, description)
+        except ValueError:
+            flash("時刻の形式が正しくありません。", "danger")
+            return redirect(url_for('edit_log', date=date))
         return redirect(url_for('view_my_logs'))
     c.execute("""
-        SELECT type, substr(timestamp, 12, 5), description FROM attendance
-        WHERE user_id = ? AND substr(timestamp, 1, 10) = ?
-    """, (user_id, date))
+        SELECT type, minute, description FROM attendance
+        WHERE user_id = ? AND day = ?
+    """, (user_id, day))
     rows = c.fetchall()
     in_time = out_time = description = ''
-    for typ, time, desc in rows:
+    for typ, minute, desc in rows:
         if typ == 'in':
-            in_time = time
+            in_time = format_minute(minute)
         elif typ == 'out':
-            out_time = time
+            out_time = format_minute(minute)
             description = desc or ''
     return render_template('edit_log.html', date=date, in_time=in_time, out_time=out_time, description=description)
 
 
 def can_chat(current_id, partner_id):
-    conn = get_db()
-    c = conn.cursor()
     if session.get('is_admin'):
-        c.execute(
-            "SELECT 1 FROM admin_managed_users WHERE admin_id = ? AND user_id = ?",
-            (current_id, partner_id),
-        )
-    else:
-        c.execute(
-            "SELECT 1 FROM admin_managed_users WHERE admin_id = ? AND user_id = ?",
-            (partner_id, current_id),
-        )
-    allowed = c.fetchone() is not None
-    return allowed
+        return partner_id in get_managed_user_ids(current_id)
+    return current_id in get_managed_user_ids(partner_id)
 
 
 def fetch_user_name(user_id):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT name FROM users WHERE id = ?", (user_id,))
-    row = c.fetchone()
-    return row['name'] if row else ''
+    profile = get_user_profile(user_id)
+    return profile['name'] if profile else ''
+
+
+class MessageStream:
+    """カーソルを逐次読みながら最古のIDと最新の既読時刻を記録するイテレータ
+
+    テンプレートはメッセージ一覧を描画した後で earliest / last_read を参照する。
+    """
+
+    def __init__(self, rows):
+        self._rows = rows
+        self.earliest = 0
+        self.last_read = ''
+
+    def __iter__(self):
+        for m in self._rows:
+            if not self.earliest:
+                self.earliest = m['id']
+            rt = m['read_timestamp']
+            if rt and rt > self.last_read:
+                self.last_read = rt
+            yield m
 
 
-@app.route('/chat/<int:partner_id>', methods=['GET', 'POST'])
+@routes.route('/chat/<int:partner_id>', methods=['GET', 'POST'])
 @login_required
 def chat(partner_id):
     current_id = session['user_id']
     if not can_chat(current_id, partner_id):
         return 'アクセス拒否'
     conn = get_db()
-    c = conn.cursor()
     if request.method == 'POST':
         if not check_csrf():
             return redirect(url_for('chat', partner_id=partner_id))
         message = request.form.get('message', '').strip()
         if message:
             ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            c.execute(
+            run_write(lambda conn: conn.execute(
                 "INSERT INTO messages (sender_id, recipient_id, message, timestamp)"
                 " VALUES (?, ?, ?, ?)",
                 (
@@ -811,8 +3056,7 @@ def chat(partner_id):
                     message,
                     ts,
                 ),
-            )
-            conn.commit()
+            ))
             push_event(partner_id, {
                 "type": "message",
                 "message": message,
@@ -822,36 +3066,18 @@ def chat(partner_id):
             })
             push_unread(partner_id)
         return redirect(url_for('chat', partner_id=partner_id))
-    limit = 20
-    c.execute("""
-        SELECT id, sender_id, recipient_id, message, timestamp, is_read, read_timestamp
-        FROM messages
-        WHERE (sender_id = ? AND recipient_id = ?) OR
-              (sender_id = ? AND recipient_id = ?)
-        ORDER BY id DESC LIMIT ?
-        """,
-        (current_id, partner_id, partner_id, current_id, limit),
-    )
-    messages = c.fetchall()[::-1]
-    earliest = messages[0]['id'] if messages else 0
-    last_read = ''
-    for m in messages:
-        rt = m['read_timestamp']
-        if rt and rt > last_read:
-            last_read = rt
+    messages = fetch_conversation_page(conn, current_id, partner_id, limit=20)
     partner_name = fetch_user_name(partner_id)
-    return render_template(
+    return stream_page(
         'chat.html',
-        messages=messages,
+        messages=MessageStream(messages),
         partner_id=partner_id,
         partner_name=partner_name,
         current_id=current_id,
-        last_read=last_read,
-        earliest=earliest,
     )
 
 
-@app.route('/chat/poll/<int:partner_id>')
+@routes.route('/chat/poll/<int:partner_id>')
 @login_required
 def poll_chat(partner_id):
     current_id = session['user_id']
@@ -879,34 +3105,122 @@ def poll_chat(partner_id):
     return {'messages': rows, 'reads': read_ids}
 
 
-@app.route('/chat/history/<int:partner_id>')
+@routes.route('/chat/history/<int:partner_id>')
 @login_required
 def chat_history(partner_id):
     current_id = session['user_id']
     if not can_chat(current_id, partner_id):
         return {'messages': []}
     before_id = int(request.args.get('before', 0))
+    around_id = int(request.args.get('around', 0))
     limit = int(request.args.get('limit', 20))
+    not_modified = not_modified_response('chat_history', *fetch_conversation_version(current_id, partner_id))
+    if not_modified:
+        return not_modified
     conn = get_db()
-    c = conn.cursor()
-    query = """
-        SELECT id, sender_id, recipient_id, message, timestamp, is_read, read_timestamp
-        FROM messages
-        WHERE ((sender_id = ? AND recipient_id = ?) OR
-               (sender_id = ? AND recipient_id = ?))
-    """
-    params = [current_id, partner_id, partner_id, current_id]
-    if before_id:
-        query += " AND id < ?"
-        params.append(before_id)
-    query += " ORDER BY id DESC LIMIT ?"
-    params.append(limit)
-    c.execute(query, params)
-    rows = [dict(r) for r in c.fetchall()][::-1]
+    if around_id:
+        # 検索結果へ移動するとき: 指定IDまでの limit 件とその後の limit 件をキーセットで読む
+        rows = fetch_conversation_page(conn, current_id, partner_id, around_id + 1, limit)
+        newer = [dict(r) for r in conn.execute(f"""
+            SELECT {MESSAGE_COLUMNS} FROM messages
+            WHERE ((sender_id = ? AND recipient_id = ?) OR (sender_id = ? AND recipient_id = ?)) AND id > ?
+            ORDER BY id LIMIT ?
+        """, (current_id, partner_id, partner_id, current_id, around_id, limit + 1)).fetchall()]
+        return {'messages': rows + newer[:limit], 'has_newer': len(newer) > limit}
+    # 古い範囲に入るとアーカイブ DB を ATTACH して読み進める
+    rows = fetch_conversation_page(conn, current_id, partner_id, before_id, limit)
     return {'messages': rows}
 
 
-@app.route('/chat/mark_read/<int:partner_id>', methods=['POST'])
+CHAT_SEARCH_MAX_RESULTS = 50
+SNIPPET_OPEN, SNIPPET_CLOSE = '\ue000', '\ue001'
+
+
+_messages_fts_paths = {}
+
+
+def messages_fts_available(conn):
+    """DB に全文検索索引があるか (ワーカー内で DB ごとに一度だけ確かめる)"""
+    if DB_PATH not in _messages_fts_paths:
+        _messages_fts_paths[DB_PATH] = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        ).fetchone() is not None
+    return _messages_fts_paths[DB_PATH]
+
+
+def search_conversation(conn, user_a, user_b, query, limit):
+    """2人の会話を全文検索し、関連度順に (id, sender_id, timestamp, snippet) を返す
+
+    索引は全会話で共通なので、一致の列挙を会話の ID 範囲に絞ってから2人の行だけを残す。
+    trigram は3文字未満の語を索引で引けないため、その場合と索引がない DB では
+    会話内を LIKE で新しい順に探す。snippet は HTML エスケープ済みで、一致箇所を <mark> で囲む。
+    """
+    terms = query.split()
+    pair = "((m.sender_id = ? AND m.recipient_id = ?) OR (m.sender_id = ? AND m.recipient_id = ?))"
+    params = [user_a, user_b, user_b, user_a]
+    if all(len(term) >= 3 for term in terms) and messages_fts_available(conn):
+        first_id, last_id = conn.execute(
+            f"SELECT min(m.id), max(m.id) FROM messages m WHERE {pair}", params
+        ).fetchone()
+        if first_id is None:
+            return []
+        match = ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+        rows = conn.execute(f"""
+            SELECT m.id, m.sender_id, m.timestamp,
+                   snippet(messages_fts, 0, ?, ?, '…', 16) AS snippet
+            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ? AND messages_fts.rowid BETWEEN ? AND ? AND {pair}
+            ORDER BY rank LIMIT ?
+        """, [SNIPPET_OPEN, SNIPPET_CLOSE, match, first_id, last_id, *params, limit]).fetchall()
+    else:
+        likes = ' AND '.join("m.message LIKE ? ESCAPE '\\'" for _ in terms)
+        patterns = ['%' + re.sub(r'([%_\\])', r'\\\1', term) + '%' for term in terms]
+        rows = conn.execute(f"""
+            SELECT m.id, m.sender_id, m.timestamp, m.message AS snippet FROM messages m
+            WHERE {pair} AND {likes}
+            ORDER BY m.id DESC LIMIT ?
+        """, [*params, *patterns, limit]).fetchall()
+        rows = [dict(row, snippet=_mark_terms(row['snippet'], terms)) for row in rows]
+    return [
+        dict(row, snippet=str(escape(row['snippet'])).replace(SNIPPET_OPEN, '<mark>').replace(SNIPPET_CLOSE, '</mark>'))
+        for row in rows
+    ]
+
+
+def _mark_terms(text, terms):
+    pattern = '|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True))
+    return re.sub(f'({pattern})', lambda m: SNIPPET_OPEN + m.group(1) + SNIPPET_CLOSE, text, flags=re.IGNORECASE)
+
+
+@routes.route('/chat/search/<int:partner_id>')
+@login_required
+def chat_search(partner_id):
+    """会話内のメッセージを検索し、IDと前後を示すスニペットを返す"""
+    current_id = session['user_id']
+    if not can_chat(current_id, partner_id):
+        return {'results': []}, 403
+    query = request.args.get('q', '').strip()
+    if not query:
+        return {'results': []}
+    limit = max(1, min(request.args.get('limit', 20, type=int), CHAT_SEARCH_MAX_RESULTS))
+    return {'results': search_conversation(get_db(), current_id, partner_id, query, limit)}
+
+
+def mark_messages_read(conn, sender_id, recipient_id, now):
+    """未読メッセージを既読にし、既読にしたメッセージIDの一覧を返す"""
+    ids = [r[0] for r in conn.execute(
+        "SELECT id FROM messages WHERE sender_id = ? AND recipient_id = ? AND is_read = 0",
+        (sender_id, recipient_id),
+    )]
+    if ids:
+        conn.execute(
+            "UPDATE messages SET is_read = 1, read_timestamp = ? WHERE sender_id = ? AND recipient_id = ? AND is_read = 0",
+            (now, sender_id, recipient_id),
+        )
+    return ids
+
+
+@routes.route('/chat/mark_read/<int:partner_id>', methods=['POST'])
 @login_required
 def mark_chat_read(partner_id):
     if not can_chat(session['user_id'], partner_id):
@@ -914,71 +3228,58 @@ def mark_chat_read(partner_id):
     if not check_csrf():
         return {'status': 'error'}, 400
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT id FROM messages WHERE sender_id = ? AND recipient_id = ? AND is_read = 0",
-        (partner_id, session['user_id']),
-    )
-    ids = [r['id'] for r in c.fetchall()]
-    c.execute(
-        "UPDATE messages SET is_read = 1, read_timestamp = ? WHERE sender_id = ? AND recipient_id = ? AND is_read = 0",
-        (now, partner_id, session['user_id']),
-    )
-    updated = c.rowcount
-    conn.commit()
+    ids = run_write(mark_messages_read, partner_id, session['user_id'], now)
+    updated = len(ids)
     if updated:
         push_event(partner_id, {"type": "read", "ids": ids})
         push_unread(session['user_id'])
     return {'updated': updated, 'ts': now}
 
 
-@app.route('/chat/unread_count')
+def fetch_chat_partners(conn, user_id, as_admin):
+    """チャット相手の一覧を最終メッセージの新しい順に返す (id, name, unread, preview, last_timestamp, last_sender_id)
+
+    未読件数と最新メッセージは conversations の要約から引くので messages は集計しない。
+    まだやり取りのない相手は名前順で末尾に並ぶ。
+    """
+    managed_col, partner_col = ('admin_id', 'user_id') if as_admin else ('user_id', 'admin_id')
+    return conn.execute(f"""
+        SELECT u.id, u.name,
+               coalesce(CASE WHEN ? < u.id THEN cv.unread_low ELSE cv.unread_high END, 0) AS unread,
+               cv.preview, cv.last_timestamp, cv.last_sender_id
+        FROM admin_managed_users m
+        INNER JOIN users u ON u.id = m.{partner_col}
+        LEFT JOIN conversations cv
+            ON cv.user_low = min(u.id, ?) AND cv.user_high = max(u.id, ?)
+        WHERE m.{managed_col} = ?
+        ORDER BY cv.last_timestamp IS NULL, cv.last_timestamp DESC, u.name
+        """,
+        (user_id, user_id, user_id, user_id),
+    ).fetchall()
+
+
+@routes.route('/chat/unread_count')
 @login_required
 def unread_count_api():
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT COUNT(*) FROM messages WHERE recipient_id = ? AND is_read = 0",
-        (session['user_id'],),
-    )
-    count = c.fetchone()[0]
-    return {'count': count}
+    return {'count': fetch_unread_total(get_db(), session['user_id'])}
 
 
-@app.route('/chat/unread_counts')
+@routes.route('/chat/unread_counts')
 @login_required
 def unread_counts_api():
     user_id = session['user_id']
+    # 管理関係の変更はユーザーキャッシュのスタンプに反映される
+    not_modified = not_modified_response(
+        'unread_counts', bool(session.get('is_admin')), fetch_inbox_version(user_id), _user_cache_stamp()
+    )
+    if not_modified:
+        return not_modified
     conn = get_db()
-    c = conn.cursor()
-    if session.get('is_admin'):
-        c.execute("""
-            SELECT u.id, COUNT(msg.id) AS unread
-            FROM users u
-            INNER JOIN admin_managed_users m ON u.id = m.user_id
-            LEFT JOIN messages msg ON msg.sender_id = u.id AND msg.recipient_id = ? AND msg.is_read = 0
-            WHERE m.admin_id = ?
-            GROUP BY u.id
-            """,
-            (user_id, user_id),
-        )
-    else:
-        c.execute("""
-            SELECT u.id, COUNT(msg.id) AS unread
-            FROM users u
-            INNER JOIN admin_managed_users m ON u.id = m.admin_id
-            LEFT JOIN messages msg ON msg.sender_id = u.id AND msg.recipient_id = ? AND msg.is_read = 0
-            WHERE m.user_id = ?
-            GROUP BY u.id
-            """,
-            (user_id, user_id),
-        )
-    rows = c.fetchall()
+    rows = fetch_chat_partners(conn, user_id, as_admin=bool(session.get('is_admin')))
     return {row['id']: row['unread'] for row in rows}
 
 
-@app.route('/events')
+@routes.route('/events')
 @login_required
 def sse_events():
     user_id = session['user_id']
@@ -1009,60 +3310,36 @@ def sse_events():
     )
 
 
-@app.route('/my/chat')
+@routes.route('/my/chat')
 @login_required
 def my_chat():
     if session.get('is_admin'):
         return redirect(url_for('admin_chat_index'))
     user_id = session['user_id']
     conn = get_db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT u.id, u.name, COUNT(msg.id) AS unread
-        FROM users u
-        INNER JOIN admin_managed_users m ON u.id = m.admin_id
-        LEFT JOIN messages msg ON msg.sender_id = u.id AND msg.recipient_id = ? AND msg.is_read = 0
-        WHERE m.user_id = ?
-        GROUP BY u.id, u.name
-        ORDER BY u.name
-        """,
-        (user_id, user_id),
-    )
-    admins = c.fetchall()
+    admins = fetch_chat_partners(conn, user_id, as_admin=False)
     if not admins:
         return 'チャット可能な管理者が設定されていません'
     return render_template('chat_list.html', users=admins, as_admin=False)
 
 
-@app.route('/admin/chat')
+@routes.route('/admin/chat')
 @admin_required
 def admin_chat_index():
     admin_id = session['user_id']
     conn = get_db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT u.id, u.name, COUNT(msg.id) AS unread
-        FROM users u
-        INNER JOIN admin_managed_users m ON u.id = m.user_id
-        LEFT JOIN messages msg ON msg.sender_id = u.id AND msg.recipient_id = ? AND msg.is_read = 0
-        WHERE m.admin_id = ?
-        GROUP BY u.id, u.name
-        ORDER BY u.name
-        """,
-        (admin_id, admin_id),
-    )
-    users = c.fetchall()
+    users = fetch_chat_partners(conn, admin_id, as_admin=True)
     return render_template('chat_list.html', users=users, as_admin=True)
 
 
-@app.route('/admin/chat/<int:user_id>')
+@routes.route('/admin/chat/<int:user_id>')
 @admin_required
 def admin_chat(user_id):
     if not can_chat(session['user_id'], user_id):
         return 'アクセス拒否'
     return redirect(url_for('chat', partner_id=user_id))
 
-@app.route('/admin/export', methods=['GET', 'POST'])
+@routes.route('/admin/export', methods=['GET', 'POST'])
 @admin_required
 def export_combined():
     admin_id = session['user_id']
@@ -1078,44 +3355,66 @@ def export_combined():
     now = datetime.now()
     years = list(range(now.year - 3, now.year + 2))
     if request.method == 'POST':
-        delete_old_exports(EXPORT_DIR)
         if not check_csrf():
             return redirect(url_for('export_combined'))
         year = int(request.form['year'])
         month = int(request.form['month'])
         if request.form['action'] == 'single_user':
             user_id = int(request.form['user_id'])
-            conn = get_db()
-            c = conn.cursor()
-            c.execute("SELECT name FROM users WHERE id = ?", (user_id,))
-            row = c.fetchone()
-            if not row:
-                return 'ユーザーが見つかりません'
-            name = row['name']
-            export_subdir = os.path.join(EXPORT_DIR, f"{year}", f"{month:02d}")
-            os.makedirs(export_subdir, exist_ok=True)
-            csv_path = generate_csv(user_id, name, year, month, export_subdir, fetch_overtime_threshold(user_id))
+            with read_snapshot(attendance_years=(year,)) as snapshot:
+                row = snapshot.execute(
+                    "SELECT name, overtime_threshold FROM users WHERE id = ?", (user_id,)
+                ).fetchone()
+                if not row:
+                    return 'ユーザーが見つかりません'
+                export_subdir = os.path.join(EXPORT_DIR, f"{year}", f"{month:02d}")
+                os.makedirs(export_subdir, exist_ok=True)
+                csv_path = generate_csv(user_id, row['name'], year, month, export_subdir,
+                                        row['overtime_threshold'] or '18:00', conn=snapshot)
             if not csv_path:
                 flash('該当データがありません。', 'warning')
                 return redirect(url_for('export_combined'))
-            return send_file(csv_path, mimetype='text/csv', as_attachment=True, download_name=os.path.basename(csv_path))
+            run_write(record_export_file, csv_path)
+            return send_export(csv_path, 'text/csv')
         elif request.form['action'] == 'bulk_all':
-            with tempfile.TemporaryDirectory() as temp_dir:
-                zip_path = os.path.join(temp_dir, f"勤怠記録_{year}_{month:02d}.zip")
-                any_file = False
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for user_id, name in user_list:
-                        csv_file = generate_csv(user_id, name, year, month, temp_dir, fetch_overtime_threshold(user_id))
-                        if csv_file:
-                            zipf.write(csv_file, os.path.basename(csv_file))
-                            any_file = True
-                if not any_file:
-                    flash('該当データがありません。', 'warning')
-                    return redirect(url_for('export_combined'))
-                return send_file(zip_path, mimetype='application/zip', as_attachment=True, download_name=f"勤怠記録_{year}_{month:02d}.zip")
+            # ZIP は exports/ に残し、プロキシからの送信や再ダウンロードに使う (古いものは掃除スレッドが削除)
+            export_subdir = os.path.join(EXPORT_DIR, f"{year}", f"{month:02d}")
+            os.makedirs(export_subdir, exist_ok=True)
+            zip_name = f"勤怠記録_{year}_{month:02d}_{admin_id}.zip"
+            zip_path = os.path.join(export_subdir, zip_name)
+            partial_path = os.path.join(export_subdir, f".{zip_name}.{secrets.token_hex(4)}.tmp")
+            try:
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    any_file = False
+                    # 全員分を同じ時点のスナップショットから出力する
+                    with read_snapshot(attendance_years=(year,)) as snapshot, zipfile.ZipFile(partial_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                        users = snapshot.execute("""
+                            SELECT u.id, u.name, u.overtime_threshold FROM users u
+                            INNER JOIN admin_managed_users m ON u.id = m.user_id
+                            WHERE m.admin_id = ?
+                            ORDER BY u.name
+                        """, (admin_id,)).fetchall()
+                        for user_id, name, overtime_threshold in users:
+                            csv_file = generate_csv(user_id, name, year, month, temp_dir,
+                                                    overtime_threshold or '18:00', conn=snapshot)
+                            if csv_file:
+                                zipf.write(csv_file, os.path.basename(csv_file))
+                                any_file = True
+            except BaseException:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                raise
+            if not any_file:
+                os.remove(partial_path)
+                flash('該当データがありません。', 'warning')
+                return redirect(url_for('export_combined'))
+            # 書き終えてから置き換え、送信中の古い ZIP や他の要求に書きかけを見せない
+            os.replace(partial_path, zip_path)
+            run_write(record_export_file, zip_path)
+            return send_export(zip_path, 'application/zip', download_name=f"勤怠記録_{year}_{month:02d}.zip")
     return render_template('export.html', user_list=user_list, now=now, years=years)
 
-@app.route('/admin/users')
+@routes.route('/admin/users')
 @admin_required
 def list_users():
     admin_id = session['user_id']
@@ -1131,7 +3430,13 @@ def list_users():
     ]
     return render_template('admin_users.html', users=users)
 
-@app.route('/admin/users/create', methods=['GET', 'POST'])
+def insert_user(conn, name, email, password_hash, is_admin):
+    """ユーザーを1人追加し、登録通知メールを送信キューに積んだかを返す"""
+    conn.execute("INSERT INTO users (name, email, password_hash, is_admin, is_superadmin) VALUES (?, ?, ?, ?, 0)",
+                 (name, email, password_hash, is_admin))
+    return send_registration_email(email, name, conn)
+
+@routes.route('/admin/users/create', methods=['GET', 'POST'])
 @admin_required
 def create_user():
     errors = {}
@@ -1158,14 +3463,12 @@ def create_user():
         if errors:
             return render_template('create_user.html', errors=errors)
 
-        password_hash = generate_password_hash(password)
-        conn = get_db()
-        c = conn.cursor()
+        password_hash = hash_password(password)
         try:
-            c.execute("INSERT INTO users (name, email, password_hash, is_admin, is_superadmin) VALUES (?, ?, ?, ?, 0)",
-                      (name, email, password_hash, is_admin))
-            conn.commit()
-            send_registration_email(email, name)
+            queued = run_write(insert_user, name, email, password_hash, is_admin)
+            invalidate_user_cache()
+            if queued:
+                notify_mail_worker()
         except sqlite3.IntegrityError:
             errors['email'] = "このメールアドレスはすでに登録されています。"
             return render_template('create_user.html', errors=errors)
@@ -1173,7 +3476,118 @@ def create_user():
         return redirect_embedded('list_users')
     return render_template('create_user.html', errors=errors)
 
-@app.route('/admin/users/manage', methods=['POST'])
+USER_IMPORT_TRUE_VALUES = {'1', 'true', 'yes', 'y', 'はい', '○'}
+
+def parse_user_import_rows(reader, existing_emails):
+    """ユーザー一括登録CSVを検証し、行ごとの結果リストを返す"""
+    results = []
+    seen = set()
+    for line_no, row in enumerate(reader, start=2):
+        name = (row.get('氏名') or '').strip()
+        email = (row.get('メールアドレス') or '').strip()
+        threshold = (row.get('残業開始時刻') or '').strip() or '18:00'
+        password = (row.get('パスワード') or '').strip()
+        result = {
+            'line': line_no, 'name': name, 'email': email,
+            'is_admin': int((row.get('管理者') or '').strip().lower() in USER_IMPORT_TRUE_VALUES),
+            'overtime_threshold': threshold, 'password': password,
+            'generated': False, 'status': 'error', 'message': '',
+        }
+        if not name:
+            result['message'] = "氏名がありません。"
+        elif not is_valid_email(email):
+            result['message'] = "メールアドレスの形式が正しくありません。"
+        elif email.lower() in existing_emails or email.lower() in seen:
+            result['message'] = "このメールアドレスはすでに登録されています。"
+        elif not is_valid_time(threshold):
+            result['message'] = "残業開始時刻は HH:MM 形式で入力してください。"
+        elif password and len(password) < 8:
+            result['message'] = "パスワードは8文字以上で入力してください。"
+        else:
+            if not password:
+                result['password'] = secrets.token_urlsafe(9)
+                result['generated'] = True
+            result['status'] = 'ok'
+            seen.add(email.lower())
+        results.append(result)
+    return results
+
+
+def insert_imported_users(conn, admin_id, rows):
+    """検証済みの (行, パスワードハッシュ) を登録して admin_id の管理対象にし、メールを積んだかを返す"""
+    c = conn.cursor()
+    c.executemany(
+        "INSERT INTO users (name, email, password_hash, is_admin, is_superadmin, overtime_threshold)"
+        " VALUES (?, ?, ?, ?, 0, ?)",
+        [(r['name'], r['email'], h, r['is_admin'], r['overtime_threshold']) for r, h in rows],
+    )
+    emails = [r['email'] for r, _ in rows]
+    ids = {}
+    for i in range(0, len(emails), 500):
+        chunk = emails[i:i + 500]
+        c.execute(
+            f"SELECT id, email FROM users WHERE email IN ({','.join('?' * len(chunk))})", chunk
+        )
+        ids.update({row['email']: row['id'] for row in c.fetchall()})
+    c.executemany(
+        "INSERT OR IGNORE INTO admin_managed_users (admin_id, user_id) VALUES (?, ?)",
+        [(admin_id, ids[email]) for email in emails],
+    )
+    queued = False
+    for r, _ in rows:
+        queued = send_registration_email(r['email'], r['name'], conn) or queued
+    return queued
+
+
+@routes.route('/admin/users/import', methods=['GET', 'POST'])
+@admin_required
+def import_users():
+    if request.method == 'GET':
+        return render_template('import_users.html', results=None)
+    if not check_csrf():
+        return redirect_embedded('import_users')
+    uploaded_file = request.files.get('file')
+    if not uploaded_file or not allowed_file(uploaded_file.filename):
+        flash("CSVファイルのみアップロードできます。", "danger")
+        return redirect_embedded('import_users')
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT lower(email) FROM users")
+    existing_emails = {row[0] for row in c.fetchall()}
+    try:
+        reader = csv.DictReader(TextIOWrapper(uploaded_file.stream, encoding='utf-8-sig'))
+        results = parse_user_import_rows(reader, existing_emails)
+    except (UnicodeDecodeError, csv.Error):
+        flash("CSVファイルの読み込みに失敗しました。フォーマットを確認してください。", "danger")
+        return redirect_embedded('import_users')
+    valid = [r for r in results if r['status'] == 'ok']
+    if valid:
+        hashes = hash_passwords([r['password'] for r in valid])
+        admin_id = session['user_id']
+        try:
+            queued = run_write(insert_imported_users, admin_id, list(zip(valid, hashes)))
+        except sqlite3.Error:
+            flash("登録中にエラーが発生したため、すべての行を取り消しました。", "danger")
+            return redirect_embedded('import_users')
+        invalidate_user_cache()
+        if queued:
+            notify_mail_worker()
+        for r in valid:
+            r['status'] = 'created'
+        log_audit_event(f'import_users:{len(valid)}', admin_id, session.get('user_name'))
+    for r in results:
+        if not r['generated']:
+            r['password'] = ''
+    flash(f"{len(valid)} 件のユーザーを登録しました。", "success" if valid else "warning")
+    return render_template('import_users.html', results=results)
+
+def replace_managed_users(conn, admin_id, user_ids):
+    """admin_id の管理対象を user_ids で置き換える"""
+    conn.execute("DELETE FROM admin_managed_users WHERE admin_id = ?", (admin_id,))
+    conn.executemany("INSERT INTO admin_managed_users (admin_id, user_id) VALUES (?, ?)",
+                     [(admin_id, user_id) for user_id in user_ids])
+
+@routes.route('/admin/users/manage', methods=['POST'])
 @admin_required
 def update_managed_users():
     if not check_csrf():
@@ -1181,16 +3595,27 @@ def update_managed_users():
     admin_id = session['user_id']
     selected_ids = request.form.getlist('managed_users')
     selected_ids = list(map(int, selected_ids))
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("DELETE FROM admin_managed_users WHERE admin_id = ?", (admin_id,))
-    for user_id in selected_ids:
-        c.execute("INSERT INTO admin_managed_users (admin_id, user_id) VALUES (?, ?)", (admin_id, user_id))
-    conn.commit()
+    run_write(replace_managed_users, admin_id, selected_ids)
+    invalidate_user_cache()
     flash("管理対象を更新しました。", "success")
     return redirect_embedded('list_users')
 
-@app.route('/admin/users/edit/<int:user_id>', methods=['GET', 'POST'])
+def update_user(conn, user_id, name, email, is_admin, overtime_threshold, password_hash=None, badge_hash=None,
+                clear_badge=False):
+    """ユーザー情報を更新する (password_hash・badge_hash が None の項目は据え置き)"""
+    conn.execute("UPDATE users SET name = ?, email = ?, is_admin = ?, overtime_threshold = ? WHERE id = ?",
+                 (name, email, is_admin, overtime_threshold, user_id))
+    if password_hash:
+        conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+    if badge_hash:
+        conn.execute("""
+            INSERT INTO kiosk_badges (token_hash, user_id) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET token_hash = excluded.token_hash
+        """, (badge_hash, user_id))
+    elif clear_badge:
+        conn.execute("DELETE FROM kiosk_badges WHERE user_id = ?", (user_id,))
+
+@routes.route('/admin/users/edit/<int:user_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_user(user_id):
     conn = get_db()
@@ -1210,6 +3635,7 @@ def edit_user(user_id):
         is_admin = 1 if user['is_superadmin'] else int('is_admin' in request.form)
         overtime_threshold = request.form.get('overtime_threshold', '18:00').strip()
         new_password = request.form.get('new_password', '').strip()
+        kiosk_badge = request.form.get('kiosk_badge', '').strip()
 
         if not name:
             errors['name'] = "氏名を入力してください。"
@@ -1220,27 +3646,56 @@ def edit_user(user_id):
         # パスワードは空欄でもOK。入っている場合のみ長さバリデーション
         if new_password and len(new_password) < 8:
             errors['new_password'] = "パスワードは8文字以上で入力してください。"
+        if kiosk_badge:
+            c.execute("SELECT user_id FROM kiosk_badges WHERE token_hash = ?", (hash_badge(kiosk_badge),))
+            owner = c.fetchone()
+            if len(kiosk_badge) < 4:
+                errors['kiosk_badge'] = "バッジ/PINは4文字以上で入力してください。"
+            elif owner and owner['user_id'] != user_id:
+                errors['kiosk_badge'] = "このバッジ/PINは他のユーザーに登録されています。"
 
         if errors:
-            return render_template('edit_user.html', user_id=user_id, user=user, errors=errors)
+            return render_template('edit_user.html', user_id=user_id, user=user, errors=errors,
+                                   has_badge=has_kiosk_badge(user_id))
 
+        password_hash = hash_password(new_password) if new_password else None
+        badge_hash = hash_badge(kiosk_badge) if kiosk_badge else None
         try:
-            c.execute("UPDATE users SET name = ?, email = ?, is_admin = ?, overtime_threshold = ? WHERE id = ?",
-                      (name, email, is_admin, overtime_threshold, user_id))
-            if new_password:
-                password_hash = generate_password_hash(new_password)
-                c.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+            run_write(update_user, user_id, name, email, is_admin, overtime_threshold, password_hash,
+                      badge_hash, 'clear_kiosk_badge' in request.form)
+            invalidate_user_cache()
+            if password_hash:
                 flash("パスワードを更新しました。", "success")
-            conn.commit()
             flash("ユーザー情報を更新しました。", "success")
         except sqlite3.IntegrityError:
             errors['email'] = "このメールアドレスは既に登録されています。"
-            return render_template('edit_user.html', user_id=user_id, user=user, errors=errors)
+            return render_template('edit_user.html', user_id=user_id, user=user, errors=errors,
+                                   has_badge=has_kiosk_badge(user_id))
         return redirect_embedded('list_users')
 
-    return render_template('edit_user.html', user_id=user_id, user=user, errors=errors)
+    return render_template('edit_user.html', user_id=user_id, user=user, errors=errors,
+                           has_badge=has_kiosk_badge(user_id))
+
+
+def has_kiosk_badge(user_id):
+    c = get_db().cursor()
+    c.execute("SELECT 1 FROM kiosk_badges WHERE user_id = ?", (user_id,))
+    return c.fetchone() is not None
+
+def delete_user_rows(conn, user_id):
+    """ユーザーとそのメッセージ・会話の要約・バッジを削除する"""
+    conn.execute(
+        "DELETE FROM messages WHERE sender_id = ? OR recipient_id = ?",
+        (user_id, user_id),
+    )
+    conn.execute(
+        "DELETE FROM conversations WHERE user_low = ? OR user_high = ?",
+        (user_id, user_id),
+    )
+    conn.execute("DELETE FROM kiosk_badges WHERE user_id = ?", (user_id,))
+    conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
 
-@app.route('/admin/users/delete/<int:user_id>', methods=['GET', 'POST'])
+@routes.route('/admin/users/delete/<int:user_id>', methods=['GET', 'POST'])
 @admin_required
 def delete_user(user_id):
     conn = get_db()
@@ -1260,19 +3715,16 @@ def delete_user(user_id):
         if user['is_superadmin']:
             flash("スーパー管理者は削除できません。", "danger")
             return redirect_embedded('list_users')
-        c.execute(
-            "DELETE FROM messages WHERE sender_id = ? OR recipient_id = ?",
-            (user_id, user_id),
-        )
-        c.execute("DELETE FROM users WHERE id = ?", (user_id,))
-        conn.commit()
+        run_write(delete_user_rows, user_id)
+        purge_user_archives(user_id)
+        invalidate_user_cache()
         flash("ユーザーを削除しました。", "success")
         return redirect_embedded('list_users')
 
     return render_template('confirm_delete_user.html', user=user)
 
 
-@app.route('/admin/mail_settings', methods=['GET', 'POST'])
+@routes.route('/admin/mail_settings', methods=['GET', 'POST'])
 @superadmin_required
 def mail_settings():
     errors = {}
@@ -1293,14 +3745,21 @@ def mail_settings():
             errors['port'] = 'ポート番号を入力してください。'
         if errors:
             settings.update(request.form)
-            return render_template('mail_settings.html', settings=settings, errors=errors)
+            return render_template('mail_settings.html', settings=settings, errors=errors, outbox=[])
         save_mail_settings(server, int(port), username, password, use_tls, subject_tmpl, body_tmpl)
+        notify_mail_worker()
         flash('メール設定を更新しました。', 'success')
         return redirect_embedded('mail_settings')
-    return render_template('mail_settings.html', settings=settings, errors=errors)
+    c = get_db().cursor()
+    c.execute(
+        "SELECT to_email, subject, status, attempts, last_error, created_at, sent_at"
+        " FROM mail_outbox ORDER BY id DESC LIMIT 20"
+    )
+    outbox = c.fetchall()
+    return render_template('mail_settings.html', settings=settings, errors=errors, outbox=outbox)
 
 
-@app.route('/admin/audit_log')
+@routes.route('/admin/audit_log')
 @superadmin_required
 def view_audit_log():
     if os.path.exists(AUDIT_LOG_PATH):
@@ -1313,7 +3772,7 @@ def view_audit_log():
     return render_template('audit_log.html', log_text=log_text)
 
 
-@app.route('/admin/audit_log/download')
+@routes.route('/admin/audit_log/download')
 @superadmin_required
 def download_audit_log():
     if not os.path.exists(AUDIT_LOG_PATH):
@@ -1326,68 +3785,66 @@ def download_audit_log():
     )
 
 
-@app.route('/admin/update', methods=['GET', 'POST'])
+@routes.route('/admin/update', methods=['GET', 'POST'])
 @superadmin_required
 def update_system():
-    local, remote = get_git_commits()
-    error = None
-    update_available = False
-    critical_changes = False
-    changed_files = []
-    if local is None:
-        error = 'Gitリポジリではありません。'
-    elif remote is None:
-        error = 'リモートリポジリが設定されていません。'
-    else:
-        update_available = local != remote
-        if update_available:
-            files = get_changed_files() or []
-            changed_files = files
-            for f in files:
-                if f.startswith('database/') or f == '.env.example':
-                    critical_changes = True
-                    break
     if request.method == 'POST':
         if not check_csrf():
             return redirect_embedded('update_system')
-        if critical_changes:
+        if request.form.get('action') == 'check':
+            refresh_update_status_async(session['user_id'], force=True)
+            return redirect_embedded('update_system')
+        # 実行直前は重要ファイルの変更有無を最新の状態で確かめる
+        status = check_for_updates(force=True)
+        if status['critical_changes']:
             flash('重要なファイルが変更されているため自動アップデートできません。', 'danger')
             return render_template(
                 'update.html',
-                local_commit=local,
-                remote_commit=remote,
+                local_commit=status['local'],
+                remote_commit=status['remote'],
                 update_available=True,
                 critical_changes=True,
-                changed_files=changed_files,
+                changed_files=status['changed_files'],
                 error=None,
+                checked_at=status['checked_at'],
             )
         message = perform_git_pull()
+        refresh_update_status_async()
         flash('アップデートを実行しました。サーバーを再起動してください。', 'success')
         return render_template(
             'update.html',
-            local_commit=local,
-            remote_commit=remote,
+            local_commit=status['local'],
+            remote_commit=status['remote'],
             update_available=False,
             error=None,
             message=message,
+            checked_at=status['checked_at'],
         )
+    status = get_update_status()
+    if status['checked_at'] is None:
+        refresh_update_status_async(session['user_id'])
+        status = get_update_status()
     return render_template(
         'update.html',
-        local_commit=local,
-        remote_commit=remote,
-        update_available=update_available,
-        critical_changes=critical_changes,
-        changed_files=changed_files,
-        error=error,
+        local_commit=status['local'],
+        remote_commit=status['remote'],
+        update_available=bool(status['remote'] and status['local'] != status['remote']),
+        critical_changes=status['critical_changes'],
+        changed_files=status['changed_files'],
+        error=status['error'],
+        checked_at=status['checked_at'],
+        checking=status['checking'],
     )
 
-@app.route('/setup', methods=['GET', 'POST'])
+def create_superadmin(conn, email, name, password_hash):
+    """初回セットアップのスーパー管理者を作り、セットアップ完了を記録する"""
+    conn.execute("INSERT INTO users (email, name, password_hash, is_admin, is_superadmin) VALUES (?, ?, ?, 1, 1)",
+                 (email, name, password_hash))
+    mark_setup_completed(conn)
+
+@routes.route('/setup', methods=['GET', 'POST'])
 def setup():
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM users")
-    count = c.fetchone()[0]
-    if count > 0:
+    if is_setup_completed():
         return redirect(url_for('login'))
     if request.method == 'POST':
         if not check_csrf():
@@ -1411,12 +3868,129 @@ def setup():
             for msg in errors:
                 flash(msg, "danger")
             return redirect(url_for('setup'))
-        password_hash = generate_password_hash(password)
-        c.execute("INSERT INTO users (email, name, password_hash, is_admin, is_superadmin) VALUES (?, ?, ?, 1, 1)",(email, name, password_hash))
-        conn.commit()
+        password_hash = hash_password(password)
+        run_write(create_superadmin, email, name, password_hash)
+        _setup_completed.add(DB_PATH)
+        invalidate_user_cache()
         return redirect(url_for('login'))
     return render_template('setup.html')
 
+class LazyBytecodeCache(FileSystemBytecodeCache):
+    """保存先ディレクトリを最初の書き込み時に作る FileSystemBytecodeCache
+
+    キャッシュの中身はそのままコードとして実行されるので、自分が所有し
+    他のユーザーが書き込めないディレクトリでなければ読み書きしない。
+    """
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self._trusted = None
+
+    def _directory_trusted(self, create=False):
+        if self._trusted is not None:
+            return self._trusted
+        try:
+            if create:
+                os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            st = os.lstat(self.directory)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logger.warning("テンプレートキャッシュを使えません: %s", e)
+            self._trusted = False
+            return False
+        trusted = (
+            stat.S_ISDIR(st.st_mode)
+            and st.st_uid == os.getuid()
+            and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+        )
+        if not trusted:
+            logger.warning(
+                "テンプレートキャッシュ %s は所有者または権限が不正なため使いません", self.directory
+            )
+        self._trusted = trusted
+        return trusted
+
+    def load_bytecode(self, bucket):
+        if self._directory_trusted():
+            super().load_bytecode(bucket)
+
+    def dump_bytecode(self, bucket):
+        if self._directory_trusted(create=True):
+            super().dump_bytecode(bucket)
+
+
+STARTUP_TIMINGS = {}
+
+
+def create_app(config=None):
+    """Flask アプリケーションを生成する
+
+    ログのファイルハンドラ以外の資源 (DB のマイグレーション、出力先ディレクトリ、
+    テンプレートのコンパイル) は最初に使われた時点で用意する。
+    config には SECRET_KEY や TESTING などの Flask 設定を渡せる。
+    """
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.secret_key = os.environ.get('SECRET_KEY', 'your_secret_key_here')  # 本番は環境変数
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 10 * 1024 * 1024))
+    app.permanent_session_lifetime = timedelta(
+        days=int(os.environ.get('SESSION_LIFETIME_DAYS', 7))
+    )
+    app.config['JINJA_CACHE_DIR'] = JINJA_CACHE_DIR
+    app.config['LOG_DIR'] = LOG_DIR
+    app.config.update(config or {})
+    if not app.secret_key or app.secret_key == 'your_secret_key_here':
+        raise RuntimeError("SECRET_KEYを環境変数で必ず設定してください")
+
+    configure_logging(app.config['LOG_DIR'])
+    if app.config['JINJA_CACHE_DIR']:
+        app.jinja_options = dict(
+            app.jinja_options, bytecode_cache=LazyBytecodeCache(app.config['JINJA_CACHE_DIR'])
+        )
+    routes.register(app)
+    app.add_template_global(generate_csrf_token, 'csrf_token')
+    app.add_template_global(asset_url)
+    before_render_template.connect(_template_render_started, app)
+    template_rendered.connect(_template_render_finished, app)
+
+    timings = app.extensions['startup'] = {
+        'import_ms': STARTUP_TIMINGS.get('import_ms'),
+        'create_app_ms': round((time.perf_counter() - started) * 1000, 2),
+        'first_request_ms': None,
+    }
+
+    @app.after_request
+    def record_first_request(response):
+        # コールドスタートの指標として最初のリクエスト (テンプレートのコンパイル等を含む) の時間を残す
+        if timings['first_request_ms'] is None and 'start_time' in g:
+            timings['first_request_ms'] = round((time.perf_counter() - g.start_time) * 1000, 2)
+            logger.info(f"起動時間: {timings}")
+        return response
+
+    return app
+
+
+_default_app = None
+
+
+def get_default_app():
+    """モジュール属性 app として公開する既定のアプリケーションを返す (初回に生成)"""
+    global _default_app, app
+    if _default_app is None:
+        _default_app = app = create_app()
+    return _default_app
+
+
+def __getattr__(name):
+    # `from app import app` や gunicorn の app:app は初回アクセス時にアプリを生成する
+    if name == 'app':
+        return get_default_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+STARTUP_TIMINGS['import_ms'] = round((time.perf_counter() - IMPORT_STARTED) * 1000, 2)
+
 if __name__ == '__main__':
     import argparse
 
@@ -1424,13 +3998,18 @@ if __name__ == '__main__':
     parser.add_argument(
         '--clear-audit-log', action='store_true',
         help='監査ログをクリアして終了')
+    parser.add_argument(
+        '--archive', action='store_true',
+        help='締めた年の勤怠と古い既読メッセージをアーカイブして終了')
     args = parser.parse_args()
 
     if args.clear_audit_log:
         clear_audit_log()
         print('Audit log cleared.')
+    elif args.archive:
+        print(json.dumps(archive_old_data()))
     else:
         debug_env = os.environ.get('FLASK_DEBUG', '0')
         debug_mode = str(debug_env).lower() in ('1', 'true', 'yes')
         # 開発サーバーでもSSEを扱えるようスレッドモードを有効化
-        app.run(host='0.0.0.0', port=8000, debug=debug_mode, threaded=True)
+        create_app().run(host='0.0.0.0', port=8000, debug=debug_mode, threaded=True)
@@ -0,0 +1,112 @@
+"""ベンチマーク用の合成データ生成
+
+同じ seed からは常に同じデータベースが生成される。
+
+    python -m benchmarks.datagen --db /tmp/bench.db --users 200 --years 2
+"""
+import argparse
+import random
+import sqlite3
+from datetime import date, datetime, timedelta
+
+ADMIN_PASSWORD_HASH = 'benchmark'  # ベンチマークはセッションを直接作るのでログインしない
+
+
+def generate(db_path, users=50, years=1, messages=30, admins=3, seed=1, end=date(2024, 12, 31)):
+    """users 人 × years 年分の勤怠と、管理者ごとの管理対象・チャットを生成する
+
+    スキーマは作成済みであること (app.initialize_database)。生成したIDを辞書で返す。
+    """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    admin_ids = []
+    for i in range(admins):
+        admin_ids.append(conn.execute(
+            "INSERT INTO users (email, name, password_hash, is_admin, is_superadmin) VALUES (?, ?, ?, 1, ?)",
+            (f'admin{i}@example.com', f'管理者{i:02d}', ADMIN_PASSWORD_HASH, int(i == 0)),
+        ).lastrowid)
+    user_ids = []
+    for i in range(users):
+        threshold = rng.choice(['17:30', '18:00', '18:00', '18:30'])
+        user_ids.append(conn.execute(
+            "INSERT INTO users (email, name, password_hash, overtime_threshold) VALUES (?, ?, ?, ?)",
+            (f'user{i}@example.com', f'社員{i:04d}', ADMIN_PASSWORD_HASH, threshold),
+        ).lastrowid)
+
+    # 管理者は全員を担当し、一般ユーザーは先頭の管理者にも必ず所属する
+    managed = {admin_id: [] for admin_id in admin_ids}
+    for n, user_id in enumerate(user_ids):
+        owners = {admin_ids[0], admin_ids[n % len(admin_ids)]}
+        for admin_id in owners:
+            managed[admin_id].append(user_id)
+    conn.executemany(
+        "INSERT INTO admin_managed_users (admin_id, user_id) VALUES (?, ?)",
+        [(admin_id, user_id) for admin_id, ids in managed.items() for user_id in ids],
+    )
+
+    start = end - timedelta(days=365 * years - 1)
+    days = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+    workdays = [d for d in days if d.weekday() < 5]
+    for user_id in user_ids:
+        rows = []
+        for d in workdays:
+            if rng.random() < 0.05:
+                continue  # 休暇
+            in_at = datetime(d.year, d.month, d.day, 8, 30) + timedelta(minutes=rng.randint(0, 60))
+            out_at = datetime(d.year, d.month, d.day, 17, 30) + timedelta(minutes=rng.randint(0, 180))
+            day = d.year * 10000 + d.month * 100 + d.day
+            rows.append((user_id, in_at.strftime('%Y-%m-%dT%H:%M:%S'), 'in', '',
+                         day, in_at.hour * 60 + in_at.minute))
+            rows.append((user_id, out_at.strftime('%Y-%m-%dT%H:%M:%S'), 'out', rng.choice(['資料作成', '会議', '客先対応', '']),
+                         day, out_at.hour * 60 + out_at.minute))
+        conn.executemany(
+            "INSERT INTO attendance (user_id, timestamp, type, description, day, minute) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    base = datetime(end.year, end.month, end.day, 9, 0)
+    for admin_id, ids in managed.items():
+        for user_id in ids:
+            rows = []
+            for n in range(messages):
+                sender, recipient = (admin_id, user_id) if n % 2 else (user_id, admin_id)
+                ts = base - timedelta(minutes=(messages - n) * 7)
+                unread = n >= messages - 3
+                rows.append((
+                    sender, recipient, f'メッセージ {n}', ts.strftime('%Y-%m-%d %H:%M:%S'),
+                    0 if unread else 1, None if unread else ts.strftime('%Y-%m-%d %H:%M:%S'),
+                ))
+            conn.executemany(
+                "INSERT INTO messages (sender_id, recipient_id, message, timestamp, is_read, read_timestamp)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+    conn.execute(
+        "INSERT OR REPLACE INTO app_settings (key, value) VALUES ('setup_completed', ?)",
+        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),),
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return {'admin_ids': admin_ids, 'user_ids': user_ids, 'managed': managed, 'end': end}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--messages', type=int, default=30)
+    parser.add_argument('--admins', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    from benchmarks.run import load_app
+    app_module = load_app(args.db)
+    app_module.initialize_database()
+    info = generate(args.db, args.users, args.years, args.messages, args.admins, args.seed)
+    print(f"{args.db}: {len(info['user_ids'])} users, {len(info['admin_ids'])} admins")
+
+
+if __name__ == '__main__':
+    main()
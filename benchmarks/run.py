@@ -0,0 +1,239 @@
+"""主要エンドポイントのベンチマーク
+
+合成データのDBを生成し、Flask のテストクライアントで実際のエンドポイントを
+繰り返し呼び出して所要時間とSQL実行回数を JSON に保存する。
+
+    python -m benchmarks.run --users 200 --years 2 --output bench.json
+    python -m benchmarks.run --compare bench.json   # 前回結果との比較
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.datagen import generate
+
+
+def load_app(db_path, export_dir=None):
+    """app モジュールを読み込み、ベンチマーク用のDBを向ける"""
+    os.environ.setdefault('SECRET_KEY', 'benchmark-secret')
+    import app as app_module
+    app_module.app.config['TESTING'] = True
+    app_module.DB_PATH = db_path
+    if export_dir:
+        app_module.EXPORT_DIR = export_dir
+    app_module.invalidate_user_cache()
+    # リクエストごとのログ出力は計測の邪魔になるので抑える
+    logging.getLogger('app').setLevel(logging.WARNING)
+    app_module.app.logger.setLevel(logging.WARNING)
+    return app_module
+
+
+def login(client, user_id, is_admin=False):
+    with client.session_transaction() as sess:
+        sess.clear()
+        sess['user_id'] = user_id
+        sess['user_name'] = f'user{user_id}'
+        sess['is_admin'] = is_admin
+        sess['is_superadmin'] = False
+        sess['_csrf_token'] = 'bench'
+
+
+def expect(resp, *statuses):
+    resp.get_data()
+    if resp.status_code not in statuses:
+        raise RuntimeError(f"unexpected status {resp.status_code}")
+    return resp
+
+
+def build_scenarios(info):
+    """(名前, 利用者ID, 管理者か, 1回分のリクエストを送る関数) の一覧"""
+    admin_id = info['admin_ids'][0]
+    user_id = info['user_ids'][0]
+    end = info['end']
+    counter = {'n': 0}
+
+    def next_n():
+        counter['n'] += 1
+        return counter['n']
+
+    def punch(client):
+        # 過去データと重ならない日付に打刻して毎回 INSERT まで通す
+        day = end + timedelta(days=next_n())
+        expect(client.post('/punch', data={
+            '_csrf_token': 'bench', 'timestamp': f'{day.isoformat()}T09:00', 'type': 'in',
+        }), 302)
+
+    def view_my_logs(client):
+        expect(client.get('/my/logs'), 200)
+
+    def import_csv(client):
+        year = end.year + 10 + next_n()
+        lines = ['日付,出勤時刻,退勤時刻,業務内容']
+        for day in range(1, 29):
+            lines.append(f'{year}/01/{day:02d},09:00,18:00,作業')
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        expect(client.post('/my/import', data={
+            '_csrf_token': 'bench', 'file': (io.BytesIO(body), 'import.csv'),
+        }, content_type='multipart/form-data'), 302)
+
+    def export_single(client):
+        expect(client.post('/admin/export', data={
+            '_csrf_token': 'bench', 'action': 'single_user', 'user_id': user_id,
+            'year': end.year, 'month': end.month,
+        }), 200)
+
+    def export_bulk(client):
+        expect(client.post('/admin/export', data={
+            '_csrf_token': 'bench', 'action': 'bulk_all', 'year': end.year, 'month': end.month,
+        }), 200)
+
+    def chat(client):
+        expect(client.get(f'/chat/{user_id}'), 200)
+
+    def chat_send(client):
+        expect(client.post(f'/chat/{user_id}', data={
+            '_csrf_token': 'bench', 'message': f'ベンチマーク {next_n()}',
+        }), 302)
+
+    def chat_history(client):
+        expect(client.get(f'/chat/history/{user_id}?limit=20'), 200)
+
+    def unread_counts_api(client):
+        expect(client.get('/chat/unread_counts'), 200)
+
+    return [
+        ('punch', user_id, False, punch),
+        ('view_my_logs', user_id, False, view_my_logs),
+        ('import_csv', user_id, False, import_csv),
+        ('export_combined_single', admin_id, True, export_single),
+        ('export_combined_bulk', admin_id, True, export_bulk),
+        ('chat', admin_id, True, chat),
+        ('chat_send', admin_id, True, chat_send),
+        ('chat_history', admin_id, True, chat_history),
+        ('unread_counts_api', admin_id, True, unread_counts_api),
+    ]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def measure(app_module, scenarios, repeat, only=None):
+    results = {}
+    for name, session_user, is_admin, func in scenarios:
+        if only and name not in only:
+            continue
+        with app_module.app.test_client() as client:
+            login(client, session_user, is_admin)
+            func(client)  # ウォームアップ
+            # SQL の回数は EXPLAIN を伴うので計測とは別の1回で数える
+            with app_module.record_queries() as queries:
+                func(client)
+            durations = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                func(client)
+                durations.append((time.perf_counter() - started) * 1000)
+        results[name] = {
+            'runs': repeat,
+            'queries': len(queries),
+            'mean_ms': round(statistics.mean(durations), 3),
+            'median_ms': round(statistics.median(durations), 3),
+            'p95_ms': round(percentile(durations, 95), 3),
+            'min_ms': round(min(durations), 3),
+            'max_ms': round(max(durations), 3),
+        }
+        print(f"{name:<24} median {results[name]['median_ms']:>9.3f}ms  "
+              f"p95 {results[name]['p95_ms']:>9.3f}ms  queries {len(queries)}")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(baseline, current, threshold):
+    """中央値を前回結果と比べて表示し、閾値 (%) を超えて遅くなった項目名を返す"""
+    regressions = []
+    print(f"\n{'scenario':<24} {'before':>10} {'after':>10} {'change':>8}")
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if not before:
+            print(f"{name:<24} {'-':>10} {result['median_ms']:>10.3f} {'new':>8}")
+            continue
+        change = (result['median_ms'] - before['median_ms']) / before['median_ms'] * 100
+        print(f"{name:<24} {before['median_ms']:>10.3f} {result['median_ms']:>10.3f} {change:>+7.1f}%")
+        if threshold is not None and change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--messages', type=int, default=30)
+    parser.add_argument('--admins', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--only', action='append', help='指定したシナリオだけ実行する (複数可)')
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    parser.add_argument('--compare', help='比較対象の過去の結果 JSON')
+    parser.add_argument('--fail-over', type=float, help='比較で中央値がこの割合 (%%) 以上遅くなったら終了コード 1')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_path = os.path.join(work_dir, 'bench.db')
+        app_module = load_app(db_path, os.path.join(work_dir, 'exports'))
+        app_module.initialize_database()
+        started = time.perf_counter()
+        info = generate(db_path, args.users, args.years, args.messages, args.admins, args.seed)
+        print(f"generated data in {time.perf_counter() - started:.1f}s")
+        results = measure(app_module, build_scenarios(info), args.repeat, args.only)
+
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'params': {k: getattr(args, k) for k in ('users', 'years', 'messages', 'admins', 'seed', 'repeat')},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('params') != report['meta']['params']:
+            print("warning: 前回とデータ量・繰り返し回数が異なります")
+        if compare(baseline, report, args.fail_over):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,317 @@
+"""SSE (/events) とチャット送信の負荷試験
+
+一時DBに管理者と社員のペアを作り、アプリを gevent の WSGIServer でローカル起動する。
+社員ごとに EventSource 相当の接続を張ったまま管理者からチャットを送り、
+配信遅延のパーセンタイル、接続あたりのメモリ、再接続中に失われたイベント数を測る。
+ネットワークには出ない (127.0.0.1 のみ)。
+
+    python -m benchmarks.sse_load --clients 2000 --messages 3 --duration 20
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import http.client
+import json
+import os
+import random
+import resource
+import socket
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.run import load_app, percentile
+
+CSRF_TOKEN = 'load'
+
+
+def current_rss_kb():
+    """現在の常駐メモリ (KB)。/proc が無い環境では最大値で代用する"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def raise_fd_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def seed_pairs(db_path, clients, admins):
+    """管理者 admins 人が社員 clients 人を分担して管理するデータを作る"""
+    conn = sqlite3.connect(db_path)
+    admin_ids = [
+        conn.execute(
+            "INSERT INTO users (email, name, password_hash, is_admin) VALUES (?, ?, 'load', 1)",
+            (f'admin{i}@example.com', f'管理者{i}'),
+        ).lastrowid
+        for i in range(admins)
+    ]
+    pairs = []
+    for i in range(clients):
+        user_id = conn.execute(
+            "INSERT INTO users (email, name, password_hash) VALUES (?, ?, 'load')",
+            (f'user{i}@example.com', f'社員{i}'),
+        ).lastrowid
+        admin_id = admin_ids[i % admins]
+        conn.execute("INSERT INTO admin_managed_users (admin_id, user_id) VALUES (?, ?)", (admin_id, user_id))
+        pairs.append((admin_id, user_id))
+    conn.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('setup_completed', 'load')")
+    conn.commit()
+    conn.close()
+    return pairs
+
+
+class SessionCookies:
+    """ログイン処理を通さずに署名済みセッション Cookie を作る"""
+
+    def __init__(self, app):
+        self.serializer = app.session_interface.get_signing_serializer(app)
+        self.name = app.config['SESSION_COOKIE_NAME']
+
+    def header(self, user_id, is_admin=False):
+        value = self.serializer.dumps({
+            'user_id': user_id, 'user_name': f'load{user_id}', 'is_admin': is_admin,
+            '_csrf_token': CSRF_TOKEN,
+        })
+        return f'{self.name}={value}'
+
+
+class SSEClient:
+    """/events を読み続け、届いたチャットの遅延を記録するクライアント"""
+
+    def __init__(self, port, cookie, stats):
+        self.port = port
+        self.cookie = cookie
+        self.stats = stats
+        self.received = set()
+        self.connected = gevent.event.Event()
+        self.sock = None
+        self.connects = 0
+
+    def run(self):
+        while not self.stats['stopping']:
+            try:
+                self._read_stream()
+            except OSError:
+                pass
+            if self.stats['stopping']:
+                break
+            self.stats['dropped'] += 1
+            gevent.sleep(0.1)
+
+    def disconnect(self):
+        """接続を切る。run() は自動で再接続する"""
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _read_stream(self):
+        started = time.perf_counter()
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        self.sock = sock
+        request = (
+            'GET /events HTTP/1.0\r\n'
+            'Host: 127.0.0.1\r\n'
+            'Accept: text/event-stream\r\n'
+            f'Cookie: {self.cookie}\r\n\r\n'
+        )
+        sock.sendall(request.encode())
+        stream = sock.makefile('rb')
+        try:
+            status = stream.readline()
+            if b' 200 ' not in status:
+                self.stats['errors'] += 1
+                raise OSError(f'unexpected status: {status!r}')
+            while stream.readline() not in (b'\r\n', b'\n', b''):
+                pass  # ヘッダ読み飛ばし
+            for raw in stream:
+                line = raw.decode('utf-8').rstrip('\n')
+                if not line.startswith('data: '):
+                    continue
+                data = json.loads(line[6:])
+                if data.get('type') == 'ping':
+                    self.stats['connect_ms'].append((time.perf_counter() - started) * 1000)
+                    self.connects += 1
+                    self.connected.set()
+                elif data.get('type') == 'message' and data['message'].startswith('load:'):
+                    _, seq, sent_at = data['message'].split(':')
+                    self.stats['latency_ms'].append((time.perf_counter() - float(sent_at)) * 1000)
+                    self.received.add(int(seq))
+        finally:
+            stream.close()
+            sock.close()
+
+
+def send_message(port, cookie, partner_id, seq, stats):
+    body = urlencode({'_csrf_token': CSRF_TOKEN, 'message': f'load:{seq}:{time.perf_counter():.6f}'})
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request('POST', f'/chat/{partner_id}', body=body, headers={
+            'Cookie': cookie, 'Content-Type': 'application/x-www-form-urlencoded',
+        })
+        resp = conn.getresponse()
+        resp.read()
+        if resp.status != 302:
+            stats['send_errors'] += 1
+            return False
+        return True
+    except OSError:
+        stats['send_errors'] += 1
+        return False
+    finally:
+        conn.close()
+
+
+def summarize(values):
+    if not values:
+        return {}
+    return {
+        'p50': round(percentile(values, 50), 2),
+        'p90': round(percentile(values, 90), 2),
+        'p99': round(percentile(values, 99), 2),
+        'max': round(max(values), 2),
+        'mean': round(statistics.mean(values), 2),
+    }
+
+
+def run_load(clients, messages, duration, admins, senders, reconnect_rate, settle, seed):
+    rng = random.Random(seed)
+    raise_fd_limit(clients * 2 + senders + 256)
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_path = os.path.join(work_dir, 'load.db')
+        app_module = load_app(db_path, os.path.join(work_dir, 'exports'))
+        app_module.initialize_database()
+        pairs = seed_pairs(db_path, clients, admins)
+        cookies = SessionCookies(app_module.app)
+
+        server = WSGIServer(('127.0.0.1', 0), app_module.app, log=None, error_log=None)
+        server.start()
+        port = server.server_port
+        stats = {
+            'stopping': False, 'errors': 0, 'send_errors': 0, 'dropped': 0,
+            'connect_ms': [], 'latency_ms': [],
+        }
+        try:
+            rss_before = current_rss_kb()
+            sse_clients = {
+                user_id: SSEClient(port, cookies.header(user_id), stats) for _, user_id in pairs
+            }
+            readers = [gevent.spawn(c.run) for c in sse_clients.values()]
+            connect_started = time.perf_counter()
+            for c in sse_clients.values():
+                c.connected.wait(timeout=60)
+            connected = sum(c.connected.is_set() for c in sse_clients.values())
+            connect_elapsed = time.perf_counter() - connect_started
+            gevent.sleep(0.5)
+            rss_connected = current_rss_kb()
+
+            # 一部のクライアントは送信期間中に切断→再接続させる
+            flaky = set(rng.sample(sorted(sse_clients), int(len(sse_clients) * reconnect_rate)))
+            for user_id in flaky:
+                gevent.spawn_later(rng.uniform(0, duration), sse_clients[user_id].disconnect)
+
+            schedule = []
+            seq = 0
+            for _ in range(messages):
+                for admin_id, user_id in pairs:
+                    seq += 1
+                    schedule.append((rng.uniform(0, duration), admin_id, user_id, seq))
+            schedule.sort()
+            sent = {user_id: set() for _, user_id in pairs}
+            admin_cookies = {admin_id: cookies.header(admin_id, True) for admin_id in {a for a, _ in pairs}}
+            pool = Pool(senders)
+            send_started = time.perf_counter()
+
+            def send(admin_id, user_id, seq):
+                if send_message(port, admin_cookies[admin_id], user_id, seq, stats):
+                    sent[user_id].add(seq)
+
+            for at, admin_id, user_id, seq in schedule:
+                delay = at - (time.perf_counter() - send_started)
+                if delay > 0:
+                    gevent.sleep(delay)
+                pool.spawn(send, admin_id, user_id, seq)
+            pool.join()
+            send_elapsed = time.perf_counter() - send_started
+            gevent.sleep(settle)
+        finally:
+            stats['stopping'] = True
+            server.stop(timeout=1)
+            gevent.killall(readers, timeout=5)
+
+    lost = {'stable': 0, 'reconnected': 0}
+    delivered = 0
+    for user_id, client in sse_clients.items():
+        missing = len(sent[user_id] - client.received)
+        delivered += len(sent[user_id] & client.received)
+        lost['reconnected' if user_id in flaky else 'stable'] += missing
+    total_sent = sum(len(s) for s in sent.values())
+    return {
+        'params': {
+            'clients': clients, 'messages': messages, 'duration': duration, 'admins': admins,
+            'senders': senders, 'reconnect_rate': reconnect_rate, 'seed': seed,
+        },
+        'connected': connected,
+        'connect_seconds': round(connect_elapsed, 2),
+        'connect_ms': summarize(stats['connect_ms']),
+        'stream_errors': stats['errors'],
+        'sent': total_sent,
+        'send_errors': stats['send_errors'],
+        'send_rate_per_sec': round(total_sent / send_elapsed, 1) if send_elapsed else 0,
+        'delivered': delivered,
+        'latency_ms': summarize(stats['latency_ms']),
+        # サーバーとクライアントが同じプロセスなので、両方の合計の目安
+        'rss_per_connection_kb': round((rss_connected - rss_before) / connected, 1) if connected else 0,
+        'reconnecting_clients': len(flaky),
+        'reconnects': stats['dropped'],
+        'lost_events': lost,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=500, help='同時に /events を購読する社員の数')
+    parser.add_argument('--messages', type=int, default=2, help='社員1人あたりに送るメッセージ数')
+    parser.add_argument('--duration', type=float, default=10, help='送信を分散させる秒数')
+    parser.add_argument('--admins', type=int, default=10)
+    parser.add_argument('--senders', type=int, default=50, help='同時に送信する数')
+    parser.add_argument('--reconnect-rate', type=float, default=0.1, help='送信中に再接続させるクライアントの割合')
+    parser.add_argument('--settle', type=float, default=2, help='送信完了後に配信を待つ秒数')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    args = parser.parse_args(argv)
+
+    result = run_load(
+        args.clients, args.messages, args.duration, args.admins, args.senders,
+        args.reconnect_rate, args.settle, args.seed,
+    )
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
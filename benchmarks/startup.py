@@ -0,0 +1,76 @@
+"""コールドスタート時間の計測
+
+新しい Python プロセスで app の読み込み、create_app()、最初のリクエスト (テンプレートの
+コンパイルを含む) にかかる時間を測る。テンプレートのバイトコードキャッシュが空の場合 (cold) と
+前のプロセスが作ったキャッシュがある場合 (warm) を比べる。
+
+    python -m benchmarks.startup --runs 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app as app_module
+imported = time.perf_counter()
+app_module.DB_PATH = sys.argv[2]
+app = app_module.create_app({'TESTING': True, 'JINJA_CACHE_DIR': sys.argv[3], 'LOG_DIR': sys.argv[4]})
+created = time.perf_counter()
+with app.test_client() as client:
+    client.get('/login').get_data()
+finished = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (finished - created) * 1000,
+    'total_ms': (finished - started) * 1000,
+}))
+"""
+
+
+def probe(work_dir, cache_dir):
+    env = dict(os.environ, SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark-secret'))
+    out = subprocess.run(
+        [sys.executable, '-c', PROBE, ROOT, os.path.join(work_dir, 'startup.db'), cache_dir,
+         os.path.join(work_dir, 'logs')],
+        check=True, capture_output=True, text=True, env=env,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def median_of(samples):
+    return {key: round(statistics.median(s[key] for s in samples), 2) for key in samples[0]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    args = parser.parse_args(argv)
+
+    results = {'cold': [], 'warm': []}
+    with tempfile.TemporaryDirectory() as work_dir:
+        probe(work_dir, os.path.join(work_dir, 'warmup-cache'))  # DB のマイグレーションを済ませておく
+        for n in range(args.runs):
+            results['cold'].append(probe(work_dir, os.path.join(work_dir, f'cold-cache-{n}')))
+            results['warm'].append(probe(work_dir, os.path.join(work_dir, 'warmup-cache')))
+    report = {name: median_of(samples) for name, samples in results.items()}
+    report['runs'] = args.runs
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,31 @@
+-- 勤怠の日付 (YYYYMMDD) と時刻 (0 時からの分) を整数で持つ
+-- timestamp 列は従来のツール向けにそのまま残す
+ALTER TABLE attendance ADD COLUMN day INTEGER;
+ALTER TABLE attendance ADD COLUMN minute INTEGER;
+
+CREATE INDEX IF NOT EXISTS idx_attendance_user_day
+    ON attendance(user_id, day, type);
+-- 日付・時刻の検索と並び替えは新しいインデックスで行う
+DROP INDEX IF EXISTS idx_attendance_user_timestamp;
+
+-- day/minute を指定せずに INSERT された行 (従来の SQL や外部ツール) は timestamp から埋める
+CREATE TRIGGER IF NOT EXISTS trg_attendance_fill_day_insert AFTER INSERT ON attendance
+WHEN NEW.day IS NULL
+BEGIN
+    UPDATE attendance SET
+        day = CAST(replace(substr(NEW.timestamp, 1, 10), '-', '') AS INTEGER),
+        minute = CAST(substr(NEW.timestamp, 12, instr(substr(NEW.timestamp, 12), ':') - 1) AS INTEGER) * 60
+            + CAST(substr(NEW.timestamp, 12 + instr(substr(NEW.timestamp, 12), ':'), 2) AS INTEGER)
+    WHERE id = NEW.id;
+END;
+
+-- timestamp だけが更新された場合も追従させる
+CREATE TRIGGER IF NOT EXISTS trg_attendance_fill_day_update AFTER UPDATE OF timestamp ON attendance
+WHEN NEW.timestamp IS NOT OLD.timestamp AND NEW.day IS OLD.day AND NEW.minute IS OLD.minute
+BEGIN
+    UPDATE attendance SET
+        day = CAST(replace(substr(NEW.timestamp, 1, 10), '-', '') AS INTEGER),
+        minute = CAST(substr(NEW.timestamp, 12, instr(substr(NEW.timestamp, 12), ':') - 1) AS INTEGER) * 60
+            + CAST(substr(NEW.timestamp, 12 + instr(substr(NEW.timestamp, 12), ':'), 2) AS INTEGER)
+    WHERE id = NEW.id;
+END;
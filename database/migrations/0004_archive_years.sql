@@ -0,0 +1,30 @@
+-- アーカイブ DB (archive/kintai_<年>.db) へ移した年の一覧
+-- attendance は締めた年をまるごと移し、messages は古い既読メッセージを年ごとに追記する
+CREATE TABLE IF NOT EXISTS archive_years (
+    kind TEXT CHECK(kind IN ('attendance', 'messages')) NOT NULL,
+    year INTEGER NOT NULL,
+    rows INTEGER NOT NULL DEFAULT 0,
+    min_id INTEGER,
+    max_id INTEGER,
+    archived_at TEXT NOT NULL,
+    PRIMARY KEY (kind, year)
+);
+
+-- アーカイブ済みの年は読み取り専用とし、ホット DB に同じ年の勤怠が混ざらないようにする
+CREATE TRIGGER IF NOT EXISTS trg_attendance_archived_insert BEFORE INSERT ON attendance
+WHEN EXISTS (
+    SELECT 1 FROM archive_years
+    WHERE kind = 'attendance' AND year = CAST(substr(NEW.timestamp, 1, 4) AS INTEGER)
+)
+BEGIN
+    SELECT RAISE(ABORT, 'attendance year is archived');
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_attendance_archived_update BEFORE UPDATE OF timestamp ON attendance
+WHEN EXISTS (
+    SELECT 1 FROM archive_years
+    WHERE kind = 'attendance' AND year = CAST(substr(NEW.timestamp, 1, 4) AS INTEGER)
+)
+BEGIN
+    SELECT RAISE(ABORT, 'attendance year is archived');
+END;
@@ -0,0 +1,11 @@
+-- エクスポートしたファイルの索引 (exports/ からの相対パス)
+-- 掃除スレッドはディレクトリを走査せず、この表の最終アクセス時刻とサイズで古いものから削除する
+CREATE TABLE IF NOT EXISTS export_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    last_access TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_export_files_last_access
+    ON export_files(last_access);
@@ -0,0 +1,87 @@
+-- 会話ごとの要約 (チャット一覧用)。ペアは user_low < user_high の順で 1 行にまとめる
+-- 最新メッセージと各側の未読件数をトリガーで保守し、一覧で messages を集計しなくて済むようにする
+CREATE TABLE IF NOT EXISTS conversations (
+    user_low INTEGER NOT NULL,
+    user_high INTEGER NOT NULL,
+    last_message_id INTEGER NOT NULL,
+    last_sender_id INTEGER NOT NULL,
+    preview TEXT NOT NULL,
+    last_timestamp TEXT NOT NULL,
+    unread_low INTEGER NOT NULL DEFAULT 0,   -- user_low 宛ての未読件数
+    unread_high INTEGER NOT NULL DEFAULT 0,  -- user_high 宛ての未読件数
+    PRIMARY KEY (user_low, user_high)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS trg_conversations_insert AFTER INSERT ON messages
+BEGIN
+    INSERT INTO conversations (
+        user_low, user_high, last_message_id, last_sender_id, preview, last_timestamp, unread_low, unread_high
+    ) VALUES (
+        min(NEW.sender_id, NEW.recipient_id), max(NEW.sender_id, NEW.recipient_id),
+        NEW.id, NEW.sender_id, substr(NEW.message, 1, 100), NEW.timestamp,
+        NEW.is_read = 0 AND NEW.recipient_id < NEW.sender_id,
+        NEW.is_read = 0 AND NEW.recipient_id > NEW.sender_id
+    )
+    ON CONFLICT (user_low, user_high) DO UPDATE SET
+        last_message_id = max(last_message_id, excluded.last_message_id),
+        last_sender_id = CASE WHEN excluded.last_message_id > last_message_id
+            THEN excluded.last_sender_id ELSE last_sender_id END,
+        preview = CASE WHEN excluded.last_message_id > last_message_id
+            THEN excluded.preview ELSE preview END,
+        last_timestamp = CASE WHEN excluded.last_message_id > last_message_id
+            THEN excluded.last_timestamp ELSE last_timestamp END,
+        unread_low = unread_low + excluded.unread_low,
+        unread_high = unread_high + excluded.unread_high;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_conversations_read AFTER UPDATE OF is_read ON messages
+WHEN OLD.is_read != NEW.is_read
+BEGIN
+    UPDATE conversations SET
+        unread_low = unread_low
+            + CASE WHEN NEW.recipient_id < NEW.sender_id THEN OLD.is_read - NEW.is_read ELSE 0 END,
+        unread_high = unread_high
+            + CASE WHEN NEW.recipient_id > NEW.sender_id THEN OLD.is_read - NEW.is_read ELSE 0 END
+    WHERE user_low = min(NEW.sender_id, NEW.recipient_id) AND user_high = max(NEW.sender_id, NEW.recipient_id);
+END;
+
+-- アーカイブへ移した古いメッセージは未読ではないので件数は変わらない。
+-- 最新メッセージが消えたときだけ残っている中で最新のものを指し直す (残りがなければ要約はそのまま)
+CREATE TRIGGER IF NOT EXISTS trg_conversations_delete AFTER DELETE ON messages
+BEGIN
+    UPDATE conversations SET
+        unread_low = unread_low - (OLD.is_read = 0 AND OLD.recipient_id < OLD.sender_id),
+        unread_high = unread_high - (OLD.is_read = 0 AND OLD.recipient_id > OLD.sender_id)
+    WHERE user_low = min(OLD.sender_id, OLD.recipient_id) AND user_high = max(OLD.sender_id, OLD.recipient_id);
+    UPDATE conversations SET (last_message_id, last_sender_id, preview, last_timestamp) = (
+        SELECT id, sender_id, substr(message, 1, 100), timestamp FROM messages
+        WHERE (sender_id = OLD.sender_id AND recipient_id = OLD.recipient_id)
+           OR (sender_id = OLD.recipient_id AND recipient_id = OLD.sender_id)
+        ORDER BY id DESC LIMIT 1
+    )
+    WHERE user_low = min(OLD.sender_id, OLD.recipient_id) AND user_high = max(OLD.sender_id, OLD.recipient_id)
+      AND last_message_id = OLD.id
+      AND EXISTS (
+        SELECT 1 FROM messages
+        WHERE (sender_id = OLD.sender_id AND recipient_id = OLD.recipient_id)
+           OR (sender_id = OLD.recipient_id AND recipient_id = OLD.sender_id)
+      );
+END;
+
+-- 既存のメッセージから要約を作る
+INSERT INTO conversations (
+    user_low, user_high, last_message_id, last_sender_id, preview, last_timestamp, unread_low, unread_high
+)
+SELECT p.user_low, p.user_high, m.id, m.sender_id, substr(m.message, 1, 100), m.timestamp,
+       p.unread_low, p.unread_high
+FROM (
+    SELECT min(sender_id, recipient_id) AS user_low, max(sender_id, recipient_id) AS user_high,
+           max(id) AS last_id,
+           sum(is_read = 0 AND recipient_id < sender_id) AS unread_low,
+           sum(is_read = 0 AND recipient_id > sender_id) AS unread_high
+    FROM messages
+    GROUP BY 1, 2
+) AS p
+JOIN messages AS m ON m.id = p.last_id
+WHERE true
+ON CONFLICT (user_low, user_high) DO NOTHING;
@@ -0,0 +1,74 @@
+-- 会話の ETag 用バージョン (conversation_versions) を conversations にまとめる。
+-- 同じペアのキーと最終メッセージIDを2つの表で保守していたので、既読・更新・削除の回数だけを
+-- read_version として conversations に持たせ、メッセージ1件の書き込みで更新する要約を1行にする
+ALTER TABLE conversations ADD COLUMN read_version INTEGER NOT NULL DEFAULT 0;
+
+UPDATE conversations SET read_version = coalesce((
+    SELECT v.read_version FROM conversation_versions AS v
+    WHERE v.user_low = conversations.user_low AND v.user_high = conversations.user_high
+), 0);
+
+-- 未読件数の合計をユーザーごとに引けるようにする (user_low 側は主キーで引ける)
+CREATE INDEX IF NOT EXISTS idx_conversations_user_high ON conversations(user_high);
+
+DROP TRIGGER IF EXISTS trg_messages_version_insert;
+DROP TRIGGER IF EXISTS trg_messages_version_update;
+DROP TRIGGER IF EXISTS trg_messages_version_delete;
+DROP TRIGGER IF EXISTS trg_conversations_read;
+DROP TRIGGER IF EXISTS trg_conversations_delete;
+DROP TABLE IF EXISTS conversation_versions;
+
+-- 受信箱のバージョン (未読バッジの ETag 用) はユーザー単位なのでそのまま残す
+CREATE TRIGGER IF NOT EXISTS trg_messages_inbox_insert AFTER INSERT ON messages
+BEGIN
+    INSERT INTO inbox_versions (user_id, version) VALUES (NEW.recipient_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_messages_inbox_update AFTER UPDATE ON messages
+BEGIN
+    INSERT INTO inbox_versions (user_id, version) VALUES (NEW.recipient_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_messages_inbox_delete AFTER DELETE ON messages
+BEGIN
+    INSERT INTO inbox_versions (user_id, version) VALUES (OLD.recipient_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+END;
+
+-- 既読に限らず更新があれば read_version を進め、既読の変化は未読件数にも反映する
+CREATE TRIGGER IF NOT EXISTS trg_conversations_update AFTER UPDATE ON messages
+BEGIN
+    UPDATE conversations SET
+        unread_low = unread_low
+            + CASE WHEN NEW.recipient_id < NEW.sender_id THEN OLD.is_read - NEW.is_read ELSE 0 END,
+        unread_high = unread_high
+            + CASE WHEN NEW.recipient_id > NEW.sender_id THEN OLD.is_read - NEW.is_read ELSE 0 END,
+        read_version = read_version + 1
+    WHERE user_low = min(NEW.sender_id, NEW.recipient_id) AND user_high = max(NEW.sender_id, NEW.recipient_id);
+END;
+
+-- アーカイブへ移した古いメッセージは未読ではないので件数は変わらない。
+-- 最新メッセージが消えたときだけ残っている中で最新のものを指し直す (残りがなければ要約はそのまま)
+CREATE TRIGGER IF NOT EXISTS trg_conversations_delete AFTER DELETE ON messages
+BEGIN
+    UPDATE conversations SET
+        unread_low = unread_low - (OLD.is_read = 0 AND OLD.recipient_id < OLD.sender_id),
+        unread_high = unread_high - (OLD.is_read = 0 AND OLD.recipient_id > OLD.sender_id),
+        read_version = read_version + 1
+    WHERE user_low = min(OLD.sender_id, OLD.recipient_id) AND user_high = max(OLD.sender_id, OLD.recipient_id);
+    UPDATE conversations SET (last_message_id, last_sender_id, preview, last_timestamp) = (
+        SELECT id, sender_id, substr(message, 1, 100), timestamp FROM messages
+        WHERE (sender_id = OLD.sender_id AND recipient_id = OLD.recipient_id)
+           OR (sender_id = OLD.recipient_id AND recipient_id = OLD.sender_id)
+        ORDER BY id DESC LIMIT 1
+    )
+    WHERE user_low = min(OLD.sender_id, OLD.recipient_id) AND user_high = max(OLD.sender_id, OLD.recipient_id)
+      AND last_message_id = OLD.id
+      AND EXISTS (
+        SELECT 1 FROM messages
+        WHERE (sender_id = OLD.sender_id AND recipient_id = OLD.recipient_id)
+           OR (sender_id = OLD.recipient_id AND recipient_id = OLD.sender_id)
+      );
+END;
@@ -0,0 +1,29 @@
+-- timestamp を解釈できない勤怠行は day/minute を 0 ではなく NULL にする
+-- (0 のままだと一覧に 0000-00-00 として並んでしまう)
+UPDATE attendance SET day = NULL, minute = NULL WHERE day = 0;
+
+-- 0002 のトリガーも、形式の合わない timestamp には 0 ではなく NULL を入れるよう作り直す
+DROP TRIGGER IF EXISTS trg_attendance_fill_day_insert;
+DROP TRIGGER IF EXISTS trg_attendance_fill_day_update;
+
+CREATE TRIGGER trg_attendance_fill_day_insert AFTER INSERT ON attendance
+WHEN NEW.day IS NULL AND NEW.timestamp GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]T[0-9]*:[0-9][0-9]*'
+BEGIN
+    UPDATE attendance SET
+        day = CAST(replace(substr(NEW.timestamp, 1, 10), '-', '') AS INTEGER),
+        minute = CAST(substr(NEW.timestamp, 12, instr(substr(NEW.timestamp, 12), ':') - 1) AS INTEGER) * 60
+            + CAST(substr(NEW.timestamp, 12 + instr(substr(NEW.timestamp, 12), ':'), 2) AS INTEGER)
+    WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER trg_attendance_fill_day_update AFTER UPDATE OF timestamp ON attendance
+WHEN NEW.timestamp IS NOT OLD.timestamp AND NEW.day IS OLD.day AND NEW.minute IS OLD.minute
+BEGIN
+    UPDATE attendance SET
+        day = CASE WHEN NEW.timestamp GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]T[0-9]*:[0-9][0-9]*'
+            THEN CAST(replace(substr(NEW.timestamp, 1, 10), '-', '') AS INTEGER) END,
+        minute = CASE WHEN NEW.timestamp GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]T[0-9]*:[0-9][0-9]*'
+            THEN CAST(substr(NEW.timestamp, 12, instr(substr(NEW.timestamp, 12), ':') - 1) AS INTEGER) * 60
+                + CAST(substr(NEW.timestamp, 12 + instr(substr(NEW.timestamp, 12), ':'), 2) AS INTEGER) END
+    WHERE id = NEW.id;
+END;
@@ -28,6 +28,13 @@ CREATE TABLE IF NOT EXISTS attendance (
     FOREIGN KEY(user_id) REFERENCES users(id)
 );
 
+-- キオスク打刻用のバッジ/PIN (HMAC のみ保存)
+CREATE TABLE IF NOT EXISTS kiosk_badges (
+    token_hash TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL UNIQUE,
+    FOREIGN KEY(user_id) REFERENCES users(id)
+);
+
 -- メール設定（常に1行のみ）
 CREATE TABLE IF NOT EXISTS mail_settings (
     id INTEGER PRIMARY KEY CHECK(id = 1),
@@ -40,6 +47,26 @@ CREATE TABLE IF NOT EXISTS mail_settings (
     body_template TEXT
 );
 
+-- メール送信キュー (バックグラウンドで送信)
+CREATE TABLE IF NOT EXISTS mail_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    to_email TEXT NOT NULL,
+    subject TEXT,
+    body TEXT,
+    status TEXT CHECK(status IN ('pending', 'sending', 'sent', 'failed')) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TEXT NOT NULL,
+    last_error TEXT,
+    created_at TEXT NOT NULL,
+    sent_at TEXT
+);
+
+-- アプリケーション設定 (初回セットアップ完了フラグなど)
+CREATE TABLE IF NOT EXISTS app_settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
 -- チャットメッセージ
 CREATE TABLE IF NOT EXISTS messages (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -53,6 +80,25 @@ CREATE TABLE IF NOT EXISTS messages (
     FOREIGN KEY(recipient_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
+-- データ更新バージョン (ETag 用、トリガーで更新)
+CREATE TABLE IF NOT EXISTS attendance_versions (
+    user_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS conversation_versions (
+    user_low INTEGER NOT NULL,
+    user_high INTEGER NOT NULL,
+    last_message_id INTEGER NOT NULL DEFAULT 0,
+    read_version INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_low, user_high)
+);
+
+CREATE TABLE IF NOT EXISTS inbox_versions (
+    user_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
 -- 追加インデックス
 CREATE INDEX IF NOT EXISTS idx_attendance_user_timestamp
     ON attendance(user_id, timestamp);
@@ -64,3 +110,46 @@ CREATE INDEX IF NOT EXISTS idx_messages_recipient_read
     ON messages(recipient_id, is_read);
 CREATE INDEX IF NOT EXISTS idx_messages_pair_timestamp
     ON messages(sender_id, recipient_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_mail_outbox_status_next
+    ON mail_outbox(status, next_attempt_at);
+
+-- バージョン更新トリガー
+CREATE TRIGGER IF NOT EXISTS trg_attendance_version_insert AFTER INSERT ON attendance
+BEGIN
+    INSERT INTO attendance_versions (user_id, version) VALUES (NEW.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_attendance_version_update AFTER UPDATE ON attendance
+BEGIN
+    INSERT INTO attendance_versions (user_id, version) VALUES (NEW.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_attendance_version_delete AFTER DELETE ON attendance
+BEGIN
+    INSERT INTO attendance_versions (user_id, version) VALUES (OLD.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_messages_version_insert AFTER INSERT ON messages
+BEGIN
+    INSERT INTO conversation_versions (user_low, user_high, last_message_id)
+        VALUES (min(NEW.sender_id, NEW.recipient_id), max(NEW.sender_id, NEW.recipient_id), NEW.id)
+        ON CONFLICT(user_low, user_high) DO UPDATE SET last_message_id = excluded.last_message_id;
+    INSERT INTO inbox_versions (user_id, version) VALUES (NEW.recipient_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_messages_version_update AFTER UPDATE ON messages
+BEGIN
+    INSERT INTO conversation_versions (user_low, user_high, read_version)
+        VALUES (min(NEW.sender_id, NEW.recipient_id), max(NEW.sender_id, NEW.recipient_id), 1)
+        ON CONFLICT(user_low, user_high) DO UPDATE SET read_version = read_version + 1;
+    INSERT INTO inbox_versions (user_id, version) VALUES (NEW.recipient_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_messages_version_delete AFTER DELETE ON messages
+BEGIN
+    INSERT INTO conversation_versions (user_low, user_high, read_version)
+        VALUES (min(OLD.sender_id, OLD.recipient_id), max(OLD.sender_id, OLD.recipient_id), 1)
+        ON CONFLICT(user_low, user_high) DO UPDATE SET read_version = read_version + 1;
+    INSERT INTO inbox_versions (user_id, version) VALUES (OLD.recipient_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+END;
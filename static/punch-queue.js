@@ -0,0 +1,93 @@
+// オフライン打刻キュー。ページと Service Worker の両方から読み込む。
+// 通信できないときの打刻を IndexedDB に溜め、/punch/batch へまとめて送る。
+(function (scope) {
+  const DB_NAME = 'kintai-offline';
+  const STORE = 'punches';
+  const SYNC_URL = '/punch/batch';
+  const LEGACY_SW_URL = '/static/sw.js';
+  const LEGACY_SW_SCOPE = '/static/';
+
+  function openDb() {
+    return new Promise((resolve, reject) => {
+      const req = indexedDB.open(DB_NAME, 1);
+      req.onupgradeneeded = () => {
+        req.result.createObjectStore(STORE, {keyPath: 'id'});
+      };
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => reject(req.error);
+    });
+  }
+
+  function withStore(mode, fn) {
+    return openDb().then(db => new Promise((resolve, reject) => {
+      const tx = db.transaction(STORE, mode);
+      const result = fn(tx.objectStore(STORE));
+      tx.oncomplete = () => { db.close(); resolve(result && 'result' in result ? result.result : result); };
+      tx.onerror = () => { db.close(); reject(tx.error); };
+    }));
+  }
+
+  function queuePunch(punch) {
+    const item = Object.assign({
+      id: Date.now().toString(36) + Math.random().toString(36).slice(2, 8),
+      queuedAt: new Date().toISOString(),
+    }, punch);
+    return withStore('readwrite', store => { store.put(item); }).then(() => item);
+  }
+
+  function listQueuedPunches() {
+    return withStore('readonly', store => store.getAll());
+  }
+
+  function removeQueuedPunches(ids) {
+    return withStore('readwrite', store => { ids.forEach(id => store.delete(id)); });
+  }
+
+  // 送信に成功したものはキューから外す。conflict は利用者の判断が要るので
+  // 結果として返し、キューからは外す (上書きする場合は on_conflict を付けて積み直す)。
+  function syncQueuedPunches(csrfToken) {
+    return listQueuedPunches().then(punches => {
+      if (!punches.length) {
+        return [];
+      }
+      const headers = {'Content-Type': 'application/json'};
+      if (csrfToken) {
+        headers['X-CSRF-Token'] = csrfToken;
+      }
+      return fetch(SYNC_URL, {
+        method: 'POST',
+        credentials: 'same-origin',
+        redirect: 'manual',
+        headers: headers,
+        body: JSON.stringify({punches: punches}),
+      }).then(resp => {
+        const type = resp.headers.get('Content-Type') || '';
+        if (!resp.ok || !type.includes('application/json')) {
+          // 未ログインやセッション切れ。キューは残して次回に回す
+          throw new Error('sync failed: ' + resp.status);
+        }
+        return resp.json();
+      }).then(data => removeQueuedPunches(data.results.map(r => r.id)).then(() => data.results));
+    });
+  }
+
+  // 以前は /static/sw.js を /static/ スコープで登録していた。残っていると /static/ 配下を
+  // 古いキャッシュから返し続けるので、ページから読み込まれたときに登録を解除する
+  function unregisterLegacyWorker() {
+    return navigator.serviceWorker.getRegistrations().then(registrations => Promise.all(
+      registrations
+        .filter(reg => {
+          const worker = reg.active || reg.waiting || reg.installing;
+          return new URL(reg.scope).pathname === LEGACY_SW_SCOPE
+            || (worker && new URL(worker.scriptURL).pathname === LEGACY_SW_URL);
+        })
+        .map(reg => reg.unregister())
+    ));
+  }
+
+  if (scope.document && 'serviceWorker' in navigator) {
+    unregisterLegacyWorker().catch(() => {});
+  }
+
+  scope.PunchQueue = {queuePunch, listQueuedPunches, removeQueuedPunches, syncQueuedPunches};
+})(self);
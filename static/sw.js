@@ -1,27 +1,124 @@
-const CACHE_NAME = 'kintai-app-cache-v1';
-const urlsToCache = [
-  '/',
-  '/static/style.css',
-  // 必要に応じて他の静的リソース
-];
+// 静的ファイルは内容ハッシュ付きURL (/assets/<hash>/...) で配信される。
+// /asset-manifest.json に載ったURLをインストール時にまとめてキャッシュし、
+// それらだけをキャッシュ優先で返す。ページ・API・SSE はネットワークに任せる。
+// ただし画面遷移が通信エラーになったときは、保存しておいた打刻画面 (/offline) を返す。
+const CACHE_PREFIX = 'kintai-assets-';
+const SHELL_CACHE = 'kintai-shell';
+const SHELL_URL = '/offline';
+const PUNCH_URL = '/punch';
+const LOGIN_URL = '/login';
+const PUNCH_SYNC_TAG = 'punch-sync';
+
+importScripts('/static/punch-queue.js');
+
+function fetchManifest() {
+  return fetch('/asset-manifest.json', {cache: 'no-store'}).then(resp => resp.json());
+}
+
+// 打刻画面はログイン中のユーザー向けに描画されるので、ログインページへ
+// 転送されたら (未ログイン・ログアウト後) 保存済みのものも消す
+function cacheShell() {
+  return fetch(SHELL_URL, {credentials: 'same-origin', cache: 'no-store'}).then(resp => {
+    if (resp.ok && !resp.redirected) {
+      return caches.open(SHELL_CACHE).then(cache => cache.put(SHELL_URL, resp));
+    }
+    return caches.delete(SHELL_CACHE);
+  });
+}
+
+function offlineShell() {
+  return caches.open(SHELL_CACHE)
+    .then(cache => cache.match(SHELL_URL))
+    .then(response => response || Response.error());
+}
 
 self.addEventListener('install', event => {
   event.waitUntil(
-    caches.open(CACHE_NAME).then(cache => cache.addAll(urlsToCache))
+    fetchManifest()
+      .then(manifest => caches.open(CACHE_PREFIX + manifest.version)
+        .then(cache => cache.addAll(manifest.assets)))
+      .then(() => cacheShell().catch(() => {}))
+      .then(() => self.skipWaiting())
+  );
+});
+
+function deleteCaches(isStale) {
+  return caches.keys().then(keys => Promise.all(keys.filter(isStale).map(key => caches.delete(key))));
+}
+
+self.addEventListener('activate', event => {
+  event.waitUntil(
+    // 旧版の Service Worker が作ったキャッシュ (kintai-app-cache-v1 など) は通信できなくても消す
+    deleteCaches(key => key !== SHELL_CACHE && !key.startsWith(CACHE_PREFIX))
+      .then(fetchManifest)
+      .then(manifest => deleteCaches(key => key.startsWith(CACHE_PREFIX) && key !== CACHE_PREFIX + manifest.version))
+      .catch(() => {})  // オフライン時は古い版のアセットの削除を次回に回す
+      .then(() => self.clients.claim())
   );
 });
 
+// 通信できずに送れなかった打刻フォームは端末のキューへ積み、打刻画面へ戻す
+function queueFailedPunch(request) {
+  return request.formData()
+    .then(form => PunchQueue.queuePunch({
+      timestamp: form.get('timestamp'),
+      type: form.get('type'),
+      description: form.get('type') === 'out' ? (form.get('description') || '') : '',
+      csrfToken: form.get('_csrf_token'),
+    }))
+    .then(() => self.registration.sync ? self.registration.sync.register(PUNCH_SYNC_TAG) : null)
+    .catch(() => {})
+    .then(() => Response.redirect('/', 303));
+}
+
 self.addEventListener('fetch', event => {
-  const url = new URL(event.request.url);
-  if (
-    event.request.headers.get('accept') === 'text/event-stream' ||
-    url.pathname === '/events'
-  ) {
-    // SSEはキャッシュせずに直接取得
-    event.respondWith(fetch(event.request));
+  const request = event.request;
+  const url = new URL(request.url);
+  if (url.origin !== self.location.origin) {
+    return;
+  }
+  if (request.mode === 'navigate') {
+    if (request.method === 'POST' && url.pathname === PUNCH_URL) {
+      const copy = request.clone();
+      event.respondWith(fetch(request).catch(() => queueFailedPunch(copy)));
+      return;
+    }
+    if (request.method !== 'GET') {
+      return;
+    }
+    event.respondWith(
+      fetch(request).then(response => {
+        // 打刻画面を開けたら保存済みのものも新しくし、ログインページへ戻ったら消す
+        const path = new URL(response.url || request.url).pathname;
+        if (path === LOGIN_URL) {
+          event.waitUntil(caches.delete(SHELL_CACHE));
+        } else if (response.ok && path === '/') {
+          event.waitUntil(cacheShell().catch(() => {}));
+        }
+        return response;
+      }).catch(offlineShell)
+    );
+    return;
+  }
+  if (request.method !== 'GET' || !url.pathname.startsWith('/assets/')) {
     return;
   }
   event.respondWith(
-    caches.match(event.request).then(response => response || fetch(event.request))
+    caches.match(request).then(response => response || fetch(request))
+  );
+});
+
+// オフライン中に溜めた打刻は、通信が戻ったときにバックグラウンド同期で送る。
+// CSRF トークンはページ側が sync 登録時にキューへ保存しておいたものを使う。
+self.addEventListener('sync', event => {
+  if (event.tag !== PUNCH_SYNC_TAG) {
+    return;
+  }
+  event.waitUntil(
+    PunchQueue.listQueuedPunches()
+      .then(punches => PunchQueue.syncQueuedPunches(punches.length ? punches[punches.length - 1].csrfToken : null))
+      .then(results => self.clients.matchAll().then(clients => clients.forEach(
+        client => client.postMessage({type: 'punch-sync', results: results})
+      )))
   );
 });
@@ -0,0 +1,120 @@
+# 本番の gunicorn -k gevent ワーカーと同じく、アプリの読み込み前にパッチする
+from gevent import monkey
+monkey.patch_all()
+
+import os, sys, time
+import shutil
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+os.environ.setdefault("SECRET_KEY", "test-secret")
+import app as app_module
+
+# ログ・テンプレートキャッシュ・DB・出力ファイルをリポジトリに書かないよう、
+# 既定のアプリを作る前に保存先をセッション用の一時ディレクトリへ向ける
+_runtime_dir = tempfile.mkdtemp(prefix='kintai-tests-')
+app_module.LOG_DIR = os.path.join(_runtime_dir, 'logs')
+app_module.JINJA_CACHE_DIR = os.path.join(_runtime_dir, 'jinja')
+app_module.AUDIT_LOG_PATH = os.path.join(_runtime_dir, 'logs', 'audit.log')
+app_module.DB_PATH = os.path.join(_runtime_dir, 'kintai.db')
+app_module.EXPORT_DIR = os.path.join(_runtime_dir, 'exports')
+app = app_module.app
+
+
+@pytest.fixture
+def test_db(tmp_path, monkeypatch):
+    """テストごとの空のDBを作って DB_PATH をそこへ向ける"""
+    app.config['TESTING'] = True
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 10 * 1024 * 1024)
+    monkeypatch.setattr(app_module, 'DB_PATH', str(tmp_path / "test.db"))
+    monkeypatch.setattr(app_module, 'AUDIT_LOG_PATH', str(tmp_path / "audit.log"))
+    app_module.initialize_database()
+    app_module.invalidate_user_cache()
+    return app_module.DB_PATH
+
+
+@pytest.fixture
+def seed(test_db):
+    """テストDBへ直接書き込む接続を開く。ブロックを抜けるとコミットしてユーザーキャッシュを捨てる"""
+    @contextmanager
+    def connect():
+        conn = sqlite3.connect(test_db)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+        app_module.invalidate_user_cache()
+    return connect
+
+
+@pytest.fixture
+def make_user(seed):
+    """ユーザーを1人追加して id を返す。managed_by を渡すとその管理者の担当にする"""
+    def make(name, email=None, is_admin=False, managed_by=None, password_hash='hash', **columns):
+        columns = dict(columns, email=email or f'{name.lower()}@example.com', name=name,
+                       password_hash=password_hash, is_admin=int(is_admin))
+        with seed() as conn:
+            user_id = conn.execute(
+                f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                tuple(columns.values()),
+            ).lastrowid
+            if managed_by is not None:
+                conn.execute("INSERT INTO admin_managed_users (admin_id, user_id) VALUES (?, ?)",
+                             (managed_by, user_id))
+        return user_id
+    return make
+
+
+@pytest.fixture
+def app_client(test_db):
+    with app.test_client() as client:
+        yield client
+
+
+@pytest.fixture
+def login():
+    """テストクライアントのセッションをログイン済みにする (CSRFトークンは 'token')"""
+    def log_in(client, user_id, is_admin=False, name=None):
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['_csrf_token'] = 'token'
+            if is_admin:
+                sess['is_admin'] = True
+            if name is not None:
+                sess['user_name'] = name
+        return client
+    return log_in
+
+
+@pytest.fixture
+def query_budget():
+    """ブロック内のSQL実行回数が max_queries を超えたらテストを失敗させる"""
+    @contextmanager
+    def budget(max_queries):
+        with app_module.record_queries() as queries:
+            yield queries
+        if len(queries) > max_queries:
+            listing = '\n'.join(f"  {q['sql']}" for q in queries)
+            pytest.fail(f"query budget exceeded: {len(queries)} > {max_queries}\n{listing}")
+    return budget
+
+
+_session_started = time.perf_counter()
+
+
+def pytest_terminal_summary(terminalreporter):
+    """アプリの読み込み・生成時間とテスト全体の所要時間を表示する"""
+    startup = app_module.app.extensions['startup']
+    terminalreporter.write_sep('-', 'startup timings')
+    terminalreporter.write_line(
+        f"import {startup['import_ms']}ms / create_app {startup['create_app_ms']}ms / "
+        f"first request {startup['first_request_ms']}ms / "
+        f"test session {(time.perf_counter() - _session_started):.2f}s"
+    )
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_runtime_dir, ignore_errors=True)
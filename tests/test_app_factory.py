@@ -0,0 +1,66 @@
+import os, sys, subprocess
+import pytest
+import app as app_module
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_has_no_side_effects():
+    script = (
+        "import os, sys, sqlite3; sys.path.insert(0, sys.argv[1]);"
+        "calls = [];"
+        "sqlite3.connect = lambda *a, **k: calls.append('connect');"
+        "os.makedirs = lambda *a, **k: calls.append('makedirs');"
+        "import app; print(calls, 'app' in vars(app))"
+    )
+    env = {k: v for k, v in os.environ.items() if k != 'SECRET_KEY'}
+    out = subprocess.run([sys.executable, '-c', script, ROOT], capture_output=True, text=True, env=env, check=True)
+    assert out.stdout.strip() == '[] False'
+
+
+def test_create_app_builds_independent_app(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, 'DB_PATH', str(tmp_path / "test.db"))
+    app = app_module.create_app({
+        'SECRET_KEY': 'other-secret', 'TESTING': True,
+        'LOG_DIR': str(tmp_path / 'logs'), 'JINJA_CACHE_DIR': str(tmp_path / 'jinja'),
+    })
+    assert app is not app_module.app
+    assert 'index' in app.view_functions
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['_csrf_token'] = 'token'
+        resp = client.post('/login', data={'_csrf_token': 'token', 'email': 'nobody@example.com', 'password': 'x'})
+        assert resp.status_code == 200
+    # DB は最初に使われたときに作られ、コンパイル済みテンプレートはキャッシュに保存される
+    assert os.path.exists(app_module.DB_PATH)
+    assert os.listdir(tmp_path / 'jinja')
+    assert app.extensions['startup']['first_request_ms'] is not None
+
+
+def test_create_app_requires_secret_key(monkeypatch):
+    monkeypatch.delenv('SECRET_KEY', raising=False)
+    with pytest.raises(RuntimeError):
+        app_module.create_app()
+
+
+def test_bytecode_cache_ignores_untrusted_directory(tmp_path):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    os.chmod(shared, 0o777)
+    app = app_module.create_app({
+        'SECRET_KEY': 'other-secret', 'TESTING': True,
+        'LOG_DIR': str(tmp_path / 'logs'), 'JINJA_CACHE_DIR': str(shared),
+    })
+    with app.test_client() as client:
+        assert client.get('/login').status_code == 200
+    # 他のユーザーが書き込めるディレクトリには保存も読み込みもしない
+    assert os.listdir(shared) == []
+    own = tmp_path / 'own'
+    app = app_module.create_app({
+        'SECRET_KEY': 'other-secret', 'TESTING': True,
+        'LOG_DIR': str(tmp_path / 'logs'), 'JINJA_CACHE_DIR': str(own),
+    })
+    with app.test_client() as client:
+        client.get('/login')
+    assert os.stat(own).st_mode & 0o777 == 0o700
+    assert os.listdir(own)
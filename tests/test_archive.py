@@ -0,0 +1,137 @@
+import pytest
+import app as app_module
+import sqlite3
+from datetime import datetime
+
+NOW = datetime(2026, 3, 1)
+
+
+@pytest.fixture
+def client(monkeypatch, app_client, seed, make_user, login):
+    monkeypatch.setattr(app_module, 'ARCHIVE_DIR', '')
+    monkeypatch.setattr(app_module, 'ARCHIVE_KEEP_YEARS', 1)
+    monkeypatch.setattr(app_module, 'ARCHIVE_MESSAGE_DAYS', 365)
+    admin_id = make_user('Admin', is_admin=True)
+    user_id = make_user('User', managed_by=admin_id)
+    with seed() as conn:
+        for ts, typ in [('2023-05-01T09:00:00', 'in'), ('2023-05-01T19:00:00', 'out'),
+                        ('2024-06-03T09:00:00', 'in'), ('2025-07-01T09:00:00', 'in')]:
+            conn.execute("INSERT INTO attendance (user_id, timestamp, type, description) VALUES (?, ?, ?, '')",
+                         (user_id, ts, typ))
+        for n, (ts, is_read) in enumerate([('2024-01-05 10:00:00', 1), ('2024-02-05 10:00:00', 1),
+                                           ('2024-03-05 10:00:00', 0), ('2026-02-01 10:00:00', 1)]):
+            conn.execute(
+                "INSERT INTO messages (sender_id, recipient_id, message, timestamp, is_read) VALUES (?, ?, ?, ?, ?)",
+                (admin_id, user_id, f'm{n}', ts, is_read),
+            )
+    return login(app_client, user_id, name='User'), admin_id, user_id
+
+
+def hot_count(table):
+    conn = sqlite3.connect(app_module.DB_PATH)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_archiver_moves_closed_years_and_old_read_messages(client):
+    moved = app_module.archive_old_data(now=NOW)
+    assert moved == {'attendance': {2023: 2, 2024: 1}, 'messages': {2024: 2}}
+    assert hot_count('attendance') == 1
+    # 未読と最近のメッセージはホット DB に残る
+    assert hot_count('messages') == 2
+    archive = sqlite3.connect(app_module.archive_path(2023))
+    assert archive.execute("SELECT COUNT(*) FROM attendance").fetchone()[0] == 2
+    archive.close()
+    assert app_module.archive_old_data(now=NOW) == {'attendance': {}, 'messages': {}}
+
+
+def test_reads_attach_archives_on_demand(client, tmp_path):
+    client, admin_id, user_id = client
+    app_module.archive_old_data(now=NOW)
+    body = client.get('/my/logs').get_data(as_text=True)
+    assert '2025-07-01' in body and '2023-05-01' not in body
+    assert '2023年' in body
+    body = client.get('/my/logs?year=2023').get_data(as_text=True)
+    assert '2023-05-01' in body and '2025-07-01' not in body
+    with app_module.read_snapshot(attendance_years=(2023,)) as snapshot:
+        path = app_module.generate_csv(user_id, 'User', 2023, 5, str(tmp_path), conn=snapshot)
+    with open(path, encoding='utf-8-sig') as f:
+        assert f.read().splitlines()[1] == '2023/05/01,月,09:00,19:00,,01:00'
+    history = client.get(f'/chat/history/{admin_id}?limit=10').get_json()['messages']
+    assert [m['message'] for m in history] == ['m0', 'm1', 'm2', 'm3']
+    older = client.get(f'/chat/history/{admin_id}?before={history[2]["id"]}&limit=1').get_json()['messages']
+    assert [m['message'] for m in older] == ['m1']
+
+
+def test_archived_years_are_read_only(client):
+    client, admin_id, user_id = client
+    app_module.archive_old_data(now=NOW)
+    resp = client.post('/punch', data={'_csrf_token': 'token', 'timestamp': '2023-05-02T09:00', 'type': 'in'},
+                       follow_redirects=True)
+    assert 'アーカイブ済みの年には打刻できません' in resp.get_data(as_text=True)
+    conn = sqlite3.connect(app_module.DB_PATH)
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO attendance (user_id, timestamp, type) VALUES (?, '2023-05-02T09:00:00', 'in')",
+                     (user_id,))
+    conn.close()
+    assert client.get('/my/logs/edit/2023-05-01').status_code == 302
+
+
+def test_conflict_resolution_rejects_archived_years(client):
+    client, admin_id, user_id = client
+    app_module.archive_old_data(now=NOW)
+    resp = client.post('/punch/resolve', data={
+        '_csrf_token': 'token', 'action': 'overwrite', 'day': '2023-05-01', 'type': 'in',
+        'timestamp': '2023-05-01T08:30:00', 'referer': '/',
+    }, follow_redirects=True)
+    assert resp.status_code == 200
+    assert 'アーカイブ済みの年には打刻できません' in resp.get_data(as_text=True)
+    resp = client.post('/my/import/resolve', data={
+        '_csrf_token': 'token', 'referer': '/my/logs',
+        'choice_2023-05-01_out': 'incoming', 'incoming_ts_2023-05-01_out': '2023-05-01T20:00:00',
+        'choice_2025-07-01_out': 'incoming', 'incoming_ts_2025-07-01_out': '2025-07-01T18:00:00',
+    })
+    assert resp.status_code == 302
+    with client.session_transaction() as sess:
+        assert ('danger', 'アーカイブ済みの年 (2023) の勤怠は取り込めません。') in sess['_flashes']
+    assert hot_count('attendance') == 1
+
+
+def test_my_logs_etag_follows_archived_years(client):
+    client, admin_id, user_id = client
+    # 管理者には打刻がないので、アーカイブしても勤怠のバージョンは変わらない
+    with client.session_transaction() as sess:
+        sess['user_id'] = admin_id
+    etag = client.get('/my/logs').headers['ETag']
+    assert client.get('/my/logs', headers={'If-None-Match': etag}).status_code == 304
+    app_module.archive_old_data(now=NOW)
+    resp = client.get('/my/logs', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert '2023年' in resp.get_data(as_text=True)
+
+
+def test_archiving_keeps_conversation_summaries(client, seed, make_user):
+    client, admin_id, user_id = client
+    late_id = make_user('Late', managed_by=admin_id)
+    mid_id = make_user('Mid', managed_by=admin_id)
+    with seed() as conn:
+        conn.executemany(
+            "INSERT INTO messages (sender_id, recipient_id, message, timestamp, is_read) VALUES (?, ?, ?, ?, ?)",
+            [(late_id, admin_id, '未読の古い連絡', '2024-01-10 10:00:00', 0),
+             (late_id, admin_id, '最新の既読', '2024-06-01 10:00:00', 1),
+             (mid_id, admin_id, '未読', '2024-03-01 10:00:00', 0)],
+        )
+
+    def partners():
+        with app_module.app.app_context():
+            rows = app_module.fetch_chat_partners(app_module.get_db(), admin_id, as_admin=True)
+            return [(row['name'], row['preview'], row['last_timestamp'], row['unread']) for row in rows]
+
+    before = partners()
+    assert [name for name, *_ in before] == ['User', 'Late', 'Mid']
+    app_module.archive_old_data(now=NOW)
+    # 最新メッセージをアーカイブへ移しても、プレビューと並び順は移す前のまま
+    assert partners() == before
+    assert hot_count('messages') == 4
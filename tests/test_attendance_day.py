@@ -0,0 +1,90 @@
+import pytest
+import app as app_module
+import sqlite3
+from datetime import date, timedelta
+from utils import split_timestamp, date_to_day, format_day, format_minute, weekday_of_day
+
+
+@pytest.fixture
+def db(test_db, make_user):
+    make_user('u', id=1)
+    conn = sqlite3.connect(test_db)
+    yield conn
+    conn.close()
+
+
+def test_day_helpers():
+    assert split_timestamp('2024-03-05T08:07:00') == (20240305, 487)
+    assert split_timestamp('2024-03-05T23:59') == (20240305, 1439)
+    assert date_to_day('2024-12-31') == 20241231
+    assert date_to_day('2024-02-29') == 20240229
+    assert format_day(20240305) == '2024-03-05'
+    assert format_day(20240305, '/') == '2024/03/05'
+    assert format_minute(487) == '08:07'
+    d = date(2023, 12, 25)
+    for _ in range(800):
+        assert weekday_of_day(date_to_day(d.isoformat())) == d.weekday()
+        d += timedelta(days=1)
+    for bad in ('2024-03-05', '2024-03-05T24:00', 'abc', '2024-13-01T08:00', '2024-02-31T08:00', '2023-02-29T08:00'):
+        with pytest.raises(ValueError):
+            split_timestamp(bad)
+
+
+def test_plain_insert_fills_day_and_minute(db):
+    db.execute("INSERT INTO attendance (user_id, timestamp, type, description) VALUES (1, '2024-03-05T08:07:00', 'in', '')")
+    assert db.execute("SELECT day, minute FROM attendance").fetchone() == (20240305, 487)
+    db.execute("UPDATE attendance SET timestamp = '2024-03-06T18:30:00'")
+    assert db.execute("SELECT day, minute FROM attendance").fetchone() == (20240306, 1110)
+
+
+def test_backfill_existing_rows(db):
+    db.executemany(
+        "INSERT INTO attendance (user_id, timestamp, type, description) VALUES (1, ?, ?, '')",
+        [('2024-03-05T08:07:00', 'in'), ('2024-03-05T17:45:00', 'out'), ('broken', 'in')],
+    )
+    db.execute("UPDATE attendance SET day = NULL, minute = NULL")
+    db.commit()
+    app_module.backfill_attendance_day_minute(db)
+    rows = db.execute("SELECT timestamp, day, minute FROM attendance ORDER BY id").fetchall()
+    assert rows == [
+        ('2024-03-05T08:07:00', 20240305, 487),
+        ('2024-03-05T17:45:00', 20240305, 1065),
+        ('broken', None, None),
+    ]
+
+
+def test_unparseable_rows_stay_null_and_render_raw(db, app_client, login):
+    db.executemany(
+        "INSERT INTO attendance (user_id, timestamp, type, description) VALUES (1, ?, ?, '')",
+        [('2024-03-05T08:07:00', 'in'), ('broken', 'in')],
+    )
+    assert db.execute("SELECT day, minute FROM attendance WHERE timestamp = 'broken'").fetchone() == (None, None)
+    # 0009 より前に 0 で埋めた行も NULL に戻す
+    db.execute("UPDATE attendance SET day = 0, minute = 0 WHERE timestamp = 'broken'")
+    db.execute("PRAGMA user_version = 8")
+    db.commit()
+    assert app_module.initialize_database() == [9]
+    assert db.execute("SELECT day FROM attendance WHERE timestamp = 'broken'").fetchone() == (None,)
+    db.execute("UPDATE attendance SET timestamp = 'still broken' WHERE timestamp = 'broken'")
+    db.commit()
+    assert db.execute("SELECT day FROM attendance WHERE timestamp = 'still broken'").fetchone() == (None,)
+
+    html = login(app_client, 1).get('/my/logs').get_data(as_text=True)
+    assert '0000-00-00' not in html
+    assert 'still broken' in html
+    assert '2024-03-05' in html
+
+
+def test_generate_csv_uses_day_columns(db, tmp_path):
+    app_module.insert_attendance(db, 1, '2024-03-04T09:00:00', 'in', '')
+    app_module.insert_attendance(db, 1, '2024-03-04T19:30:00', 'out', '会議')
+    app_module.insert_attendance(db, 1, '2024-04-01T09:00:00', 'in', '')
+    db.commit()
+    path = app_module.generate_csv(1, 'u', 2024, 3, str(tmp_path), conn=db)
+    with open(path, encoding='utf-8-sig') as f:
+        lines = f.read().splitlines()
+    assert lines == [
+        '日付,曜日,出勤時刻,退勤時刻,業務内容,残業時間',
+        '2024/03/04,月,09:00,19:30,会議,01:30',
+    ]
+    assert app_module.generate_csv(1, 'u', 2024, 12, str(tmp_path), conn=db) is None
@@ -0,0 +1,36 @@
+import json, logging
+import app as app_module
+from benchmarks import run as bench
+
+
+def test_benchmark_smoke(tmp_path, monkeypatch):
+    # ベンチマークは app の設定を書き換えるので、テスト後に戻す
+    monkeypatch.setattr(app_module, 'DB_PATH', app_module.DB_PATH)
+    monkeypatch.setattr(app_module, 'EXPORT_DIR', app_module.EXPORT_DIR)
+    monkeypatch.setattr(logging.getLogger('app'), 'level', logging.getLogger('app').level)
+    monkeypatch.setattr(app_module.app.logger, 'level', app_module.app.logger.level)
+    output = tmp_path / 'bench.json'
+    assert bench.main(['--users', '3', '--admins', '2', '--messages', '4', '--repeat', '2',
+                       '--output', str(output)]) == 0
+    report = json.loads(output.read_text(encoding='utf-8'))
+    assert set(report['results']) == {
+        'punch', 'view_my_logs', 'import_csv', 'export_combined_single', 'export_combined_bulk',
+        'chat', 'chat_send', 'chat_history', 'unread_counts_api',
+    }
+    assert report['results']['punch']['runs'] == 2
+    assert bench.main(['--users', '3', '--admins', '2', '--messages', '4', '--repeat', '2',
+                       '--only', 'punch', '--compare', str(output), '--fail-over', '100000']) == 0
+
+
+def test_sse_load_smoke(monkeypatch):
+    from benchmarks import sse_load
+    monkeypatch.setattr(app_module, 'DB_PATH', app_module.DB_PATH)
+    monkeypatch.setattr(app_module, 'EXPORT_DIR', app_module.EXPORT_DIR)
+    monkeypatch.setattr(logging.getLogger('app'), 'level', logging.getLogger('app').level)
+    monkeypatch.setattr(app_module.app.logger, 'level', app_module.app.logger.level)
+    result = sse_load.run_load(clients=5, messages=2, duration=0.3, admins=2, senders=5,
+                               reconnect_rate=0, settle=0.5, seed=1)
+    assert result['connected'] == 5
+    assert result['sent'] == 10
+    assert result['delivered'] == 10
+    assert result['lost_events'] == {'stable': 0, 'reconnected': 0}
@@ -0,0 +1,90 @@
+import pytest
+import app as app_module
+import sqlite3
+
+
+@pytest.fixture
+def client(app_client, seed, make_user, login):
+    admin_id = make_user('Admin', is_admin=True)
+    user_id = make_user('User', managed_by=admin_id)
+    other_id = make_user('Other')
+    texts = ['おはようございます', '来週の会議の資料', '打刻の修正をお願いします', '<b>修正します</b>']
+    texts += [f'雑談 {n}' for n in range(30)]
+    with seed() as conn:
+        for n, text in enumerate(texts):
+            sender, recipient = (admin_id, user_id) if n % 2 else (user_id, admin_id)
+            conn.execute(
+                "INSERT INTO messages (sender_id, recipient_id, message, timestamp) VALUES (?, ?, ?, ?)",
+                (sender, recipient, text, f'2024-04-01 09:{n:02d}:00'),
+            )
+        conn.execute(
+            "INSERT INTO messages (sender_id, recipient_id, message, timestamp) VALUES (?, ?, '打刻の修正をお願いします', '2024-04-01 10:00:00')",
+            (other_id, admin_id),
+        )
+    return login(app_client, admin_id, is_admin=True), admin_id, user_id, other_id
+
+
+def test_search_returns_ranked_snippets_within_conversation(client):
+    client, admin_id, user_id, other_id = client
+    results = client.get(f'/chat/search/{user_id}?q=修正を').get_json()['results']
+    assert len(results) == 1
+    assert results[0]['id'] == 3
+    assert results[0]['snippet'] == '打刻の<mark>修正を</mark>お願いします'
+    results = client.get(f'/chat/search/{user_id}?q=修正します').get_json()['results']
+    # 本文の HTML はエスケープされ、一致箇所だけが <mark> になる
+    assert results[0]['snippet'] == '&lt;b&gt;<mark>修正します</mark>&lt;/b&gt;'
+    assert client.get(f'/chat/search/{other_id}?q=修正を').status_code == 403
+
+
+def test_short_terms_fall_back_to_like(client):
+    client, admin_id, user_id, other_id = client
+    results = client.get(f'/chat/search/{user_id}?q=会議').get_json()['results']
+    assert [r['snippet'] for r in results] == ['来週の<mark>会議</mark>の資料']
+    assert client.get(f'/chat/search/{user_id}?q=%25').get_json()['results'] == []
+
+
+def test_search_limit_is_clamped(client):
+    client, admin_id, user_id, other_id = client
+    assert len(client.get(f'/chat/search/{user_id}?q=雑談&limit=-1').get_json()['results']) == 1
+    assert len(client.get(f'/chat/search/{user_id}?q=雑談&limit=abc').get_json()['results']) == 20
+    assert len(client.get(f'/chat/search/{user_id}?q=雑談&limit=100').get_json()['results']) == 30
+
+
+def test_search_without_trigram_support_uses_like(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, 'DB_PATH', str(tmp_path / "old.db"))
+    monkeypatch.setattr(app_module.sqlite3, 'sqlite_version_info', (3, 31, 1))
+    app_module.initialize_database()
+    conn = sqlite3.connect(app_module.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    assert not app_module.messages_fts_available(conn)
+    conn.execute(
+        "INSERT INTO messages (sender_id, recipient_id, message, timestamp) VALUES (1, 2, '打刻の修正をお願いします', '2024-04-01 09:00:00')"
+    )
+    results = app_module.search_conversation(conn, 1, 2, '修正を', 20)
+    conn.close()
+    assert [r['snippet'] for r in results] == ['打刻の<mark>修正を</mark>お願いします']
+
+
+def test_index_follows_deletes_and_existing_rows_are_indexed(client):
+    client, admin_id, user_id, other_id = client
+    conn = sqlite3.connect(app_module.DB_PATH)
+    conn.execute("DELETE FROM messages WHERE id = 3")
+    # 索引導入前の DB を再現し、マイグレーションで既存行が取り込まれることを確かめる
+    conn.executescript(
+        "DROP TABLE messages_fts; DROP TRIGGER trg_messages_fts_insert; DROP TRIGGER trg_messages_fts_delete;"
+        "DROP TRIGGER trg_messages_fts_update;"
+    )
+    app_module.create_messages_fts(conn)
+    conn.close()
+    assert client.get(f'/chat/search/{user_id}?q=修正を').get_json()['results'] == []
+    assert client.get(f'/chat/search/{user_id}?q=来週の会議').get_json()['results'][0]['id'] == 2
+
+
+def test_history_around_message(client):
+    client, admin_id, user_id, other_id = client
+    data = client.get(f'/chat/history/{user_id}?around=3&limit=2').get_json()
+    assert [m['id'] for m in data['messages']] == [2, 3, 4, 5]
+    assert data['has_newer'] is True
+    data = client.get(f'/chat/history/{user_id}?around=33&limit=2').get_json()
+    assert [m['id'] for m in data['messages']] == [32, 33, 34]
+    assert data['has_newer'] is False
@@ -0,0 +1,52 @@
+import os
+import gzip
+import pytest
+import app as app_module
+app = app_module.app
+
+
+@pytest.fixture
+def client(app_client, make_user, login):
+    return login(app_client, make_user('User'), name='User')
+
+
+def test_streamed_page_is_gzipped(client):
+    resp = client.get('/my/logs', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in resp.headers['Vary']
+    assert '勤怠履歴' in gzip.decompress(resp.get_data()).decode('utf-8')
+
+
+def test_small_or_unaccepted_responses_are_not_compressed(client):
+    assert 'Content-Encoding' not in client.get('/chat/unread_count', headers={'Accept-Encoding': 'gzip'}).headers
+    assert 'Content-Encoding' not in client.get('/my/logs').headers
+
+
+def test_hashed_assets_are_immutable(client):
+    with app.test_request_context():
+        url = app_module.asset_url('style.css')
+    assert url.startswith('/assets/')
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert 'immutable' in resp.headers['Cache-Control']
+    assert 'max-age=31536000' in resp.headers['Cache-Control']
+    assert client.get('/assets/000000000000/style.css').status_code == 404
+    manifest = client.get('/asset-manifest.json').get_json()
+    assert url in manifest['assets'] and manifest['version']
+    assert not any(a.endswith('/sw.js') for a in manifest['assets'])
+
+
+def test_hashed_assets_are_compressed_once(client, monkeypatch):
+    monkeypatch.setattr(app_module, '_compressed_assets', {})
+    with app.test_request_context():
+        url = app_module.asset_url('style.css')
+    resp = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    with open(os.path.join(app_module.STATIC_DIR, 'style.css'), 'rb') as f:
+        assert gzip.decompress(resp.get_data()) == f.read()
+    assert list(app_module._compressed_assets) == [('style.css', url.split('/')[2], 'gzip')]
+    etag = resp.headers['ETag']
+    assert etag.endswith('-gzip"')
+    resp = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert 'Content-Encoding' not in client.get(url).headers
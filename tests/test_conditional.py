@@ -0,0 +1,51 @@
+import pytest
+import app as app_module
+import sqlite3
+
+
+@pytest.fixture
+def client(app_client, make_user, login):
+    admin_id = make_user('Admin', is_admin=True)
+    user_id = make_user('User', managed_by=admin_id)
+    return login(app_client, user_id, name='User'), admin_id, user_id
+
+
+def execute(sql, params=()):
+    conn = sqlite3.connect(app_module.DB_PATH)
+    conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def test_my_logs_not_modified_until_attendance_changes(client):
+    client, admin_id, user_id = client
+    first = client.get('/my/logs')
+    first.get_data()
+    etag = first.headers['ETag']
+    with app_module.record_queries() as queries:
+        resp = client.get('/my/logs', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert not any('FROM attendance WHERE' in q['sql'] for q in queries)
+    execute("INSERT INTO attendance (user_id, timestamp, type) VALUES (?, '2024-01-01T09:00:00', 'in')", (user_id,))
+    resp = client.get('/my/logs', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+
+def test_chat_apis_revalidate_on_new_message_and_read(client):
+    client, admin_id, user_id = client
+    etag = client.get(f'/chat/history/{admin_id}').headers['ETag']
+    counts_etag = client.get('/chat/unread_counts').headers['ETag']
+    assert client.get(f'/chat/history/{admin_id}', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/chat/unread_counts', headers={'If-None-Match': counts_etag}).status_code == 304
+    execute(
+        "INSERT INTO messages (sender_id, recipient_id, message, timestamp) VALUES (?, ?, 'hi', '2024-01-01 09:00:00')",
+        (admin_id, user_id),
+    )
+    resp = client.get(f'/chat/history/{admin_id}', headers={'If-None-Match': etag})
+    assert resp.status_code == 200 and resp.get_json()['messages'][0]['message'] == 'hi'
+    resp = client.get('/chat/unread_counts', headers={'If-None-Match': counts_etag})
+    assert resp.status_code == 200 and resp.get_json()[str(admin_id)] == 1
+    etag = resp.headers['ETag']
+    execute("UPDATE messages SET is_read = 1")
+    assert client.get('/chat/unread_counts', headers={'If-None-Match': etag}).status_code == 200
@@ -0,0 +1,96 @@
+import pytest
+import app as app_module
+import sqlite3
+app = app_module.app
+
+
+@pytest.fixture
+def client(app_client, seed, make_user, login):
+    admin_id = make_user('Admin', is_admin=True)
+    user_ids = [make_user(name, managed_by=admin_id) for name in ('Aoki', 'Baba', 'Chiba')]
+    rows = [
+        (user_ids[0], admin_id, 'おはようございます', '2024-04-01 09:00:00'),
+        (admin_id, user_ids[0], 'おはよう', '2024-04-01 09:05:00'),
+        (user_ids[1], admin_id, '打刻を忘れました', '2024-04-02 18:00:00'),
+        (user_ids[1], admin_id, '修正をお願いします', '2024-04-02 18:01:00'),
+    ]
+    with seed() as conn:
+        conn.executemany(
+            "INSERT INTO messages (sender_id, recipient_id, message, timestamp) VALUES (?, ?, ?, ?)", rows
+        )
+    return login(app_client, admin_id, is_admin=True, name='Admin'), admin_id, user_ids
+
+
+def partners(admin_id):
+    conn = app_module.get_db()
+    return [dict(row) for row in app_module.fetch_chat_partners(conn, admin_id, as_admin=True)]
+
+
+def test_list_is_ordered_by_latest_message(client):
+    client, admin_id, (aoki, baba, chiba) = client
+    with app.app_context():
+        rows = partners(admin_id)
+    assert [r['id'] for r in rows] == [baba, aoki, chiba]
+    assert [r['unread'] for r in rows] == [2, 1, 0]
+    assert rows[0]['preview'] == '修正をお願いします'
+    assert rows[2]['preview'] is None
+    client.post(f'/chat/{aoki}', data={'_csrf_token': 'token', 'message': '今日は在宅です'})
+    with app.app_context():
+        rows = partners(admin_id)
+    assert [r['id'] for r in rows] == [aoki, baba, chiba]
+    assert rows[0]['last_sender_id'] == admin_id
+    page = client.get('/admin/chat').get_data(as_text=True)
+    assert page.index('Aoki') < page.index('Baba') < page.index('Chiba')
+    assert 'あなた: 今日は在宅です' in page
+
+
+def test_unread_counts_follow_mark_read_and_delete(client):
+    client, admin_id, (aoki, baba, chiba) = client
+    assert client.get('/chat/unread_counts').get_json() == {str(aoki): 1, str(baba): 2, str(chiba): 0}
+    client.post(f'/chat/mark_read/{baba}', headers={'X-CSRF-Token': 'token'})
+    assert client.get('/chat/unread_counts').get_json()[str(baba)] == 0
+    assert client.get('/chat/unread_count').get_json() == {'count': 1}
+    conn = sqlite3.connect(app_module.DB_PATH)
+    conn.execute("DELETE FROM messages WHERE id = 2")
+    conn.commit()
+    conn.close()
+    with app.app_context():
+        rows = {r['id']: r for r in partners(admin_id)}
+    # 最新メッセージが消えたら残っている中で最新のものに戻る
+    assert rows[aoki]['preview'] == 'おはようございます'
+    assert rows[aoki]['unread'] == 1
+
+
+def test_chat_list_does_not_scan_messages(client, query_budget):
+    client, admin_id, user_ids = client
+    client.get('/admin/chat')
+    with query_budget(2) as queries:
+        assert client.get('/admin/chat').status_code == 200
+    # 一覧もヘッダーの未読バッジも要約から引き、messages は読まない
+    assert not any('messages' in q['sql'] for q in queries)
+
+
+def test_migration_builds_summary_from_existing_messages(client):
+    client, admin_id, (aoki, baba, chiba) = client
+    with app.app_context():
+        before = partners(admin_id)
+    conn = sqlite3.connect(app_module.DB_PATH)
+    # 0007 より前の DB (要約なし、ETag 用の conversation_versions あり) に戻してから移行し直す
+    conn.executescript(
+        "DROP TABLE conversations; DROP TRIGGER trg_conversations_insert; DROP TRIGGER trg_conversations_update;"
+        "DROP TRIGGER trg_conversations_delete; DROP TRIGGER trg_messages_inbox_insert;"
+        "DROP TRIGGER trg_messages_inbox_update; DROP TRIGGER trg_messages_inbox_delete;"
+    )
+    with open(app_module.SCHEMA_PATH, encoding='utf-8') as f:
+        conn.executescript(f.read())
+    conn.execute("INSERT INTO conversation_versions (user_low, user_high, last_message_id, read_version) VALUES (?, ?, 2, 5)", (admin_id, aoki))
+    conn.execute("PRAGMA user_version = 6")
+    conn.commit()
+    conn.close()
+    assert app_module.initialize_database() == [7, 8, 9]
+    with app.app_context():
+        assert partners(admin_id) == before
+        # ETag 用の回数は conversations に引き継がれ、古い表は残らない
+        assert app_module.fetch_conversation_version(admin_id, aoki) == (2, 5)
+        tables = {row[0] for row in app_module.get_db().execute("SELECT name FROM sqlite_master")}
+    assert 'conversation_versions' not in tables and 'trg_messages_version_insert' not in tables
@@ -0,0 +1,86 @@
+import os, time
+import pytest
+import app as app_module
+import sqlite3
+from datetime import datetime, timedelta
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch, app_client, make_user, login):
+    monkeypatch.setattr(app_module, 'EXPORT_DIR', str(tmp_path / "exports"))
+    monkeypatch.setattr(app_module, 'EXPORT_MAX_AGE_DAYS', 30)
+    monkeypatch.setattr(app_module, 'EXPORT_MAX_BYTES', 0)
+    monkeypatch.setitem(app_module._export_janitor_state, 'scanned', False)
+    return login(app_client, make_user('Admin', is_admin=True), is_admin=True)
+
+
+def write_export(relpath, size, recorded=True):
+    path = os.path.join(app_module.EXPORT_DIR, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    if recorded:
+        conn = sqlite3.connect(app_module.DB_PATH)
+        app_module.record_export_file(conn, path)
+        conn.commit()
+        conn.close()
+    return path
+
+
+def set_last_access(relpath, when):
+    conn = sqlite3.connect(app_module.DB_PATH)
+    conn.execute("UPDATE export_files SET last_access = ? WHERE path = ?",
+                 (when.strftime('%Y-%m-%d %H:%M:%S'), relpath))
+    conn.commit()
+    conn.close()
+
+
+def test_expired_and_untracked_files_are_removed(client):
+    old = write_export('2023/01/old.csv', 100, recorded=False)
+    stamp = time.time() - 40 * 86400
+    os.utime(old, (stamp, stamp))
+    write_export('2024/05/new.csv', 50)
+    assert app_module.clean_exports() == {'files': 1, 'bytes': 100}
+    assert not os.path.exists(old)
+    # 空になったディレクトリも片付ける
+    assert not os.path.exists(os.path.join(app_module.EXPORT_DIR, '2023'))
+    status = client.get('/admin/exports/janitor').get_json()
+    assert status['last_bytes_reclaimed'] == 100
+    assert status['total_files'] == 1 and status['total_bytes'] == 50
+
+
+def test_size_quota_removes_least_recently_used(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'EXPORT_MAX_BYTES', 250)
+    now = datetime.now()
+    for n in range(3):
+        write_export(f'2024/0{n + 1}/file.csv', 100)
+        set_last_access(f'2024/0{n + 1}/file.csv', now - timedelta(days=3 - n))
+    # ダウンロードされたファイルは最近使ったものとして残る
+    assert client.get('/exports/2024/01/file.csv').status_code == 200
+    assert app_module.clean_exports() == {'files': 1, 'bytes': 100}
+    remaining = sorted(os.listdir(os.path.join(app_module.EXPORT_DIR, '2024')))
+    assert remaining == ['01', '03']
+
+
+def test_recent_large_export_survives_quota(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'EXPORT_MAX_BYTES', 100)
+    write_export('2024/06/big.zip', 500)
+    # 書き出した直後のファイルは、1件で上限を超えていても消さない
+    assert app_module.clean_exports() == {'files': 0, 'bytes': 0}
+    later = datetime.now() + timedelta(minutes=app_module.EXPORT_EVICT_MIN_AGE_MINUTES + 1)
+    assert app_module.clean_exports(now=later) == {'files': 1, 'bytes': 500}
+
+
+def test_scan_and_removal_run_off_the_event_loop(client, monkeypatch):
+    from gevent import monkey
+    get_ident = monkey.get_original('threading', 'get_ident')
+    calls = []
+    scan = app_module._scan_export_dir
+    remove = app_module._remove_exports
+    monkeypatch.setattr(app_module, '_scan_export_dir', lambda: calls.append(get_ident()) or scan())
+    monkeypatch.setattr(app_module, '_remove_exports', lambda paths: calls.append(get_ident()) or remove(paths))
+    old = write_export('2023/01/old.csv', 100)
+    set_last_access('2023/01/old.csv', datetime.now() - timedelta(days=40))
+    assert app_module.clean_exports() == {'files': 1, 'bytes': 100}
+    assert not os.path.exists(old)
+    assert len(calls) == 2 and get_ident() not in calls
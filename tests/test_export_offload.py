@@ -0,0 +1,59 @@
+import os
+import pytest
+import app as app_module
+import sqlite3
+app = app_module.app
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch, app_client, seed, make_user, login):
+    monkeypatch.setattr(app_module, 'EXPORT_DIR', str(tmp_path / "exports"))
+    monkeypatch.setattr(app_module, 'EXPORT_OFFLOAD', '')
+    admin_id = make_user('Admin', is_admin=True)
+    user_id = make_user('User', managed_by=admin_id)
+    with seed() as conn:
+        conn.execute("INSERT INTO attendance (user_id, timestamp, type) VALUES (?, '2024-04-01T09:00:00', 'in')", (user_id,))
+    path = os.path.join(app_module.EXPORT_DIR, '2024', '04', '勤怠.csv')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('日付,曜日\n' * 100)
+    return login(app_client, admin_id, is_admin=True)
+
+
+def test_direct_mode_supports_range_and_conditional(client):
+    resp = client.get('/exports/2024/04/勤怠.csv', headers={'Range': 'bytes=0-9'})
+    assert resp.status_code == 206
+    assert len(resp.data) == 10
+    etag = client.get('/exports/2024/04/勤怠.csv').headers['ETag']
+    assert client.get('/exports/2024/04/勤怠.csv', headers={'If-None-Match': etag}).status_code == 304
+    # エクスポートはリクエスト内で読み込んで圧縮しない
+    assert 'Content-Encoding' not in client.get('/exports/2024/04/勤怠.csv', headers={'Accept-Encoding': 'gzip'}).headers
+
+
+def test_nginx_offload_emits_accel_redirect(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'EXPORT_OFFLOAD', 'nginx')
+    resp = client.get('/exports/2024/04/勤怠.csv')
+    assert resp.status_code == 200
+    assert resp.data == b''
+    assert resp.headers['X-Accel-Redirect'] == '/protected-exports/2024/04/%E5%8B%A4%E6%80%A0.csv'
+    assert 'X-Sendfile' not in resp.headers
+    assert "filename*=UTF-8''%E5%8B%A4%E6%80%A0.csv" in resp.headers['Content-Disposition']
+    # パス検査はオフロード時も変わらない
+    assert client.get('/exports/../app.py').status_code == 400
+
+
+def test_sendfile_offload_and_persisted_bulk_zip(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'EXPORT_OFFLOAD', 'sendfile')
+    resp = client.post('/admin/export', data={
+        '_csrf_token': 'token', 'year': '2024', 'month': '4', 'action': 'bulk_all',
+    })
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/zip'
+    zip_path = resp.headers['X-Sendfile']
+    assert os.path.dirname(zip_path) == os.path.realpath(os.path.join(app_module.EXPORT_DIR, '2024', '04'))
+    assert os.path.isfile(zip_path)
+    assert [name for name in os.listdir(os.path.dirname(zip_path)) if name.startswith('.')] == []
+    conn = sqlite3.connect(app_module.DB_PATH)
+    paths = [row[0] for row in conn.execute("SELECT path FROM export_files")]
+    conn.close()
+    assert f'2024/04/{os.path.basename(zip_path)}' in paths
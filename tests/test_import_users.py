@@ -0,0 +1,49 @@
+import io
+import pytest
+import app as app_module
+import sqlite3
+
+
+@pytest.fixture
+def client(monkeypatch, app_client, seed, make_user, login):
+    monkeypatch.setattr(app_module, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')
+    admin_id = make_user('Admin', is_admin=True)
+    with seed() as conn:
+        conn.execute(
+            "INSERT INTO mail_settings (id, server, port, subject_template, body_template)"
+            " VALUES (1, 'localhost', 25, 'Welcome', 'Hello {name}')"
+        )
+    return login(app_client, admin_id, is_admin=True), admin_id
+
+
+def test_bulk_import_reports_each_row(client):
+    client, admin_id = client
+    body = (
+        "氏名,メールアドレス,管理者,残業開始時刻,パスワード\n"
+        "Alice,alice@example.com,0,18:30,\n"
+        "Bob,bob@example.com,1,,password123\n"
+        "Dup,ADMIN@example.com,0,,\n"
+        "Bad,bad@example.com,0,25:00,\n"
+    ).encode('utf-8-sig')
+    resp = client.post('/admin/users/import', data={
+        '_csrf_token': 'token', 'file': (io.BytesIO(body), 'users.csv'),
+    }, content_type='multipart/form-data')
+    assert resp.status_code == 200
+    html = resp.get_data(as_text=True)
+    assert html.count('<td>登録しました</td>') == 2
+    assert 'すでに登録されています' in html
+    assert 'HH:MM' in html
+
+    conn = sqlite3.connect(app_module.DB_PATH)
+    users = {r[0]: r[1:] for r in conn.execute(
+        "SELECT email, is_admin, overtime_threshold, password_hash FROM users")}
+    managed = {r[0] for r in conn.execute(
+        "SELECT user_id FROM admin_managed_users WHERE admin_id = ?", (admin_id,))}
+    outbox = conn.execute("SELECT COUNT(*) FROM mail_outbox").fetchone()[0]
+    conn.close()
+    assert users['alice@example.com'][:2] == (0, '18:30')
+    assert users['bob@example.com'][:2] == (1, '18:00')
+    assert users['bob@example.com'][2].startswith('pbkdf2:sha256:1000$')
+    assert 'bad@example.com' not in users
+    assert len(managed) == 2
+    assert outbox == 2
@@ -0,0 +1,81 @@
+import pytest
+import app as app_module
+import sqlite3
+import gevent
+app = app_module.app
+
+KEY = {'X-Kiosk-Key': 'kiosk-key'}
+
+
+@pytest.fixture
+def client(monkeypatch, app_client, seed, make_user, login):
+    monkeypatch.setattr(app_module, 'KIOSK_API_KEY', 'kiosk-key')
+    ids = [make_user(f'User{i}') for i in range(20)]
+    with seed() as conn:
+        conn.executemany(
+            "INSERT INTO kiosk_badges (token_hash, user_id) VALUES (?, ?)",
+            [(app_module.hash_badge(f'badge-{i}'), user_id) for i, user_id in enumerate(ids)],
+        )
+    admin_id = make_user('Admin', is_admin=True)
+    app_module.kiosk_writer.reset_stats()
+    return login(app_client, admin_id, is_admin=True), ids
+
+
+def test_kiosk_requires_api_key(client):
+    client, ids = client
+    resp = client.post('/kiosk/punch', json={'badge': 'badge-0', 'type': 'in'})
+    assert resp.status_code == 401
+    resp = client.post('/kiosk/punch', json={'badge': 'badge-0', 'type': 'in'},
+                       headers={'X-Kiosk-Key': 'wrong'})
+    assert resp.status_code == 401
+
+
+def test_kiosk_punch_and_conflict(client):
+    client, ids = client
+    body = {'badge': 'badge-0', 'type': 'in', 'timestamp': '2024-04-01T09:00'}
+    resp = client.post('/kiosk/punch', json=body, headers=KEY)
+    assert resp.status_code == 200
+    assert resp.get_json()['status'] == 'created'
+    assert resp.get_json()['name'] == 'User0'
+    resp = client.post('/kiosk/punch', json=dict(body, timestamp='2024-04-01T09:03'), headers=KEY)
+    assert resp.status_code == 409
+    assert resp.get_json()['existing']['timestamp'] == '2024-04-01T09:00'
+    resp = client.post('/kiosk/punch', json=dict(body, badge='nobody'), headers=KEY)
+    assert resp.status_code == 404
+
+
+def test_concurrent_punches_are_group_committed(client):
+    client, ids = client
+
+    def punch(i):
+        with app.test_client() as c:
+            return c.post('/kiosk/punch', json={
+                'badge': f'badge-{i}', 'type': 'in', 'timestamp': '2024-04-01T09:00'
+            }, headers=KEY).status_code
+
+    jobs = [gevent.spawn(punch, i) for i in range(len(ids))]
+    gevent.joinall(jobs)
+    assert [job.value for job in jobs] == [200] * len(ids)
+    conn = sqlite3.connect(app_module.DB_PATH)
+    assert conn.execute("SELECT COUNT(*) FROM attendance").fetchone()[0] == len(ids)
+    conn.close()
+    stats = client.get('/admin/kiosk/stats').get_json()
+    assert stats['jobs'] == len(ids)
+    assert stats['batches'] < len(ids)
+
+
+def test_edit_user_sets_badge(client):
+    client, ids = client
+    resp = client.post(f'/admin/users/edit/{ids[1]}', data={
+        '_csrf_token': 'token', 'name': 'User1', 'email': 'u1@example.com',
+        'overtime_threshold': '18:00', 'kiosk_badge': 'badge-0',
+    })
+    assert 'このバッジ/PINは他のユーザーに登録されています。' in resp.get_data(as_text=True)
+    client.post(f'/admin/users/edit/{ids[1]}', data={
+        '_csrf_token': 'token', 'name': 'User1', 'email': 'u1@example.com',
+        'overtime_threshold': '18:00', 'kiosk_badge': 'new-badge',
+    })
+    resp = client.post('/kiosk/punch', json={'badge': 'new-badge', 'type': 'in'}, headers=KEY)
+    assert resp.get_json()['name'] == 'User1'
+    resp = client.post('/kiosk/punch', json={'badge': 'badge-1', 'type': 'out'}, headers=KEY)
+    assert resp.status_code == 404
@@ -0,0 +1,98 @@
+import socketserver
+import threading
+import pytest
+import app as app_module
+import sqlite3
+
+
+class SMTPStandIn(socketserver.StreamRequestHandler):
+    """最低限のSMTPコマンドだけを受け付けるテスト用サーバー"""
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        self.server.sessions += 1
+        self.reply('220 localhost ready')
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            cmd = line.split(' ', 1)[0].upper()
+            if cmd in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif cmd == 'DATA':
+                self.reply('354 end with .')
+                data = []
+                while True:
+                    chunk = self.rfile.readline().decode()
+                    if chunk.rstrip('\r\n') == '.':
+                        break
+                    data.append(chunk)
+                if self.server.fail:
+                    self.reply('451 try again later')
+                else:
+                    self.server.messages.append(''.join(data))
+                    self.reply('250 queued')
+            elif cmd == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPStandIn)
+    server.daemon_threads = True
+    server.messages, server.sessions, server.fail = [], 0, False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def db(test_db, seed, smtp_server):
+    with seed() as conn:
+        conn.execute(
+            "INSERT INTO mail_settings (id, server, port, use_tls, subject_template, body_template)"
+            " VALUES (1, '127.0.0.1', ?, 0, 'Welcome {name}', 'Hello {name} <{email}>')",
+            (smtp_server.server_address[1],),
+        )
+    conn = sqlite3.connect(test_db)
+    conn.row_factory = sqlite3.Row
+    yield conn
+    conn.close()
+
+
+def test_outbox_reuses_one_smtp_session(db, smtp_server):
+    for i in range(3):
+        assert app_module.send_registration_email(f'user{i}@example.com', f'User{i}', db)
+    db.commit()
+    assert app_module.process_mail_outbox() == 3
+    assert smtp_server.sessions == 1
+    assert len(smtp_server.messages) == 3
+    assert 'Hello User0 <user0@example.com>' in smtp_server.messages[0]
+    statuses = {r['status'] for r in db.execute("SELECT status FROM mail_outbox")}
+    assert statuses == {'sent'}
+
+
+def test_failed_delivery_is_retried_with_backoff(db, smtp_server, monkeypatch):
+    monkeypatch.setattr(app_module, 'MAIL_MAX_ATTEMPTS', 2)
+    smtp_server.fail = True
+    app_module.send_registration_email('user@example.com', 'User', db)
+    db.commit()
+    assert app_module.process_mail_outbox() == 0
+    row = db.execute("SELECT status, attempts, next_attempt_at, created_at, last_error FROM mail_outbox").fetchone()
+    assert row['status'] == 'pending' and row['attempts'] == 1
+    assert row['next_attempt_at'] > row['created_at'] and '451' in row['last_error']
+    # 次回送信時刻前は再送しない
+    assert app_module.process_mail_outbox() == 0
+    assert db.execute("SELECT attempts FROM mail_outbox").fetchone()[0] == 1
+    db.execute("UPDATE mail_outbox SET next_attempt_at = '2000-01-01 00:00:00'")
+    db.commit()
+    app_module.process_mail_outbox()
+    row = db.execute("SELECT status, attempts FROM mail_outbox").fetchone()
+    assert row['status'] == 'failed' and row['attempts'] == 2
@@ -0,0 +1,115 @@
+import os, sys, subprocess
+import pytest
+import app as app_module
+import sqlite3
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def migrations_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, 'DB_PATH', str(tmp_path / "test.db"))
+    migrations = tmp_path / "migrations"
+    migrations.mkdir()
+    monkeypatch.setattr(app_module, 'MIGRATIONS_DIR', str(migrations))
+    monkeypatch.setattr(app_module, 'python_migrations', {})
+    return migrations
+
+
+def user_version():
+    conn = sqlite3.connect(app_module.DB_PATH)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.close()
+    return version
+
+
+def test_migrations_apply_once(migrations_dir):
+    (migrations_dir / "0002_add_note.sql").write_text(
+        "ALTER TABLE users ADD COLUMN note TEXT;", encoding='utf-8'
+    )
+    assert app_module.initialize_database() == [1, 2]
+    assert user_version() == 2
+    assert app_module.initialize_database() == []
+
+
+def test_migrated_database_only_reads_user_version(migrations_dir, monkeypatch):
+    app_module.initialize_database()
+    statements = []
+    connect = sqlite3.connect
+
+    def traced_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(app_module.sqlite3, 'connect', traced_connect)
+    app_module.initialize_database()
+    assert statements == ["PRAGMA user_version"]
+
+
+def test_failed_migration_is_rolled_back(migrations_dir):
+    (migrations_dir / "0002_broken.sql").write_text(
+        "ALTER TABLE users ADD COLUMN note TEXT;\nSELECT * FROM no_such_table;", encoding='utf-8'
+    )
+    with pytest.raises(sqlite3.OperationalError):
+        app_module.initialize_database()
+    assert user_version() == 1
+    conn = sqlite3.connect(app_module.DB_PATH)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+    conn.close()
+    assert 'note' not in columns
+
+
+def test_python_backfill_resumes_in_chunks(migrations_dir, monkeypatch):
+    app_module.initialize_database()
+    conn = sqlite3.connect(app_module.DB_PATH)
+    conn.execute("ALTER TABLE users ADD COLUMN upper_name TEXT")
+    conn.executemany(
+        "INSERT INTO users (email, name, password_hash) VALUES (?, ?, 'hash')",
+        [(f'u{i}@example.com', f'user{i}') for i in range(25)],
+    )
+    conn.commit()
+    conn.close()
+    calls = []
+
+    def fill(conn, rows):
+        calls.append(len(rows))
+        if len(calls) == 2:
+            raise RuntimeError('interrupted')
+        conn.executemany("UPDATE users SET upper_name = ? WHERE id = ?", [(name.upper(), id_) for id_, name in rows])
+
+    @app_module.python_migration(2)
+    def fill_upper_name(conn):
+        app_module.backfill_in_chunks(
+            conn, "SELECT id, name FROM users WHERE upper_name IS NULL LIMIT ?", fill, chunk_size=10
+        )
+
+    with pytest.raises(RuntimeError):
+        app_module.initialize_database()
+    assert user_version() == 1
+    assert app_module.initialize_database() == [2]
+    # 中断前に終えた最初のチャンクは再処理しない
+    assert calls == [10, 10, 10, 5]
+    conn = sqlite3.connect(app_module.DB_PATH)
+    assert conn.execute("SELECT COUNT(*) FROM users WHERE upper_name IS NULL").fetchone()[0] == 0
+    conn.close()
+
+
+def test_concurrent_workers_apply_each_migration_once(migrations_dir):
+    (migrations_dir / "0002_counter.sql").write_text(
+        "CREATE TABLE applied (n INTEGER);\nINSERT INTO applied VALUES (2);", encoding='utf-8'
+    )
+    script = (
+        "import sys, os; sys.path.insert(0, sys.argv[1]); os.environ.setdefault('SECRET_KEY', 'x');"
+        "import app; app.DB_PATH = sys.argv[2]; app.MIGRATIONS_DIR = sys.argv[3]; app.python_migrations = {};"
+        "app.initialize_database()"
+    )
+    workers = [
+        subprocess.Popen([sys.executable, '-c', script, ROOT, app_module.DB_PATH, str(migrations_dir)])
+        for _ in range(4)
+    ]
+    assert [w.wait(timeout=60) for w in workers] == [0] * 4
+    conn = sqlite3.connect(app_module.DB_PATH)
+    assert conn.execute("SELECT COUNT(*) FROM applied").fetchone()[0] == 1
+    conn.close()
+    assert user_version() == 2
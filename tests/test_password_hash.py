@@ -0,0 +1,29 @@
+import app as app_module
+import sqlite3
+from werkzeug.security import generate_password_hash
+
+
+def test_hash_and_verify_through_pool():
+    calls = app_module.password_hash_stats['calls']
+    pwhash = app_module.hash_password('password123')
+    assert app_module.verify_password(pwhash, 'password123')
+    assert not app_module.verify_password(pwhash, 'wrong')
+    assert app_module.password_hash_stats['calls'] == calls + 3
+    assert app_module.password_hash_stats['queued'] == 0
+
+
+def test_rehash_on_login_when_cost_changes(monkeypatch, app_client, make_user):
+    monkeypatch.setattr(app_module, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')
+    monkeypatch.setattr(app_module, '_password_hash_prefix', None)
+    make_user('User', password_hash=generate_password_hash('password123', method='pbkdf2:sha256:2000'))
+    with app_client.session_transaction() as sess:
+        sess['_csrf_token'] = 'token'
+    resp = app_client.post('/login', data={
+        '_csrf_token': 'token', 'email': 'user@example.com', 'password': 'password123',
+    })
+    assert resp.status_code == 302
+    conn = sqlite3.connect(app_module.DB_PATH)
+    stored = conn.execute("SELECT password_hash FROM users").fetchone()[0]
+    conn.close()
+    assert stored.startswith('pbkdf2:sha256:1000$')
+    assert not app_module.password_needs_rehash(stored)
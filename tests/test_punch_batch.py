@@ -0,0 +1,104 @@
+import pytest
+import app as app_module
+import sqlite3
+
+
+@pytest.fixture
+def client(app_client, seed, make_user, login):
+    user_id = make_user('User')
+    with seed() as conn:
+        conn.execute(
+            "INSERT INTO attendance (user_id, timestamp, type, description) VALUES (?, '2024-04-01T09:00', 'in', '')",
+            (user_id,),
+        )
+    return login(app_client, user_id), user_id
+
+
+def fetch_punches(user_id):
+    conn = sqlite3.connect(app_module.DB_PATH)
+    rows = conn.execute(
+        "SELECT timestamp, type, description FROM attendance WHERE user_id = ? ORDER BY timestamp",
+        (user_id,),
+    ).fetchall()
+    conn.close()
+    return rows
+
+
+def test_batch_applies_punches_with_per_item_results(client):
+    client, user_id = client
+    resp = client.post('/punch/batch', json={'punches': [
+        {'id': 'a', 'timestamp': '2024-04-01T18:00', 'type': 'out', 'description': '作業'},
+        {'id': 'b', 'timestamp': '2024-04-01T09:05', 'type': 'in'},
+        {'id': 'c', 'timestamp': '2024-04-01T09:00', 'type': 'in'},
+        {'id': 'd', 'timestamp': 'not-a-date', 'type': 'in'},
+        {'id': 'e', 'timestamp': '2024-04-02T09:00', 'type': 'lunch'},
+        {'id': 'f', 'timestamp': '2024-02-31T09:00', 'type': 'in'},
+    ]}, headers={'X-CSRF-Token': 'token'})
+    assert resp.status_code == 200
+    results = {r['id']: r for r in resp.get_json()['results']}
+    assert results['a']['status'] == 'created'
+    assert results['b']['status'] == 'conflict'
+    assert results['b']['existing']['timestamp'] == '2024-04-01T09:00'
+    assert results['c']['status'] == 'duplicate'
+    assert results['d']['status'] == 'invalid'
+    assert results['e']['status'] == 'invalid'
+    assert results['f']['status'] == 'invalid'
+    assert fetch_punches(user_id) == [
+        ('2024-04-01T09:00', 'in', ''),
+        ('2024-04-01T18:00', 'out', '作業'),
+    ]
+
+
+def test_batch_overwrite_replaces_existing_punch(client):
+    client, user_id = client
+    resp = client.post('/punch/batch', json={'punches': [
+        {'id': 'a', 'timestamp': '2024-04-01T09:10', 'type': 'in', 'on_conflict': 'overwrite'},
+    ]}, headers={'X-CSRF-Token': 'token'})
+    assert resp.get_json()['results'][0]['status'] == 'overwritten'
+    assert fetch_punches(user_id) == [('2024-04-01T09:10', 'in', '')]
+
+
+def test_batch_requires_csrf_header(client):
+    client, user_id = client
+    resp = client.post('/punch/batch', json={'punches': [
+        {'id': 'a', 'timestamp': '2024-04-02T09:00', 'type': 'in'},
+    ]})
+    assert resp.status_code == 400
+    assert len(fetch_punches(user_id)) == 1
+
+
+def test_offline_shell_keeps_flashes_and_is_not_http_cached(client):
+    client, user_id = client
+    with client.session_transaction() as sess:
+        sess['user_name'] = 'User'
+        sess['_flashes'] = [('success', '打刻しました。')]
+    resp = client.get('/offline')
+    page = resp.get_data(as_text=True)
+    assert resp.status_code == 200
+    assert 'no-store' in resp.headers['Cache-Control']
+    assert 'id="punch-form"' in page and 'value="token"' in page
+    assert '打刻しました。' not in page
+    # 保存用の画面はフラッシュメッセージを消費しない
+    assert '打刻しました。' in client.get('/').get_data(as_text=True)
+    with client.session_transaction() as sess:
+        sess.clear()
+    assert client.get('/offline').status_code == 302
+
+
+def test_resolve_rejects_malformed_timestamps(client):
+    client, user_id = client
+    resp = client.post('/punch/resolve', data={
+        '_csrf_token': 'token', 'action': 'overwrite', 'day': '2024-04-01', 'type': 'in',
+        'timestamp': '2024-04-01 09:30', 'referer': '/',
+    })
+    assert resp.status_code == 302
+    resp = client.post('/my/import/resolve', data={
+        '_csrf_token': 'token', 'referer': '/my/logs',
+        'choice_2024-04-01_in': 'incoming', 'incoming_ts_2024-04-01_in': '2024-04-01T25:00',
+        'choice_2024-04-02_in': 'incoming', 'incoming_ts_2024-04-02_in': '2024-04-02T09:00:00',
+    })
+    assert resp.status_code == 302
+    with client.session_transaction() as sess:
+        assert ('danger', '2024-04-01 の in：時刻の形式が正しくありません。') in sess['_flashes']
+    # 不正な時刻は保存されず、正しい行だけが取り込まれる
+    assert fetch_punches(user_id) == [('2024-04-01T09:00', 'in', ''), ('2024-04-02T09:00:00', 'in', '')]
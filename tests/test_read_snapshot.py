@@ -0,0 +1,48 @@
+import pytest
+import app as app_module
+import sqlite3
+
+
+@pytest.fixture
+def db(test_db, seed, make_user):
+    user_id = make_user('User', overtime_threshold='17:00')
+    with seed() as conn:
+        conn.execute(
+            "INSERT INTO attendance (user_id, timestamp, type) VALUES (?, '2024-04-01T09:00:00', 'in')", (user_id,)
+        )
+    conn = sqlite3.connect(test_db, timeout=0.1)
+    yield conn, user_id
+    conn.close()
+
+
+def test_database_uses_wal(db):
+    conn, user_id = db
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+
+def test_snapshot_is_consistent_and_does_not_block_writers(db, tmp_path):
+    conn, user_id = db
+    with app_module.read_snapshot() as snapshot:
+        # スナップショット取得後の書き込みは待たされず、スナップショットからは見えない
+        conn.execute(
+            "INSERT INTO attendance (user_id, timestamp, type) VALUES (?, '2024-04-01T18:30:00', 'out')", (user_id,)
+        )
+        conn.commit()
+        path = app_module.generate_csv(user_id, 'User', 2024, 4, str(tmp_path), '17:00', conn=snapshot)
+    with open(path, encoding='utf-8-sig') as f:
+        lines = f.read().splitlines()
+    assert lines[1] == '2024/04/01,月,09:00,,,'
+    with app_module.read_snapshot() as snapshot:
+        assert snapshot.execute("SELECT COUNT(*) FROM attendance").fetchone()[0] == 2
+
+
+@pytest.mark.parametrize('dirname', ['a?b', 'a#b', '100%'])
+def test_snapshot_handles_uri_characters_in_path(tmp_path, monkeypatch, dirname):
+    path = tmp_path / dirname / 'kintai.db'
+    path.parent.mkdir()
+    monkeypatch.setattr(app_module, 'DB_PATH', str(path))
+    app_module.initialize_database()
+    with app_module.read_snapshot() as snapshot:
+        assert snapshot.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+        with pytest.raises(sqlite3.OperationalError):
+            snapshot.execute("DELETE FROM users")
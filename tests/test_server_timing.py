@@ -0,0 +1,37 @@
+import re, logging
+import pytest
+import app as app_module
+
+
+@pytest.fixture
+def client(monkeypatch, app_client, make_user, login):
+    monkeypatch.setattr(app_module, 'SERVER_TIMING', True)
+    return login(app_client, make_user('User'), name='User')
+
+
+def test_server_timing_header(client):
+    resp = client.get('/my/logs', headers={'X-Request-ID': 'abc-123'})
+    header = resp.headers['Server-Timing']
+    for name in ('db;dur=', 'tpl;dur=', 'ctx;dur=', 'app;dur=', 'total;dur='):
+        assert name in header
+    assert 'reqid;desc="abc-123"' in header
+    assert resp.headers['X-Request-ID'] == 'abc-123'
+
+
+def test_invalid_request_id_is_replaced(client):
+    resp = client.get('/my/logs', headers={'X-Request-ID': 'bad id"'})
+    assert resp.headers['X-Request-ID'] != 'bad id"'
+    assert len(resp.headers['X-Request-ID']) == 16
+
+
+def test_streamed_page_logs_full_timing_on_close(client, caplog):
+    with caplog.at_level(logging.INFO, logger='app'):
+        resp = client.get('/my/logs', headers={'X-Request-ID': 'stream-1'})
+        resp.get_data()
+        resp.close()
+    ends = [r.getMessage() for r in caplog.records if r.getMessage().startswith('Request end')]
+    # ヘッダ送信時ではなく、送信完了時に1回だけ記録される
+    assert len(ends) == 1
+    assert '(streamed)' in ends[0] and '[stream-1]' in ends[0]
+    tpl = float(re.search(r'tpl;dur=([0-9.]+)', ends[0]).group(1))
+    assert tpl > 0
@@ -0,0 +1,46 @@
+import pytest
+import app as app_module
+import sqlite3
+app = app_module.app
+
+
+@pytest.fixture
+def client(monkeypatch, app_client):
+    monkeypatch.setitem(app.config, 'TESTING', False)
+    with app_client.session_transaction() as sess:
+        sess['_csrf_token'] = 'token'
+    yield app_client
+    app_module._setup_completed.discard(app_module.DB_PATH)
+
+
+def test_setup_flag_cached_after_first_superadmin(client, query_budget):
+    resp = client.get('/login')
+    assert resp.status_code == 302 and resp.headers['Location'].endswith('/setup')
+
+    resp = client.post('/setup', data={
+        '_csrf_token': 'token',
+        'name': 'Admin',
+        'email': 'admin@example.com',
+        'password': 'password123',
+        'confirm_password': 'password123',
+    })
+    assert resp.headers['Location'].endswith('/login')
+
+    with query_budget(0):
+        assert client.get('/login').status_code == 200
+
+    conn = sqlite3.connect(app_module.DB_PATH)
+    row = conn.execute("SELECT value FROM app_settings WHERE key = 'setup_completed'").fetchone()
+    conn.close()
+    assert row is not None
+
+
+def test_existing_database_is_detected(client):
+    conn = sqlite3.connect(app_module.DB_PATH)
+    conn.execute(
+        "INSERT INTO users (email, name, password_hash) VALUES ('a@example.com', 'A', 'hash')"
+    )
+    conn.commit()
+    conn.close()
+    assert client.get('/login').status_code == 200
+    assert app_module.DB_PATH in app_module._setup_completed
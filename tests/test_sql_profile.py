@@ -0,0 +1,62 @@
+import pytest
+import app as app_module
+app = app_module.app
+
+
+@pytest.fixture
+def client(app_client, seed, make_user, login):
+    user_id = make_user('User')
+    with seed() as conn:
+        conn.executemany(
+            "INSERT INTO attendance (user_id, timestamp, type) VALUES (?, ?, ?)",
+            [(user_id, '2024-04-01T09:00:00', 'in'), (user_id, '2024-04-01T18:30:00', 'out')],
+        )
+    return login(app_client, user_id, name='User')
+
+
+def test_queries_are_recorded_with_rows_and_plan(client):
+    with app_module.record_queries() as queries:
+        resp = client.get('/my/logs')
+        resp.get_data()
+    assert resp.status_code == 200
+    logs = [q for q in queries if 'FROM attendance WHERE' in q['sql']]
+    assert logs and logs[0]['rows'] == 2
+    assert all(q['duration'] >= 0 for q in queries)
+    assert '  ' not in logs[0]['sql']
+
+
+def test_full_scan_is_flagged(client):
+    with app.app_context(), app_module.record_queries() as queries:
+        app_module.get_db().execute("SELECT COUNT(*) FROM attendance WHERE description = 'x'").fetchone()
+    assert queries[0]['full_scan']
+    assert queries[0]['sql'].endswith('description = ?')
+
+
+def test_plan_cache_is_bounded(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'QUERY_PLAN_CACHE_SIZE', 3)
+    monkeypatch.setattr(app_module, '_query_plans', app_module.OrderedDict())
+    with app.app_context(), app_module.record_queries():
+        conn = app_module.get_db()
+        for column in ('id', 'email', 'name', 'is_admin', 'id'):
+            conn.execute(f"SELECT {column} FROM users WHERE id = 1").fetchall()
+    # 最近使った順に上限件数だけ残る
+    assert list(app_module._query_plans) == [
+        'SELECT name FROM users WHERE id = ?', 'SELECT is_admin FROM users WHERE id = ?', 'SELECT id FROM users WHERE id = ?',
+    ]
+
+
+def test_server_timing_alone_does_not_explain(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'SERVER_TIMING', True)
+    monkeypatch.setattr(app_module, 'SQL_PROFILE', False)
+    explained = []
+    monkeypatch.setattr(app_module, 'explain_query', lambda *args: explained.append(args) or ([], False))
+    resp = client.get('/my/logs')
+    resp.get_data()
+    assert 'db;dur=' in resp.headers['Server-Timing']
+    assert explained == []
+
+
+def test_my_logs_query_budget(client, query_budget):
+    with query_budget(3):
+        resp = client.get('/my/logs')
+        assert '2024-04-01' in resp.get_data(as_text=True)
@@ -0,0 +1,33 @@
+import pytest
+import app as app_module
+
+
+@pytest.fixture
+def client(app_client, seed, make_user, login):
+    admin_id = make_user('Admin', is_admin=True)
+    user_id = make_user('User', managed_by=admin_id)
+    with seed() as conn:
+        conn.executemany(
+            "INSERT INTO messages (sender_id, recipient_id, message, timestamp, is_read, read_timestamp)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            [(admin_id, user_id, f'msg{i}', f'2024-01-01 09:{i:02d}:00', 1, f'2024-01-01 10:{i:02d}:00')
+             for i in range(25)],
+        )
+    return login(app_client, admin_id, is_admin=True)
+
+
+def test_chat_page_is_streamed(client):
+    resp = client.get('/chat/2')
+    assert resp.is_streamed
+    html = resp.get_data(as_text=True)
+    assert 'msg5' in html and 'msg24' in html and 'msg4<' not in html
+    assert html.index('msg5') < html.index('msg24')
+    assert 'let earliest = 6;' in html
+    assert "let lastRead = '2024-01-01 10:24:00';" in html
+
+
+def test_flash_is_consumed_before_streaming(client):
+    with client.session_transaction() as sess:
+        sess['_flashes'] = [('success', 'flash-once')]
+    assert 'flash-once' in client.get('/my/logs').get_data(as_text=True)
+    assert 'flash-once' not in client.get('/my/logs').get_data(as_text=True)
@@ -0,0 +1,60 @@
+import pytest
+import app as app_module
+app = app_module.app
+
+
+@pytest.fixture
+def git_calls(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, 'DB_PATH', str(tmp_path / "test.db"))
+    calls = []
+    outputs = {
+        ('rev-parse', 'HEAD'): 'aaa',
+        ('fetch',): '',
+        ('rev-parse', 'origin/main'): 'bbb',
+        ('diff', '--name-only', 'HEAD', 'origin/main'): 'app.py\ndatabase/schema.sql\n',
+    }
+
+    def fake_git(*args):
+        calls.append(args)
+        return outputs[args]
+
+    monkeypatch.setattr(app_module, '_git', fake_git)
+    monkeypatch.setattr(app_module, '_update_status', dict(app_module._update_status, checked_at=None))
+    return calls
+
+
+def test_check_fetches_once(git_calls):
+    status = app_module.check_for_updates()
+    assert git_calls.count(('fetch',)) == 1
+    assert status['changed_files'] == ['app.py', 'database/schema.sql']
+    assert status['critical_changes']
+    assert status['checked_at']
+
+
+def test_fetch_runs_in_one_worker_per_interval(git_calls):
+    app_module.check_for_updates()
+    # 直近に取得済みなら、他のワーカーは取得済みの origin/main と比べるだけ
+    status = app_module.check_for_updates()
+    assert git_calls.count(('fetch',)) == 1
+    assert status['remote'] == 'bbb'
+    with app_module.try_file_lock(app_module.DB_PATH + '.update.lock') as locked:
+        assert locked
+        # 取得中のワーカーがいれば、今すぐ確認でも重ねて取得しない
+        app_module.check_for_updates(force=True)
+    assert git_calls.count(('fetch',)) == 1
+    app_module.check_for_updates(force=True)
+    assert git_calls.count(('fetch',)) == 2
+
+
+def test_page_reads_cached_status(git_calls):
+    app.config['TESTING'] = True
+    app_module.check_for_updates()
+    git_calls.clear()
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['is_superadmin'] = True
+        resp = client.get('/admin/update')
+    assert resp.status_code == 200
+    assert git_calls == []
+    assert 'bbb' in resp.get_data(as_text=True)
@@ -0,0 +1,41 @@
+import os
+import pytest
+import app as app_module
+import sqlite3
+app = app_module.app
+
+
+@pytest.fixture
+def users(make_user):
+    admin_id = make_user('Admin', is_admin=True)
+    return admin_id, make_user('User', managed_by=admin_id)
+
+
+def test_can_chat_is_served_from_cache(users, query_budget):
+    admin_id, user_id = users
+    with app.test_request_context('/'):
+        app_module.session['is_admin'] = True
+        assert app_module.can_chat(admin_id, user_id)
+        assert app_module.fetch_user_name(user_id) == 'User'
+    with app.test_request_context('/'), query_budget(0):
+        app_module.session['is_admin'] = True
+        assert app_module.can_chat(admin_id, user_id)
+        assert not app_module.can_chat(admin_id, admin_id)
+        assert app_module.fetch_user_name(user_id) == 'User'
+
+
+def test_invalidation_from_another_worker(users):
+    admin_id, user_id = users
+    with app.test_request_context('/'):
+        assert app_module.can_chat(user_id, admin_id)
+    conn = sqlite3.connect(app_module.DB_PATH)
+    conn.execute("DELETE FROM admin_managed_users")
+    conn.commit()
+    conn.close()
+    # 別ワーカーでの無効化はスタンプファイルの更新として届く
+    stamp = app_module._user_cache_stamp_path()
+    with open(stamp, 'w') as f:
+        f.write('other-worker')
+    os.utime(stamp, ns=(1, 1))
+    with app.test_request_context('/'):
+        assert not app_module.can_chat(user_id, admin_id)
@@ -0,0 +1,83 @@
+import os
+import pytest
+import app as app_module
+import sqlite3
+import gevent
+
+
+@pytest.fixture
+def client(monkeypatch, app_client, make_user, login):
+    monkeypatch.setattr(app_module, 'DB_WRITE_QUEUE', True)
+    admin_id = make_user('Admin', is_admin=True)
+    user_id = make_user('User', managed_by=admin_id)
+    app_module.db_writer.reset_stats()
+    return login(app_client, admin_id, is_admin=True), admin_id, user_id
+
+
+def test_writes_go_through_queue(client):
+    client, admin_id, user_id = client
+    client.post('/punch', data={'_csrf_token': 'token', 'timestamp': '2024-04-01T09:00', 'type': 'in'})
+    resp = client.post('/punch', data={'_csrf_token': 'token', 'timestamp': '2024-04-01T09:05', 'type': 'in'})
+    assert '<title>打刻確認</title>' in resp.get_data(as_text=True)
+    client.post(f'/chat/{user_id}', data={'_csrf_token': 'token', 'message': 'hello'})
+    stats = client.get('/admin/db/write_stats').get_json()
+    assert stats['enabled'] is True
+    assert stats['jobs'] == 3
+    assert stats['errors'] == 0
+    assert os.path.exists(app_module.DB_PATH + '.write.lock')
+    conn = sqlite3.connect(app_module.DB_PATH)
+    assert conn.execute("SELECT COUNT(*) FROM attendance").fetchone()[0] == 1
+    assert conn.execute("SELECT message FROM messages").fetchone()[0] == 'hello'
+    conn.close()
+
+
+def test_failed_job_does_not_affect_batch(client):
+    client, admin_id, user_id = client
+
+    def bad(conn):
+        conn.execute("INSERT INTO attendance (user_id, timestamp, type) VALUES (?, '2024-04-01T09:00', 'in')", (user_id,))
+        raise ValueError('boom')
+
+    def good(conn):
+        conn.execute("INSERT INTO attendance (user_id, timestamp, type) VALUES (?, '2024-04-02T09:00', 'in')", (user_id,))
+        return 'ok'
+
+    def submit(func):
+        try:
+            return app_module.db_writer.submit(func)
+        except ValueError as e:
+            return str(e)
+
+    jobs = [gevent.spawn(submit, bad), gevent.spawn(submit, good)]
+    gevent.joinall(jobs)
+    assert [job.value for job in jobs] == ['boom', 'ok']
+    conn = sqlite3.connect(app_module.DB_PATH)
+    rows = conn.execute("SELECT timestamp FROM attendance").fetchall()
+    conn.close()
+    assert rows == [('2024-04-02T09:00',)]
+
+
+def test_user_management_goes_through_writer(client):
+    client, admin_id, user_id = client
+    form = {'_csrf_token': 'token', 'name': 'New', 'email': 'new@example.com',
+            'password': 'password123', 'confirm_password': 'password123'}
+    assert client.post('/admin/users/create', data=form).status_code == 302
+    # 重複したメールアドレスの IntegrityError は書き込みスレッドから呼び出し元へ届く
+    resp = client.post('/admin/users/create', data=form)
+    assert 'このメールアドレスはすでに登録されています' in resp.get_data(as_text=True)
+    conn = sqlite3.connect(app_module.DB_PATH)
+    new_id = conn.execute("SELECT id FROM users WHERE email = 'new@example.com'").fetchone()[0]
+    conn.close()
+    client.post('/admin/users/manage', data={'_csrf_token': 'token', 'managed_users': [user_id, new_id]})
+    client.post(f'/admin/users/edit/{new_id}', data={
+        '_csrf_token': 'token', 'name': 'Renamed', 'email': 'new@example.com', 'overtime_threshold': '18:00',
+        'kiosk_badge': 'badge-1',
+    })
+    client.post(f'/admin/users/delete/{user_id}', data={'_csrf_token': 'token'})
+    stats = client.get('/admin/db/write_stats').get_json()
+    assert stats['jobs'] == 5
+    conn = sqlite3.connect(app_module.DB_PATH)
+    assert conn.execute("SELECT name FROM users ORDER BY id").fetchall() == [('Admin',), ('Renamed',)]
+    assert (new_id,) in conn.execute("SELECT user_id FROM admin_managed_users").fetchall()
+    assert conn.execute("SELECT user_id FROM kiosk_badges").fetchall() == [(new_id,)]
+    conn.close()
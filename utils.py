@@ -1,5 +1,5 @@
 import re
-from datetime import datetime
+from datetime import date, datetime
 
 __all__ = [
     'is_valid_email',
@@ -9,6 +9,12 @@ __all__ = [
     'normalize_time_str',
     'calculate_overtime',
     'sanitize_filename',
+    'normalize_sql',
+    'split_timestamp',
+    'date_to_day',
+    'format_day',
+    'format_minute',
+    'weekday_of_day',
 ]
 
 def is_valid_email(email: str) -> bool:
@@ -98,3 +104,56 @@ def sanitize_filename(name: str) -> str:
     """Return a filename-safe string made of alphanumerics, hyphen and underscore."""
     return re.sub(r'[^A-Za-z0-9_-]+', '', name)
 
+
+
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace and replace literals with ? so statements can be grouped."""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def split_timestamp(ts: str) -> tuple[int, int]:
+    """Split 'YYYY-MM-DDTHH:MM[:SS]' into a YYYYMMDD integer and minute of day."""
+    date_part, sep, time_part = ts.partition('T')
+    if not sep:
+        raise ValueError(f"invalid timestamp: {ts!r}")
+    hour, minute = time_part.split(':')[:2]
+    hour, minute = int(hour), int(minute[:2])
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"invalid timestamp: {ts!r}")
+    return date_to_day(date_part), hour * 60 + minute
+
+
+def date_to_day(date_str: str) -> int:
+    """Convert 'YYYY-MM-DD' into a YYYYMMDD integer, rejecting dates not on the calendar.
+
+    This is the validator for stored dates, so it is only used on write paths;
+    reads go through format_day/weekday_of_day on already valid integers.
+    """
+    year, month, day = date_str.split('-')
+    year, month, day = int(year), int(month), int(day)
+    date(year, month, day)  # raises ValueError for e.g. 2024-02-31
+    return year * 10000 + month * 100 + day
+
+
+def format_day(day: int, sep: str = '-') -> str:
+    """Format a YYYYMMDD integer as 'YYYY-MM-DD' (or with another separator)."""
+    return f"{day // 10000:04d}{sep}{day // 100 % 100:02d}{sep}{day % 100:02d}"
+
+
+def format_minute(minute: int) -> str:
+    """Format a minute of day as 'HH:MM'."""
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+_WEEKDAY_OFFSETS = (0, 3, 2, 5, 0, 3, 5, 1, 4, 6, 2, 4)
+
+
+def weekday_of_day(day: int) -> int:
+    """Return the weekday (Monday=0) of a YYYYMMDD integer without building a datetime."""
+    year, month, dom = day // 10000, day // 100 % 100, day % 100
+    if month < 3:
+        year -= 1
+    sunday_based = (year + year // 4 - year // 100 + year // 400 + _WEEKDAY_OFFSETS[month - 1] + dom) % 7
+    return (sunday_based + 6) % 7